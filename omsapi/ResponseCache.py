@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# **ResponseCache: persistent storage of OMS responses on disk**  
+# 
+# While developing a notebook, the same OMS queries are typically repeated many times, mostly for historical runs for which the response will never change. The ResponseCache stores the raw responses on disk, keyed on the (normalized) query URL, so that repeated queries do not need to go to the network.  
+# 
+# A ResponseCache is usually not used directly, but attached to an OMSAPI instance using OMSAPI.set_response_cache (see omsapi.py), or to the omsinterface tools using omstools.set_response_cache.  
+# Entries expire after a time-to-live that can be set per endpoint, except for queries that only concern finished runs (see the finalrun argument), which never expire. The total size of the cache on disk is bounded; when the bound is exceeded, the least recently used entries are removed.  
+# In offline mode, queries are answered from the cache only (also with expired entries), and queries that are not in the cache raise an error. This can also be used to replay previously recorded responses, e.g. for testing without network access.
+
+
+
+### imports
+
+# external modules
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import requests
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# local modules
+sys.path.append(os.path.abspath('../utils/notebook_utils'))
+
+
+
+
+### default time-to-live (in seconds) per endpoint
+# the key 'default' is used for endpoints that are not explicitly listed,
+# a value of None means that the entries never expire.
+
+DEFAULT_TTLS = {'default': 24*3600, 'meta': 7*24*3600}
+
+
+
+
+class ResponseCache(object):
+    ### persistent storage of OMS responses on disk
+    # each entry is a file in the cache directory, named after a hash of the normalized query url (see normalize_url).
+    # the first line of the file is a json header with the url, the endpoint, the time of the query
+    # and whether the response is final (i.e. never expires), the rest of the file is the raw response body.
+    # the modification time of the files is used to keep track of the least recently used entries.
+
+    def __init__( self, cachedir, maxsize=1e9, ttls=None, finalrun=None, offline=False ):
+        ### initializer
+        # input arguments:
+        # - cachedir: directory where to store the responses (created if it does not exist yet)
+        # - maxsize: maximum total size of the cache in bytes (default: 1 GB)
+        # - ttls: dict matching endpoint names (e.g. 'runs' or 'lumisections') to a time-to-live in seconds
+        #   (None for entries that never expire), overriding the defaults in DEFAULT_TTLS.
+        #   the metadata of an endpoint is stored under the endpoint name 'meta'.
+        # - finalrun: last run number that is known to be finished;
+        #   responses for queries that only concern runs up to this number never expire.
+        #   (a query only concerns runs up to finalrun if it has a run_number filter with operator EQ, LE or LT
+        #   and a value not larger than finalrun.)
+        # - offline: if True, only the cache is used, and queries that are not in the cache raise an error.
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls is not None: self.ttls.update(ttls)
+        self.finalrun = finalrun
+        self.offline = offline
+        if not os.path.exists(self.cachedir): os.makedirs(self.cachedir)
+
+    def normalize_url( self, url ):
+        ### get a normalized version of a query url, used as key in the cache
+        # mostly for internal use.
+        # the query parameters are sorted, and so are the items of comma-separated values
+        # (e.g. the order of the attributes in fields=...), so that equivalent queries share the same entry.
+        # the items of the sort parameter are kept in their order, since it defines the sorting priority.
+        # the scheme and host are dropped, as well as the part of the path before the 'api' segment
+        # (e.g. '/agg/api/v1/runs/' gives 'api/v1/runs/'), so that responses recorded through one base url
+        # (e.g. OMS_ALTERNATIVE_API_URL outside the CERN network) are also found when querying through another one.
+        parts = urlsplit(url)
+        path = parts.path
+        segments = path.split('/')
+        if 'api' in segments: path = '/'.join(segments[segments.index('api'):])
+        params = []
+        for key,val in parse_qsl(parts.query, keep_blank_values=True):
+            if key!='sort': val = ','.join(sorted(val.split(',')))
+            params.append( (key,val) )
+        query = urlencode( sorted(params), safe='[],' )
+        return urlunsplit( ('', '', path, query, '') )
+
+    def get_path( self, url ):
+        ### get the path to the file corresponding to a given url
+        # mostly for internal use.
+        key = hashlib.sha1( self.normalize_url(url).encode() ).hexdigest()
+        return os.path.join( self.cachedir, key+'.resp' )
+
+    def get_endpoint( self, url ):
+        ### get the endpoint name from a query url
+        # mostly for internal use.
+        # e.g. '.../api/v1/lumisections/?filter...' gives 'lumisections', '.../api/v1/runs/meta' gives 'meta'.
+        parts = [part for part in urlsplit(url).path.split('/') if len(part)>0]
+        if len(parts)==0: return ''
+        return parts[-1]
+
+    def is_final( self, url ):
+        ### check whether the response to a query url will never change, based on its run number filters
+        # mostly for internal use.
+        if self.finalrun is None: return False
+        maxrun = None
+        for key,val in parse_qsl(urlsplit(url).query):
+            if key not in ['filter[run_number][EQ]','filter[run_number][LE]','filter[run_number][LT]']: continue
+            try: val = int(val)
+            except ValueError: continue
+            if maxrun is None or val<maxrun: maxrun = val
+        return (maxrun is not None and maxrun<=self.finalrun)
+
+    def get( self, url ):
+        ### retrieve a response from the cache
+        # input arguments:
+        # - url: full query url
+        # returns:
+        # - a requests.Response object (with status code 200 and the cached body),
+        #   or None if the url is not in the cache or its entry has expired (and the cache is not in offline mode)
+        path = self.get_path( url )
+        try:
+            with open(path,'rb') as f:
+                header = json.loads(f.readline())
+                body = f.read()
+        except (OSError,ValueError):
+            # (missing or corrupt file, treat as a miss)
+            return None
+        if self.normalize_url(header['url'])!=self.normalize_url(url): return None
+        if not self.offline and not header['final']:
+            ttl = self.ttls.get(header['endpoint'], self.ttls['default'])
+            if ttl is not None and time.time()-header['time']>ttl: return None
+        # mark as recently used
+        try: os.utime(path)
+        except OSError: pass
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response.encoding = header.get('encoding', None)
+        response._content = body
+        return response
+
+    def put( self, url, response ):
+        ### add a response to the cache
+        # input arguments:
+        # - url: full query url
+        # - response: requests.Response object (only successful responses with status code 200 are stored)
+        # notes:
+        # - the file is first written under a temporary name and then renamed,
+        #   so that an interrupted or concurrent write never leaves a corrupt entry behind.
+        # - after writing, the least recently used entries are removed if the cache exceeds its maximum size.
+        if response.status_code!=200: return
+        header = {'url': url, 'endpoint': self.get_endpoint(url), 'time': time.time(),
+                  'final': self.is_final(url), 'encoding': response.encoding}
+        path = self.get_path( url )
+        (fd,temppath) = tempfile.mkstemp( dir=self.cachedir, suffix='.tmp' )
+        with os.fdopen(fd,'wb') as f:
+            f.write( (json.dumps(header)+'\n').encode() )
+            f.write( response.content )
+        os.replace( temppath, path )
+        self.evict()
+
+    def fetch( self, url, request ):
+        ### get a response from the cache, or execute a request and store its response in the cache
+        # input arguments:
+        # - url: full query url
+        # - request: function without arguments that executes the query and returns a requests.Response object
+        # returns:
+        # - a requests.Response object
+        response = self.get( url )
+        if response is not None: return response
+        if self.offline:
+            raise Exception('ERROR in ResponseCache.fetch: url {} was not found in the cache'.format(url)
+                           +' and the cache is in offline mode.')
+        response = request()
+        self.put( url, response )
+        return response
+
+    def get_entries( self ):
+        ### get a list of tuples (path, size in bytes, last use time) for all entries in the cache
+        # mostly for internal use.
+        entries = []
+        for f in os.listdir(self.cachedir):
+            if os.path.splitext(f)[1]!='.resp': continue
+            path = os.path.join(self.cachedir,f)
+            try: stat = os.stat(path)
+            except OSError: continue
+            entries.append( (path,stat.st_size,stat.st_mtime) )
+        return entries
+
+    def get_size( self ):
+        ### get the total size of the cache in bytes
+        return sum([entry[1] for entry in self.get_entries()])
+
+    def evict( self ):
+        ### remove the least recently used entries until the cache is smaller than its maximum size
+        entries = sorted( self.get_entries(), key=lambda entry: entry[2] )
+        totalsize = sum([entry[1] for entry in entries])
+        for (path,size,_) in entries:
+            if totalsize<=self.maxsize: break
+            try: os.remove(path)
+            except OSError: continue
+            totalsize -= size
+
+    def clear( self ):
+        ### remove all entries from the cache
+        for (path,_,_) in self.get_entries():
+            try: os.remove(path)
+            except OSError: continue
+
+
+
+
+
+
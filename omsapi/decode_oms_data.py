@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# **Conversion of OMS responses to numpy arrays or pandas dataframes**  
+# 
+# OMS responses are json-like dictionaries with one entry per row, each with a dictionary of attributes.  
+# For large queries (e.g. per-lumisection information over many runs), looping over these rows in python for each attribute is slow.  
+# The functions in this script convert one or more responses (e.g. the different pages of a query) without creating intermediate objects per row,  
+# and only for the requested attributes, into one typed numpy array per attribute or into a pandas dataframe.  
+# 
+# Used by get_oms_data.py (get_oms_data_all and get_oms_response_columns) and by the omsinterface tools (omstools.get_resource_columns).
+
+
+
+### imports
+
+# external modules
+import os
+import sys
+from operator import itemgetter
+import numpy as np
+import pandas as pd
+
+# local modules
+sys.path.append(os.path.abspath('../utils/notebook_utils'))
+
+
+
+
+def get_column_array( values ):
+    ### convert a sequence of json values (all for the same attribute) to a typed numpy array
+    # input arguments:
+    # - values: list or tuple of values as they appear in the json response
+    # returns:
+    # - a numpy array with the following type:
+    #   - bool if all values are booleans
+    #   - int64 if all values are integers
+    #   - float64 if all values are numbers and/or None (None is converted to nan)
+    #   - object in all other cases (e.g. strings or nested dicts)
+
+    types = set(map(type, values))
+    if len(types)==0: return np.zeros(0)
+    if types=={bool}: return np.array(values, dtype=bool)
+    if types=={int}: return np.array(values, dtype=np.int64)
+    if types <= {int, float, type(None)}: return np.array(values, dtype=float)
+    res = np.empty(len(values), dtype=object)
+    res[:] = values
+    return res
+
+
+
+
+def decode_oms_responses( omsresponses, attributes=[], dataframe=False ):
+    ### convert one or more json-like OMS responses to a dict of typed numpy arrays or a pandas dataframe
+    # input arguments:
+    # - omsresponses: a json-like OMS response (dict with a 'data' entry), or a list of them (e.g. different pages)
+    # - attributes: list of attribute names to convert (default: all attributes of the first row)
+    #   nested fields can be accessed with a dot, e.g. 'l1a_physics.rate' for the 'rate' field of 'l1a_physics'
+    # - dataframe: if True, return a pandas dataframe with one column per attribute instead of a dict
+    # returns:
+    # - a dict matching attribute names to 1D numpy arrays (see get_column_array for the types),
+    #   or a pandas dataframe with the same columns.
+    # notes:
+    # - the requested attributes are extracted from the rows without creating intermediate objects per row,
+    #   other attributes in the response are ignored.
+    # - to reduce the size of the responses themselves, also restrict the attributes in the query
+    #   (e.g. attributes argument of get_oms_data).
+
+    if isinstance(omsresponses, dict): omsresponses = [omsresponses]
+    # determine which top-level attributes are needed
+    if len(attributes)==0:
+        attributes = []
+        for omsresponse in omsresponses:
+            if len(omsresponse['data'])>0:
+                attributes = list(omsresponse['data'][0]['attributes'].keys())
+                break
+    fields = [attribute.split('.') for attribute in attributes]
+    toplevel = list(dict.fromkeys([field[0] for field in fields]))
+    # extract the values of all needed attributes
+    # (a separate map over the rows for each attribute avoids creating any intermediate per-row objects)
+    columns = {key: [] for key in toplevel}
+    for omsresponse in omsresponses:
+        rows = [row['attributes'] for row in omsresponse['data']]
+        for key in toplevel:
+            try: columns[key].extend( list(map(itemgetter(key), rows)) )
+            except KeyError:
+                # (some rows lack this attribute, fill with None)
+                columns[key].extend( [row.get(key) for row in rows] )
+    # make the arrays, retrieving nested fields if needed
+    res = {}
+    for attribute,field in zip(attributes,fields):
+        column = columns[field[0]]
+        for key in field[1:]:
+            column = [value.get(key) if isinstance(value,dict) else None for value in column]
+        res[attribute] = get_column_array( column )
+    if dataframe: return pd.DataFrame(res, columns=attributes)
+    return res
+
+
+
+
+
+
@@ -16,6 +16,11 @@
 # - The returned object is a complicated dictionary containing all information.  
 #   Simply print it to find out its exact structure and how to access exactly the values you need.  
 #   The function "get_oms_response_attribute" is a small helper function to retrieve a specific attribute from this dictionary.
+# - Note that "get_oms_data" returns only the first limit_entries entries.  
+#   Use "get_oms_data_all" to retrieve all entries (with concurrent requests for the different pages),
+#   returned as a dict of numpy arrays (one per attribute) instead of a json-like dictionary.
+# - Use "get_oms_data_per_lumisection" to retrieve per-lumisection information for many runs at once (with concurrent requests),
+#   aligned with a given list of run and lumisection numbers (e.g. those of a HistStruct, see also HistStruct.add_oms_data).
 #   
 # See the notebook example.ipynb in this directory for some examples!
 
@@ -26,9 +31,15 @@
 # external modules
 import sys
 import os
+import copy
+import math
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # local modules
 from omsapi import OMSAPI
+from decode_oms_data import decode_oms_responses
 from urls import API_URL, API_VERSION, API_AUDIENCE
 from clientid import API_CLIENT_ID, API_CLIENT_SECRET
 sys.path.append(os.path.abspath('../utils/notebook_utils'))
@@ -57,29 +68,15 @@ def get_oms_api():
 
 
 
-def get_oms_data( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, sort=None, attributes=[], limit_entries=1000):
-    ### query some data from OMS
-    # input arguments:
-    # - omsapi: an OMSAPI instance, e.g. created by get_oms_api()
-    # - api_endpoint: string, target information, e.g. 'runs' or 'lumisections'
-    #   (see the readme for a link where the available endpoints are listed)
-    # - runnb: run number(s) to retrieve the info for,
-    #   either integer (for single run) or tuple or list of two elements (first run and last run)
-    #   (can also be None to not filter on run number but this is not recommended)
-    # - extrafilters: list of extra filters (apart from run number),
-    #   each filter is supposed to be a dict of the form {'attribute_name':<name>,'value':<value>,'operator':<operator>}
-    #   where <name> must be a valid field name in the OMS data, <value> its value, and <operator> chosen from "EQ", "NEQ", "LT", "GT", "LE", "GE" or "LIKE"
-    # - extraargs: dict of custom key/value pairs to add to the query
-    #   (still experimental, potentially usable for changing the granularity from 'run' to 'lumisection' for e.g. L1 trigger rates, see example.ipynb)
-    # - sort: valid field name in the OMS data by which to sort
-    # - attributes: list of valid field names in the OMS data to return (if not specified, all information is returned)
-    # - limit_entries: entry limit for output json object
+def make_oms_query( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, sort=None, attributes=[]):
+    ### make an OMSQuery object (without executing it) based on the input parameters
+    # input arguments: see get_oms_data (except limit_entries, as no pagination is set)
     
     filters = []
     
     # check omsapi argument
     if not isinstance(omsapi,OMSAPI):
-        raise Exception('ERROR in get_oms_data.py/get_oms_data:'
+        raise Exception('ERROR in get_oms_data.py/make_oms_query:'
                        +' first argument is of type '+str(type(omsapi))+' while and OMSAPI object is expected.'
                        +' You can use get_oms_api() to create this object.')
     # check runnb argument
@@ -91,7 +88,7 @@ def get_oms_data( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, so
         filters.append({attribute_name:'run_number',value:str(runnb[0]),operator:'GE'})
         filters.append({attribute_name:'run_number',value:str(runnb[1]),operator:'LE'})
     else:
-        print('WARNING in get_oms_data.py/get_oms_data:'
+        print('WARNING in get_oms_data.py/make_oms_query:'
              +' run number {} not recognized'.format(runnb)
              +' (supposed to be an int, a tuple or list of 2 elements, or None).')
     # check extrafilters argument
@@ -99,7 +96,7 @@ def get_oms_data( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, so
     for extrafilter in extrafilters:
         keys = sorted(extrafilter.keys())
         if not keys==expected_keys:
-            print('WARNING in get_oms_data.py/get_oms_data:'
+            print('WARNING in get_oms_data.py/make_oms_query:'
                  +' filter {} contains unexpected keys'.format(extrafilter)
                  +' (expecting only {}).'.format(expected_keys)
                  +' The filter will be added but the query might fail...')
@@ -110,6 +107,31 @@ def get_oms_data( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, so
     if sort is not None: q.sort(sort)
     if len(attributes) is not None: q.attrs(attributes)
     for key,val in extraargs.items(): q.custom(key,value=val)
+    return q
+
+
+
+
+def get_oms_data( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, sort=None, attributes=[], limit_entries=1000):
+    ### query some data from OMS
+    # input arguments:
+    # - omsapi: an OMSAPI instance, e.g. created by get_oms_api()
+    # - api_endpoint: string, target information, e.g. 'runs' or 'lumisections'
+    #   (see the readme for a link where the available endpoints are listed)
+    # - runnb: run number(s) to retrieve the info for,
+    #   either integer (for single run) or tuple or list of two elements (first run and last run)
+    #   (can also be None to not filter on run number but this is not recommended)
+    # - extrafilters: list of extra filters (apart from run number),
+    #   each filter is supposed to be a dict of the form {'attribute_name':<name>,'value':<value>,'operator':<operator>}
+    #   where <name> must be a valid field name in the OMS data, <value> its value, and <operator> chosen from "EQ", "NEQ", "LT", "GT", "LE", "GE" or "LIKE"
+    # - extraargs: dict of custom key/value pairs to add to the query
+    #   (still experimental, potentially usable for changing the granularity from 'run' to 'lumisection' for e.g. L1 trigger rates, see example.ipynb)
+    # - sort: valid field name in the OMS data by which to sort
+    # - attributes: list of valid field names in the OMS data to return (if not specified, all information is returned)
+    # - limit_entries: entry limit for output json object
+    
+    q = make_oms_query( omsapi, api_endpoint, runnb, extrafilters=extrafilters, extraargs=extraargs, 
+                        sort=sort, attributes=attributes )
     q.paginate(1, limit_entries)
     print(q.data_query())
     response = q.data()
@@ -118,15 +140,186 @@ def get_oms_data( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, so
 
 
 
+def _get_oms_data_page( q, page, page_size ):
+    ### execute a copy of a query for a given page and return the json-like response
+    # (a copy is made so that the same query can be used for different pages concurrently)
+    q = copy.copy(q)
+    q.paginate(page, page_size)
+    response = q.data()
+    if response.status_code != 200:
+        raise Exception('ERROR in get_oms_data.py/_get_oms_data_page:'
+                       +' request for page {} failed with status code {}.'.format(page, response.status_code))
+    return response.json()
+
+
+def iterate_oms_data( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, sort=None, attributes=[], 
+                      page_size=1000, nthreads=8 ):
+    ### query all data from OMS, yielding the pages as they arrive
+    # input arguments: see get_oms_data, and in addition:
+    # - page_size: number of entries per request
+    # - nthreads: maximum number of pages that are requested concurrently
+    # yields:
+    # - tuples of the form (page number, json-like response for that page),
+    #   in order of arrival (i.e. not necessarily in page order!)
+    # note: the first page is requested first to find the total number of entries,
+    #       the remaining pages are then requested concurrently.
+    #       if the total number of entries is not available in the response metadata,
+    #       pages are requested one by one until an incomplete page is returned.
+    
+    q = make_oms_query( omsapi, api_endpoint, runnb, extrafilters=extrafilters, extraargs=extraargs, 
+                        sort=sort, attributes=attributes )
+    response = _get_oms_data_page( q, 1, page_size )
+    yield (1, response)
+    try: npages = math.ceil( response['meta']['totalResourceCount'] / page_size )
+    except (KeyError, TypeError):
+        page = 1
+        while len(response['data'])==page_size:
+            page += 1
+            response = _get_oms_data_page( q, page, page_size )
+            yield (page, response)
+        return
+    if npages<=1: return
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+        futures = {executor.submit(_get_oms_data_page, q, page, page_size): page for page in range(2, npages+1)}
+        try:
+            for future in as_completed(futures):
+                yield (futures[future], future.result())
+        finally:
+            # make sure no more requests are sent if the iteration is stopped early
+            for future in futures: future.cancel()
+
+
+def get_oms_data_all( omsapi, api_endpoint, runnb, extrafilters=[], extraargs={}, sort=None, attributes=[], 
+                      page_size=1000, nthreads=8, callback=None, dataframe=False ):
+    ### query all data from OMS (i.e. without truncating at a fixed number of entries)
+    # input arguments: see get_oms_data and iterate_oms_data, and in addition:
+    # - callback: function called with arguments (page number, json-like response for that page)
+    #   as soon as each page arrives (e.g. for printing progress or for processing data on the fly)
+    # - dataframe: if True, return a pandas dataframe instead of a dict of numpy arrays
+    # returns:
+    # - a dict matching attribute names to numpy arrays with the values of that attribute for all entries,
+    #   in the order of the OMS response (i.e. the pages are put back in order).
+    #   see get_oms_response_columns for the conversion.
+    
+    pages = {}
+    for page, response in iterate_oms_data( omsapi, api_endpoint, runnb, extrafilters=extrafilters, 
+                                            extraargs=extraargs, sort=sort, attributes=attributes, 
+                                            page_size=page_size, nthreads=nthreads ):
+        if callback is not None: callback(page, response)
+        pages[page] = response
+    return get_oms_response_columns( [pages[page] for page in sorted(pages.keys())], attributes=attributes, dataframe=dataframe )
+
+
+
+
+def _run_async( coroutine ):
+    ### run a coroutine until completion and return its result
+    # note: if an event loop is already running (e.g. in a jupyter notebook),
+    #       the coroutine is run in a new event loop in a separate thread.
+    try: asyncio.get_running_loop()
+    except RuntimeError: return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def _get_oms_data_runs( omsapi, api_endpoint, runnbs, attributes=[], page_size=5000, maxconcurrent=8 ):
+    ### retrieve all data for each run in a list of runs, with at most maxconcurrent runs being retrieved at the same time
+    # returns a list with the output of get_oms_data_all for each run (in the same order as runnbs)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(maxconcurrent)
+    executor = ThreadPoolExecutor(max_workers=maxconcurrent)
+    async def get_run( runnb ):
+        async with semaphore:
+            return await loop.run_in_executor( executor, lambda: get_oms_data_all( omsapi, api_endpoint, int(runnb), 
+                                                   attributes=attributes, page_size=page_size, nthreads=1 ) )
+    try: return await asyncio.gather( *[get_run(runnb) for runnb in runnbs] )
+    finally: executor.shutdown()
+
+
+def get_oms_data_per_lumisection( omsapi, runnbs, lsnbs, attributes, api_endpoint='lumisections', lsattribute='lumisection_number',
+                                  page_size=5000, maxconcurrent=8 ):
+    ### query per-lumisection data from OMS for many lumisections at once
+    # input arguments:
+    # - omsapi: an OMSAPI instance, e.g. created by get_oms_api()
+    # - runnbs: 1D numpy array of run numbers
+    # - lsnbs: 1D numpy array of lumisection numbers (same length as runnbs)
+    # - attributes: list of valid field names in the OMS data to retrieve
+    # - api_endpoint: endpoint with per-lumisection information
+    # - lsattribute: field name in the OMS data that holds the lumisection number
+    # - page_size: number of entries per request
+    # - maxconcurrent: maximum number of runs that are retrieved concurrently
+    # returns:
+    # - a dict matching attribute names to 1D numpy arrays with the same length as runnbs and lsnbs,
+    #   where element i holds the value for run runnbs[i] and lumisection lsnbs[i].
+    #   numerical (and boolean) attributes are returned as floats, with nan for lumisections that were not found in OMS,
+    #   other attributes are returned as object arrays, with None for lumisections that were not found in OMS.
+    # note: all lumisections of each run are retrieved with a single query (or a few if there are more than page_size),
+    #       and joined to the input arrays in a vectorized way.
+    
+    runnbs = np.asarray(runnbs).astype(np.int64)
+    lsnbs = np.asarray(lsnbs).astype(np.int64)
+    if len(runnbs)!=len(lsnbs):
+        raise Exception('ERROR in get_oms_data.py/get_oms_data_per_lumisection:'
+                       +' runnbs and lsnbs have different lengths ({} and {}).'.format(len(runnbs),len(lsnbs)))
+    queryattributes = list(attributes)
+    if lsattribute not in queryattributes: queryattributes.append(lsattribute)
+    uniqueruns = np.unique(runnbs)
+    runcolumns = _run_async( _get_oms_data_runs( omsapi, api_endpoint, uniqueruns, attributes=queryattributes,
+                                                 page_size=page_size, maxconcurrent=maxconcurrent ) )
+    # concatenate the results for all runs and make a sortable key for each (run, lumisection) pair
+    omsruns = np.concatenate([np.full(len(columns.get(lsattribute,[])), runnb, dtype=np.int64)
+                              for runnb,columns in zip(uniqueruns,runcolumns)]+[np.zeros(0,dtype=np.int64)])
+    omscolumns = {}
+    for attribute in queryattributes:
+        omscolumns[attribute] = np.concatenate([columns[attribute] for columns in runcolumns if attribute in columns]
+                                               +[np.zeros(0)])
+    omskeys = (omsruns<<32) + omscolumns[lsattribute].astype(np.int64)
+    keys = (runnbs<<32) + lsnbs
+    # find for each input lumisection the matching OMS entry
+    order = np.argsort(omskeys, kind='stable')
+    sortedkeys = omskeys[order]
+    pos = np.minimum( np.searchsorted(sortedkeys, keys), max(len(sortedkeys)-1,0) )
+    found = (sortedkeys[pos]==keys) if len(sortedkeys)>0 else np.zeros(len(keys),dtype=bool)
+    index = order[pos] if len(sortedkeys)>0 else pos
+    nmissing = np.sum(~found)
+    if nmissing>0:
+        print('WARNING in get_oms_data.py/get_oms_data_per_lumisection:'
+             +' {} out of {} lumisections were not found in OMS.'.format(nmissing,len(keys)))
+    res = {}
+    for attribute in attributes:
+        column = omscolumns[attribute]
+        try: column = column.astype(float)
+        except (ValueError,TypeError): column = column.astype(object)
+        values = column[index] if len(column)>0 else np.zeros(len(keys),dtype=column.dtype)
+        values[~found] = np.nan if values.dtype==float else None
+        res[attribute] = values
+    return res
+
+
+
+
 def get_oms_response_attribute( omsresponse, attribute ):
     ### small helper function to retrieve a list of values for a single attribute
     # input arguments:
     # - omsresponse: the json-like object returned by get_oms_data
     # - attribute: name of one of the attributes present in omsresponse
+    # note: to retrieve multiple attributes as numpy arrays, get_oms_response_columns is much faster.
     
     return [omsresponse['data'][i]['attributes'][attribute] for i in range(len(omsresponse['data']))]
 
 
+def get_oms_response_columns( omsresponses, attributes=[], dataframe=False ):
+    ### convert one or more json-like OMS responses to a dict of numpy arrays (one per attribute)
+    # input arguments:
+    # - omsresponses: a json-like object returned by get_oms_data, or a list of them (e.g. different pages)
+    # - attributes: list of attribute names to convert (default: all attributes of the first entry),
+    #   nested fields can be accessed with a dot, e.g. 'l1a_physics.rate'
+    # - dataframe: if True, return a pandas dataframe instead of a dict of numpy arrays
+    # note: see decode_oms_data.py for more details, e.g. on the types of the arrays.
+    
+    return decode_oms_responses( omsresponses, attributes=attributes, dataframe=dataframe )
+
+
 
 
 
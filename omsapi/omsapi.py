@@ -5,9 +5,14 @@
 from __future__ import print_function
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import subprocess
 import json
 import time
+import random
+import threading
+
+from ResponseCache import ResponseCache
 
 # Suppress InsecureRequestWarning
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -23,6 +28,37 @@ cern_auth_token_url='https://auth.cern.ch/auth/realms/cern/protocol/openid-conne
 grant_type='client_credentials'
 exc_token_type='access_token'
 
+#Retry parameters
+retry_max_sec = 300  # Upper limit on the delay between two retries
+token_refresh_margin_sec = 60  # Renew the token this long before it expires (at most a quarter of its lifetime)
+
+
+def retry_with_backoff(func, err_sec, what="request", max_retries=None):
+    """ Call func, retrying after connection errors with exponential backoff
+
+        Args:
+            func (callable): function without arguments to call
+            err_sec (float): delay before the first retry in seconds (no retries if 0)
+            what (str): description of func for the warning messages
+            max_retries (int): maximum number of retries (None for no limit)
+
+        The delay is doubled after each failed attempt (up to retry_max_sec),
+        with a random jitter so that concurrent workers do not retry in lockstep.
+    """
+
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except ConnectionError as ex:
+            if err_sec <= 0 or (max_retries is not None and attempt >= max_retries):
+                raise
+            delay = min(err_sec * 2 ** attempt, retry_max_sec)
+            delay *= random.uniform(0.5, 1.0)
+            print("Warning: will retry " + what + " in " + "{:.1f}".format(delay) + " seconds after connection error: " + str(ex))
+            time.sleep(delay)
+            attempt += 1
+
 class OMSApiException(Exception):
     """ OMS API Client Exception """
     pass
@@ -31,7 +67,8 @@ class OMSApiException(Exception):
 class OMSQuery(object):
     """ OMS Query object """
 
-    def __init__(self, base_url, resource, verbose, cookies, oms_auth, cert_verify, retry_on_err_sec, proxies):
+    def __init__(self, base_url, resource, verbose, cookies, oms_auth, cert_verify, retry_on_err_sec, proxies,
+                 session=None, meta_cache=None, response_cache=None):
         self.attribute_validation = True
         self.base_url = base_url
         self.resource = resource
@@ -41,6 +78,9 @@ class OMSQuery(object):
         self.cert_verify = cert_verify
         self.err_sec = retry_on_err_sec
         self.proxies = proxies
+        self.session = session  # Shared requests.Session (module-level requests if None)
+        self.meta_cache = meta_cache  # Shared dict of resource metadata (no caching if None)
+        self.response_cache = response_cache  # Shared ResponseCache (no caching if None)
 
         self._attrs = None  # Projection
         self._filter = []  # Filtering
@@ -79,9 +119,18 @@ class OMSQuery(object):
         """ Load meta information about resource without fetching data"""
 
         resourceBase = self.resource.split("/")[0]
+        if self.meta_cache is not None and resourceBase in self.meta_cache:
+            self.metadata = self.meta_cache[resourceBase]
+            return
+
         url = "{base_url}/{resource}/meta".format(base_url=self.base_url,
                                                   resource=resourceBase)
 
+        if self.response_cache is not None and self.response_cache.offline:
+            if self.response_cache.get(url) is None:
+                self._warn("Meta information is not available in offline mode")
+                return
+
         response = self.get_request(url, verify=self.cert_verify)
 
         if response.status_code != 200:
@@ -89,6 +138,8 @@ class OMSQuery(object):
         else:
             try:
                 self.metadata = response.json()["meta"]["fields"]
+                if self.meta_cache is not None:
+                    self.meta_cache[resourceBase] = self.metadata
             except (ValueError, KeyError, TypeError):
                 self._warn("Meta information is incorrect")
 
@@ -145,7 +196,7 @@ class OMSQuery(object):
             self._warn("attrs() - attributes must be a list", raise_exc=True)
 
         # Find only existing attributes, remove duplicates
-        self._attrs = [attr for attr in set(
+        self._attrs = [attr for attr in dict.fromkeys(
             attributes) if self._attr_exists(attr)]
 
         return self
@@ -301,18 +352,18 @@ class OMSQuery(object):
 
         # Project
         if self._attrs:
-            url_params.append("fields=" + ",".join(set(self._attrs)))
+            url_params.append("fields=" + ",".join(dict.fromkeys(self._attrs)))
 
         # Filter
         url_params.extend(self._filter)
 
         # Sort
         if self._sort:
-            url_params.append("sort=" + ",".join(set(self._sort)))
+            url_params.append("sort=" + ",".join(dict.fromkeys(self._sort)))
 
         # Include
         if self._include:
-            url_params.append("include=" + ",".join(set(self._include)))
+            url_params.append("include=" + ",".join(dict.fromkeys(self._include)))
 
         # Paginate
         page_offset = self.per_page * (self.page - 1)
@@ -340,18 +391,8 @@ class OMSQuery(object):
 
         if self.verbose:
             print(url)
-        if self.err_sec > 0:
-            while True:
-                try:
-                    ret = self.get_request(url, verify=self.cert_verify)
-                    break
-                except ConnectionError as ex:
-                    print("Warning: will retry in " + str(self.err_sec) + "seconds after connection error: " + str(ex))
-                    time.sleep(self.err_sec)
-        else:
-            ret = self.get_request(url, verify=self.cert_verify)
 
-        return ret
+        return retry_with_backoff(lambda: self.get_request(url, verify=self.cert_verify), self.err_sec)
 
     def meta(self):
         """ Returns metadata of a resource.
@@ -363,16 +404,25 @@ class OMSQuery(object):
         return self.metadata
 
     def get_request(self, url, verify=False):
+        if self.response_cache is not None:
+            return self.response_cache.fetch(url, lambda: self._get_request(url, verify=verify))
+        return self._get_request(url, verify=verify)
+
+    def _get_request(self, url, verify=False):
+        http = self.session if self.session is not None else requests
         if self.oms_auth:
-            response = requests.get(url, verify=verify, headers=self.oms_auth.token_headers, proxies=self.proxies)
-            #check if token has expired (Unauthorized)
+            #the token is renewed proactively if it is about to expire
+            headers = self.oms_auth.get_token_headers()
+            response = http.get(url, verify=verify, headers=headers, proxies=self.proxies)
+            #check if token has expired anyway (Unauthorized)
             if response.status_code == 401:
                 print("Unauthorized. Will try to obtain a new token")
-                self.oms_auth.auth_oidc()
-                return requests.get(url, verify=verify, headers=self.oms_auth.token_headers, proxies=self.proxies)
+                #(only renewed if no other worker did so in the meantime)
+                headers = self.oms_auth.renew_token(headers)
+                return http.get(url, verify=verify, headers=headers, proxies=self.proxies)
             return response
         else:
-            return requests.get(url, verify=verify, cookies=self.cookies, proxies=self.proxies)
+            return http.get(url, verify=verify, cookies=self.cookies, proxies=self.proxies)
  
 class OMSAPIOAuth(object):
     """ OMS API token store and manager """
@@ -385,30 +435,59 @@ class OMSAPIOAuth(object):
         self.proxies = proxies
         self.token_json = None
         self.token_time = None
+        self.token_expiry = None
+        self.token_headers = None
         self.err_sec = retry_on_err_sec
+        # Serializes token renewals between concurrent queries
+        self.lock = threading.Lock()
  
     def auth_oidc(self):
         """ Authorisation Using CERN Open ID authentication wrappeer"""
-        if self.err_sec > 0:
-            while True:
-                try:
-                    ret = self.auth_oidc_req()
-                    return ret
-                except ConnectionError as ex:
-                    print("Warning: will retry auth_oidc in " + str(self.err_sec) + "seconds after connection error: " + str(ex))
-                    time.sleep(self.err_sec)
-        else:
-            return self.auth_oidc_req()
+        with self.lock:
+            return retry_with_backoff(self.auth_oidc_req, self.err_sec, what="auth_oidc")
+
+    def token_is_valid(self):
+        """ Check if a token is available and will not expire within the refresh margin """
+
+        if not self.token_json:
+            return False
+        if self.token_expiry is None:
+            return True
+        margin = min(token_refresh_margin_sec, 0.25 * (self.token_expiry - self.token_time))
+        return time.time() < self.token_expiry - margin
+
+    def get_token_headers(self):
+        """ Get the authorization headers, renewing the token first if it is about to expire
+
+            Thread-safe: if several workers find that the token is about to expire,
+            only the first one renews it and the others wait for and use the new token.
+        """
+
+        if not self.token_is_valid():
+            with self.lock:
+                if not self.token_is_valid():
+                    retry_with_backoff(self.auth_oidc_req, self.err_sec, what="auth_oidc")
+        return self.token_headers
+
+    def renew_token(self, rejected_headers):
+        """ Renew the token after a request with the given headers was rejected (Unauthorized)
+
+            The token is only renewed if it was not renewed by another worker since the rejected request,
+            which avoids duplicate token exchanges when many concurrent requests fail at the same time.
+
+            Returns:
+                dict: the new authorization headers
+        """
+
+        with self.lock:
+            if self.token_headers == rejected_headers:
+                retry_with_backoff(self.auth_oidc_req, self.err_sec, what="auth_oidc")
+            return self.token_headers
 
     def auth_oidc_req(self):
         """ Authorisation Using CERN Open ID authentication """
 
         current_time = time.time()
-        if self.token_json and self.token_time:
-            if current_time - self.token_time < 30:
-                print("Warning: token was requested less than 30 seconds ago. Will not renew this time.")
-                return
-                
         self.token_time = current_time
         token_req_data = {
             'grant_type': grant_type,
@@ -437,12 +516,16 @@ class OMSAPIOAuth(object):
 
         self.token_json = json.loads(ret.content)
         self.token_headers = {'Authorization':'Bearer ' + self.token_json["access_token"]}
+        # Track the expiry time, measured from before the token request to be on the safe side
+        expires_in = self.token_json.get("expires_in")
+        self.token_expiry = current_time + float(expires_in) if expires_in is not None else None
 
  
 class OMSAPI(object):
     """ Base OMS API client """
 
-    def __init__(self, api_url="https://cmsoms.cern.ch/agg/api", api_version="v1", verbose=True, cert_verify=True, retry_on_err_sec=0, proxies={}):
+    def __init__(self, api_url="https://cmsoms.cern.ch/agg/api", api_version="v1", verbose=True, cert_verify=True, retry_on_err_sec=0, proxies={},
+                 pool_size=10):
         self.api_url = api_url
         self.api_version = api_version
         self.verbose = verbose
@@ -462,14 +545,58 @@ class OMSAPI(object):
         self.oms_auth = None
         self.cookies = {}
 
+        # Connection pool shared by all queries (keep-alive avoids a new TCP+TLS handshake per request)
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Resource metadata, fetched once per resource for the lifetime of the client
+        self.meta_cache = {}
+
+        # Persistent cache of responses on disk (see set_response_cache)
+        self.response_cache = None
+
     def query(self, resource, query_validation=True):
         """ Create query object """
 
         q = OMSQuery(self.base_url, resource=resource, verbose=self.verbose,
-                     cookies=self.cookies, oms_auth=self.oms_auth, cert_verify=self.cert_verify, retry_on_err_sec=self.err_sec, proxies=self.proxies)
+                     cookies=self.cookies, oms_auth=self.oms_auth, cert_verify=self.cert_verify, retry_on_err_sec=self.err_sec, proxies=self.proxies,
+                     session=self.session, meta_cache=self.meta_cache, response_cache=self.response_cache)
 
         return q
 
+    def set_response_cache(self, cachedir, maxsize=1e9, ttls=None, finalrun=None, offline=False):
+        """ Store responses on disk and reuse them for identical queries (see ResponseCache)
+
+            Args:
+                cachedir (str): directory where to store the responses, None to stop using a response cache
+                maxsize (float): maximum total size of the cache in bytes
+                ttls (dict): time-to-live in seconds per endpoint (None for no expiry)
+                finalrun (int): last finished run, responses for runs up to this number never expire
+                offline (bool): only use the cache, raise an error for queries that are not in the cache
+
+            Examples:
+                .set_response_cache("omscache", finalrun=325175)
+                .set_response_cache("omscache", offline=True)
+        """
+
+        if cachedir is None:
+            self.response_cache = None
+        else:
+            self.response_cache = ResponseCache(cachedir, maxsize=maxsize, ttls=ttls, finalrun=finalrun, offline=offline)
+
+    def clear_meta_cache(self):
+        """ Forget cached resource metadata (e.g. after a change of the API) """
+
+        self.meta_cache.clear()
+
+    def close(self):
+        """ Close all pooled connections """
+
+        self.session.close()
+
     def auth_oidc(self, client_id, client_secret, audience="cmsoms-prod", proxies={}):
         """ Authorisation Using CERN Open ID authentication """
 
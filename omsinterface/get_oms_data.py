@@ -48,6 +48,9 @@ def get_oms_data( mode, run, hltpathname='', authmode='login' ):
     # returns:
     # - a list or dict (depending on the specifications) containing all information.
     #   simply print it to see how to access the exact values you need.
+    #   note: in case mode is 'hltrates', a dict is returned with the path names,
+    #   the lumisection numbers and a numpy array of rates (one row per path, one column per lumisection),
+    #   see omstools.get_all_hltpathrates.
 
     # parse arguments
     
@@ -17,9 +17,14 @@
 import sys
 import os
 import math
+import threading
+import numpy as np
 import requests
 import importlib
 from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # local modules
@@ -27,12 +32,18 @@ from urls import * # url paths and related settings (e.g. timeout time)
 import connectiontools
 importlib.reload(connectiontools)
 from connectiontools import check_connectivity, get_cookies
+sys.path.append(os.path.abspath('../omsapi'))
+from ResponseCache import ResponseCache
+from decode_oms_data import decode_oms_responses
 sys.path.append(os.path.abspath('../utils/notebook_utils'))
 
 
 
 
 def check_oms_connectivity():
+    if _response_cache is not None and _response_cache.offline:
+        # no connection is made in offline mode, and no authentication is needed
+        return True
     return check_connectivity(OMS_API_URL)
 
 
@@ -46,31 +57,87 @@ def get_oms_cookies( authmode, **kwargs ):
 
 
 PAGE_SIZE = 1000
+NTHREADS = 8 # maximum number of pages that are requested concurrently
+MAX_RETRIES = 3 # number of retries for failed connections or server errors
+BACKOFF_FACTOR = 0.5 # retries are spaced by BACKOFF_FACTOR * 2**(retry number) seconds
+
+_session = None
+_session_lock = threading.Lock()
+_response_cache = None
+
+def get_session(pool_size=NTHREADS):
+    ### get the requests.Session shared by all requests in this module
+    # the session keeps connections alive between requests (avoiding a new handshake per page)
+    # and retries failed requests with exponential backoff.
+    # its connection pool is enlarged if it is too small for pool_size concurrent requests.
+    global _session
+    with _session_lock:
+        if _session is None or _session.pool_size < pool_size:
+            session = requests.Session()
+            retry = Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                          status_forcelist=(429, 500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.pool_size = pool_size
+            _session = session
+        return _session
+
+
+def set_response_cache(cachedir, maxsize=1e9, ttls=None, finalrun=None, offline=False):
+    ### store responses on disk and reuse them for identical queries
+    # input arguments:
+    # - cachedir: directory where to store the responses (see ResponseCache), use None to stop using a response cache
+    # - maxsize: maximum total size of the cache in bytes (default: 1 GB)
+    # - ttls: dict matching endpoint names to a time-to-live in seconds (see ResponseCache)
+    # - finalrun: last run number that is known to be finished, responses for runs up to this number never expire
+    # - offline: if True, only the cache is used, and queries that are not in the cache raise an error
+    global _response_cache
+    if cachedir is None: _response_cache = None
+    else: _response_cache = ResponseCache(cachedir, maxsize=maxsize, ttls=ttls, finalrun=finalrun, offline=offline)
+
+
+def _get(url, **kwargs):
+    # get a url using the shared session, or from the response cache if it is set
+    def request():
+        response = get_session().get(url, **kwargs)
+        response.raise_for_status()
+        return response
+    if _response_cache is not None:
+        return _response_cache.fetch(url, request)
+    return request()
+
 
 def _get_oms_resource_within_cern_gpn(relative_url):
     url = "{}{}".format(OMS_API_URL, relative_url)
-    return requests.get(url)
+    return _get(url)
 
 
 def _get_oms_resource_authenticated(relative_url, cookies):
     url = "{}{}".format(OMS_ALTERNATIVE_API_URL, relative_url)
-    return requests.get(url, cookies=cookies, verify=False)
+    return _get(url, cookies=cookies, verify=False)
 
 
 def get_oms_resource(table, parameters, **kwargs):
+    # note: if the keyword arguments inside_cern_gpn and/or cookies are provided,
+    #       they are used instead of checking the connectivity and obtaining new cookies for each request.
     parameters = urlencode(parameters)
     relative_url = "{table}?{parameters}".format(table=table, parameters=parameters)
-    print('relative url: '+str(relative_url))
+    if not kwargs.pop('silent', False):
+        print('relative url: '+str(relative_url))
     
-    inside_cern_gpn = check_oms_connectivity()
+    inside_cern_gpn = kwargs.pop('inside_cern_gpn', None)
+    if inside_cern_gpn is None: inside_cern_gpn = check_oms_connectivity()
     if inside_cern_gpn:  # Within CERN GPN
         response = _get_oms_resource_within_cern_gpn(relative_url)
     else:  # Outside CERN GPN, requires authentication
-        if not 'authmode' in kwargs.keys():
-            raise Exception('ERROR in omstools.py/get_oms_resource: '
-                           +'need authentication parameters')
-        authmode = kwargs.pop('authmode')
-        cookies = get_oms_cookies( authmode, verify=False, **kwargs )
+        cookies = kwargs.pop('cookies', None)
+        if cookies is None:
+            if not 'authmode' in kwargs.keys():
+                raise Exception('ERROR in omstools.py/get_oms_resource: '
+                               +'need authentication parameters')
+            authmode = kwargs.pop('authmode')
+            cookies = get_oms_cookies( authmode, verify=False, **kwargs )
         response = _get_oms_resource_authenticated(relative_url, cookies)
         
     return response.json()
@@ -98,21 +165,36 @@ def _get_resources_page(table, parameters, page, page_size, **kwargs):
     assert page >= 1, "Page number cant be lower than 1"
     params = {"page[offset]": (page - 1) * page_size, "page[limit]": page_size}
     params.update(parameters)
-    
-    oms_resource = get_oms_resource(table, params, **kwargs)
 
     return get_oms_resource(table, params, **kwargs)
 
 
-def get_resources(table, parameters, page_size=PAGE_SIZE, silent=False, **kwargs):
+def _get_authentication(kwargs):
+    # check the connectivity and obtain cookies (if needed) only once for a series of requests
     if "inside_cern_gpn" not in kwargs:
         kwargs['inside_cern_gpn'] = check_oms_connectivity()
+    if not kwargs['inside_cern_gpn'] and 'cookies' not in kwargs:
+        if not 'authmode' in kwargs.keys():
+            raise Exception('ERROR in omstools.py/get_resources: '
+                           +'need authentication parameters')
+        authkwargs = {key: val for key, val in kwargs.items() if key!='inside_cern_gpn'}
+        authmode = authkwargs.pop('authmode')
+        kwargs['cookies'] = get_oms_cookies( authmode, verify=False, **authkwargs )
+    return kwargs
+
+
+def _get_resources_pages(table, parameters, page_size=PAGE_SIZE, silent=False, nthreads=NTHREADS, **kwargs):
+    # note: the first page is retrieved to find the total number of resources,
+    #       the remaining pages are retrieved concurrently using at most nthreads threads
+    #       (each page is requested exactly once, and the output is in page order).
+    kwargs = _get_authentication(kwargs)
+    get_session(pool_size=max(1, nthreads))
 
     if not silent:
         print("Getting initial response...", end="\r")
 
     response = _get_resources_page(
-        table, parameters, page=1, page_size=page_size, **kwargs
+        table, parameters, page=1, page_size=page_size, silent=silent, **kwargs
     )
     
     resource_count = response["meta"]["totalResourceCount"]
@@ -123,20 +205,41 @@ def get_resources(table, parameters, page_size=PAGE_SIZE, silent=False, **kwargs
         print("Total number of {}: {}".format(table, resource_count))
         print()
 
-    resources = [flatten_resource(resource) for resource in response["data"]]
+    responses = [response]
 
-    for page in range(2, page_count + 1):
-        if not silent:
-            print_progress(page, page_count, text="Page {}/{}".format(page, page_count))
-        response = _get_resources_page(table, parameters, page, page_size, **kwargs)
-        resources.extend([flatten_resource(resource) for resource in response["data"]])
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+        futures = [executor.submit(_get_resources_page, table, parameters, page, page_size,
+                                   silent=True, **kwargs)
+                   for page in range(2, page_count + 1)]
+        for page, future in enumerate(futures, 2):
+            responses.append(future.result())
+            if not silent:
+                print_progress(page, page_count, text="Page {}/{}".format(page, page_count))
 
     if not silent:
         print()
         print()
 
-    assert len(resources) == resource_count, "Oops, not enough resources were returned"
-    return resources
+    assert sum(len(response["data"]) for response in responses) == resource_count, "Oops, not enough resources were returned"
+    return responses
+
+
+def get_resources(table, parameters, page_size=PAGE_SIZE, silent=False, nthreads=NTHREADS, **kwargs):
+    responses = _get_resources_pages(table, parameters, page_size=page_size, silent=silent, nthreads=nthreads, **kwargs)
+    return [flatten_resource(resource) for response in responses for resource in response["data"]]
+
+
+def get_resource_columns(table, parameters, attributes=[], dataframe=False, page_size=PAGE_SIZE, silent=False, nthreads=NTHREADS, **kwargs):
+    # note: same as get_resources, but instead of a list of flattened dicts (one per resource),
+    #       a dict of numpy arrays (one per attribute) or a pandas dataframe is returned
+    #       (see omsapi/decode_oms_data.py for details).
+    #       only the requested attributes are queried (all if attributes is empty),
+    #       nested fields can be accessed with a dot, e.g. 'l1a_physics.rate'.
+    parameters = dict(parameters)
+    if len(attributes) > 0:
+        parameters["fields"] = ",".join(dict.fromkeys(attribute.split(".")[0] for attribute in attributes))
+    responses = _get_resources_pages(table, parameters, page_size=page_size, silent=silent, nthreads=nthreads, **kwargs)
+    return decode_oms_responses(responses, attributes=attributes, dataframe=dataframe)
 
 
 def get_runs(begin, end, **kwargs):
@@ -180,8 +283,7 @@ def get_lumisection_count(run_number, **kwargs):
         "sort": "lumisection_number"
     }
 
-    if "inside_cern_gpn" not in kwargs:
-        kwargs['inside_cern_gpn'] = check_oms_connectivity()
+    kwargs = _get_authentication(kwargs)
 
     response = _get_resources_page(
         "lumisections", parameters, page_size=1, page=1, **kwargs
@@ -214,42 +316,74 @@ def get_hltpathinfos(run_number, **kwargs):
     return get_resources("hltpathinfo", parameters, page_size=1000, **kwargs)
 
 
-def get_hltpathrates(run_number, path_name, **kwargs):
-    parameters = {
+def _get_hltpathrates_parameters(run_number, path_name):
+    return {
         "filter[last_lumisection_number][GT]": 0,
         "filter[path_name][EQ]": path_name,
         "filter[run_number][EQ]": run_number,
         "sort": "last_lumisection_number",
         "group[granularity]": "lumisection",
     }
+
+
+def get_hltpathrates(run_number, path_name, **kwargs):
+    parameters = _get_hltpathrates_parameters(run_number, path_name)
     return get_resources("hltpathrates", parameters, page_size=10000, **kwargs)
 
 
-def get_all_hltpathrates(run_number, silent=False, **kwargs):
+def get_all_hltpathrates(run_number, silent=False, nthreads=NTHREADS, progress=None, attribute="rate", **kwargs):
+    # note: the rates for the different paths are retrieved concurrently using at most nthreads threads,
+    #       sharing the same session and cookies.
+    #       progress is an optional function with arguments (number of paths done, total number of paths, path name)
+    #       that is called each time the rates for a path are retrieved
+    #       (if not specified and silent is False, a progress bar is printed).
+    #       the return value is a dict with the following items:
+    #       - 'path_names': list of path names
+    #       - 'path_index': dict matching path names to their index in 'path_names'
+    #       - 'lumisection_numbers': 1D numpy array of lumisection numbers
+    #       - 'rates': 2D numpy array of shape (number of paths, number of lumisections)
+    #         holding the requested attribute of each path and lumisection (nan if not available)
     if not silent:
         print("Retrieving all hltpathrates for run number {}".format(run_number))
         print("Getting list of available hltpathinfos...")
 
+    kwargs = _get_authentication(kwargs)
+    get_session(pool_size=max(1, nthreads))
+
     hltpathinfos = get_hltpathinfos(run_number, silent=silent, **kwargs)
 
     path_info_count = len(hltpathinfos)
 
     path_names = [pathinfo["path_name"] for pathinfo in hltpathinfos]
 
-    hltpathrates = []
-
-    for i, path_name in enumerate(path_names, 1):
-
-        print_progress(
-            i,
-            path_info_count,
-            text="Path {}/{}: {:80s}".format(i, path_info_count, path_name),
-        )
-        hltpathrates.extend(
-            get_hltpathrates(run_number, path_name, silent=silent, **kwargs)
-        )
-
-    return hltpathrates
+    if progress is None and not silent:
+        def progress(current, total, path_name):
+            print_progress(current, total, text="Path {}/{}: {:80s}".format(current, total, path_name))
+
+    pathrates = [None] * path_info_count
+
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+        futures = {executor.submit(get_resource_columns, "hltpathrates", _get_hltpathrates_parameters(run_number, path_name),
+                                   attributes=["last_lumisection_number", attribute], page_size=10000,
+                                   silent=True, nthreads=1, **kwargs): i
+                   for i, path_name in enumerate(path_names)}
+        for ndone, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            columns = future.result()
+            pathrates[i] = (columns["last_lumisection_number"].astype(np.int64),
+                            columns[attribute].astype(float))
+            if progress is not None:
+                progress(ndone, path_info_count, path_names[i])
+
+    lumisection_numbers = np.unique(np.concatenate([lsnbs for lsnbs, _ in pathrates] + [np.zeros(0, dtype=np.int64)]))
+    ratematrix = np.full((path_info_count, len(lumisection_numbers)), np.nan)
+    for i, (lsnbs, rates) in enumerate(pathrates):
+        ratematrix[i, np.searchsorted(lumisection_numbers, lsnbs)] = rates
+
+    return {"path_names": path_names,
+            "path_index": {path_name: i for i, path_name in enumerate(path_names)},
+            "lumisection_numbers": lumisection_numbers,
+            "rates": ratematrix}
 
 
 
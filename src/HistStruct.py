@@ -24,19 +24,76 @@ import os
 import sys
 import pickle
 import math
+import time
+import hashlib
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import importlib
+# (matplotlib is only imported in the plotting functions)
 
 # local modules
+from ScoreCache import ScoreCache
+from RunStore import RunStore
 sys.path.append('classifiers')
 from HistogramClassifier import HistogramClassifier
 sys.path.append('../utils')
 import dataframe_utils as dfu
 import hist_utils as hu
+import sparse_hist_utils as shu
 import json_utils as jsonu
-import plot_utils as pu
+
+
+
+
+### helper functions for evaluating classifiers in worker processes (see HistStruct.evaluate_classifiers)
+# they are defined at module level so that they can be used by a process pool.
+# the classifiers are passed once to each worker process (in init_worker_classifiers),
+# the histograms and scores are exchanged through shared memory (in evaluate_chunk_in_process).
+
+workerclassifiers = {}
+
+def remove_shared_file( path ):
+    ### remove a file holding histograms in shared memory (see HistStruct.get_shared_histograms), if it still exists
+    # mostly for internal use.
+    try: os.remove( path )
+    except OSError: pass
+
+def init_worker_classifiers( classifiers ):
+    ### store the classifiers in a worker process
+    # mostly for internal use.
+    global workerclassifiers
+    workerclassifiers = classifiers
+
+def evaluate_chunk_in_process( task ):
+    ### evaluate a classifier on a range of histograms in a worker process
+    # mostly for internal use.
+    # input arguments:
+    # - task: tuple of (histogram name, start index, stop index, histogram spec, score spec), where:
+    #   - histogram spec is either a dict with keys 'path', 'shape' and 'dtype' describing the full histogram array
+    #     in a file in shared memory, or a dict with key 'histograms' holding the histograms for this range themselves;
+    #   - score spec is a tuple of the name and length of the float64 score array in shared memory.
+    # returns:
+    # - the evaluation time in seconds
+    # notes:
+    # - the scores are written to the shared score array in place, for the given range only.
+    (histname,start,stop,histspec,scorespec) = task
+    shms = []
+    try:
+        if 'histograms' in histspec: histograms = histspec['histograms']
+        else: histograms = np.memmap(histspec['path'], dtype=histspec['dtype'], mode='r', shape=histspec['shape'])[start:stop]
+        shms.append( shared_memory.SharedMemory(name=scorespec[0]) )
+        starttime = time.time()
+        scores = workerclassifiers[histname].evaluate( histograms )
+        evaltime = time.time()-starttime
+        np.ndarray((scorespec[1],), dtype=np.float64, buffer=shms[-1].buf)[start:stop] = scores
+        # (views on the shared memory must be released before closing it)
+        del histograms, scores
+    finally:
+        for shm in shms: shm.close()
+    return evaltime
 
 
 
@@ -50,18 +107,39 @@ class HistStruct(object):
     # - prepare the data for machine learning training
     # - evaluate classifiers (machine learning types or other)
     
-    def __init__( self ):
+    def __init__( self, dtype=None ):
         ### empty initializer, setting all containers to empty defaults
+        # input arguments:
+        # - dtype: data type in which to store the histograms, e.g. np.float32 to halve the memory
+        #   (default: None, meaning float64 for add_dataframe and the data type as given for add_histograms);
+        #   see also set_dtype and compare_dtype_scores.
         # a HistStruct object has the following properties:
         # histnames: list of histogram names
         # histograms: dict mapping histogram name to 2D numpy array of histograms (shape (nhists,nbins))
+        #             (or to a RunStoreArray loading the histograms on demand, see add_run_store,
+        #             or to a SparseHists object storing only the non-zero bins, see set_sparse)
         # nentries: dict mapping histogram name to 1D numpy array of number of entries per histogram (same length as histograms)
         # runnbs: 1D numpy array of run numbers (same length as histograms)
         # lsnbs: 1D numpy array of lumisection numbers (same length as histograms)
         # classifiers: dict mapping histogram name to object of type HistogramClassifier
         # scores: dict mapping histogram name to 1D numpy array of values associated to the histograms (same length as histograms)
-        # masks: dict mapping name to 1D numpy array of booleans (same length as histograms) that can be used for masking
+        # masks: dict mapping name to a mask that can be used for masking, stored as a packed bitset
+        #        (i.e. np.packbits of a 1D numpy array of booleans with the same length as histograms, see get_mask)
+        # maskcache: dict caching combined masks and their indices per mask expression (see get_combined_mask)
+        # histcache: dict caching read-only masked histogram arrays per histogram name and mask expression
+        #            (see get_histograms with cache=True)
+        # streambuffers: dict of pre-allocated arrays in which lumisections are appended (see stream_lumisections)
+        # dtype: data type in which the histograms are stored (None if not specified, see initializer)
         # exthistograms: dict similar to histograms for additional (e.g. artificially generated) histograms
+        # fingerprints: dict mapping histogram name to a tuple of (data fingerprint, classifier fingerprint),
+        #               as they were at the moment the scores were computed (see evaluate_classifiers)
+        # scorecache: ScoreCache object for persistent storage of the scores on disk (None if not used, see set_score_cache)
+        # lsdata: dict mapping name to 1D numpy array of additional information per lumisection (same length as histograms),
+        #         e.g. pileup or luminosity retrieved from OMS (see add_oms_data)
+        # scorefitters: dict caching CloudFitter objects fitted on the scores (see fit_scores),
+        #               keyed on the fitter type, its arguments and a hash of the points it was fitted on
+        # sharedhists: dict mapping histogram name to a tuple of a weak reference to the histogram array
+        #              and the path of the file in shared memory that holds it (see get_shared_histograms)
         self.histnames = []
         self.histograms = {}
         self.nentries = {}
@@ -70,7 +148,28 @@ class HistStruct(object):
         self.classifiers = {}
         self.scores = {}
         self.masks = {}
+        self.maskcache = {}
+        self.histcache = {}
+        self.streambuffers = {}
+        self.dtype = dtype
         self.exthistograms = {}
+        self.fingerprints = {}
+        self.scorecache = None
+        self.lsdata = {}
+        self.scorefitters = {}
+        self.sharedhists = {}
+        
+    def __getstate__( self ):
+        ### support for pickling: the cached masked histogram arrays (see get_histograms)
+        # and the unused capacity of the streaming buffers (see stream_lumisections) are not stored,
+        # and histograms in shared memory (see get_shared_histograms) are stored as regular numpy arrays
+        state = self.__dict__.copy()
+        state['histcache'] = {}
+        state['streambuffers'] = {}
+        state['sharedhists'] = {}
+        state['histograms'] = {histname: np.asarray(histograms) if isinstance(histograms,np.memmap) else histograms
+                               for histname,histograms in self.histograms.items()}
+        return state
         
     def save( self, path ):
         ### save a HistStruct object to a pkl file
@@ -87,17 +186,31 @@ class HistStruct(object):
         # - path to a pkl file containing a HistStruct object
         with open(path,'rb') as f:
             obj = pickle.load(f)
+        # (objects saved with an older version of this class may lack some attributes)
+        if not hasattr(obj,'fingerprints'): obj.fingerprints = {}
+        if not hasattr(obj,'scorecache'): obj.scorecache = None
+        if not hasattr(obj,'lsdata'): obj.lsdata = {}
+        if not hasattr(obj,'scorefitters'): obj.scorefitters = {}
+        if not hasattr(obj,'maskcache'): obj.maskcache = {}
+        if not hasattr(obj,'histcache'): obj.histcache = {}
+        if not hasattr(obj,'streambuffers'): obj.streambuffers = {}
+        if not hasattr(obj,'sharedhists'): obj.sharedhists = {}
+        if not hasattr(obj,'dtype'): obj.dtype = None
+        for name,mask in obj.masks.items():
+            if mask.dtype==bool: obj.masks[name] = np.packbits(mask)
         return obj
         
-    def add_dataframe( self, df, cropslices=None, donormalize=True, rebinningfactor=None ):
+    def add_dataframe( self, df, cropslices=None, donormalize=True, rebinningfactor=None, sparse=False ):
         ### add a dataframe to a HistStruct
         # input arguments:
         # - df: a pandas dataframe as read from the input csv files
         # - cropslices: list of slices (one per dimension) by which to crop the histograms
         # - donormalize: boolean whether to normalize the histograms
         # - rebinningfactor: factor by which to group bins together
+        # - sparse: boolean whether to store the histograms as a SparseHists object (see set_sparse)
         # for more details on cropslices, donormalize and rebinningfactor, see hist_utils.py / preparedatafromdf!
         # notes:
+        # - the histograms are decoded and processed in the data type of the HistStruct (see initializer)
         # - the new dataframe can contain one or multiple histogram types
         # - the new dataframe must contain the same run and lumisection numbers (for each histogram type in it)
         #   as already present in the HistStruct, except if it is the first one to be added
@@ -117,7 +230,9 @@ class HistStruct(object):
             # prepare the data
             (hists_all,runnbs_all,lsnbs_all) = hu.preparedatafromdf(thisdf,returnrunls=True,
                                                                     donormalize=donormalize,
-                                                                    rebinningfactor=rebinningfactor)
+                                                                    rebinningfactor=rebinningfactor,
+                                                                    dtype=float if self.dtype is None else self.dtype,
+                                                                    sparse=sparse)
             runnbs_all = runnbs_all.astype(int)
             lsnbs_all = lsnbs_all.astype(int)
             # check consistency in run and lumisection numbers
@@ -146,7 +261,8 @@ class HistStruct(object):
         #     if you don't need that type of selection, nentries can be left at default.
         #   - default is None, meaning all entries will be set to zero.
         # notes:
-        # - no preprocessing is performed, this is assumed to have been done manually (if needed) before adding the histograms
+        # - no preprocessing is performed, this is assumed to have been done manually (if needed) before adding the histograms,
+        #   except for conversion to the data type of the HistStruct (if specified, see initializer)
         # - runnbs and lsnbs must correspond to what is already in the current HistStruct, except if this is the first set of histogram to be added
         # - see also add_dataframe for an alternative way of adding histograms
         
@@ -164,24 +280,71 @@ class HistStruct(object):
         if len(nentries)!=len(runnbs):
             raise Exception('ERROR in HistStruct.add_histograms: entries are not consistent with run/lumi numbers: '
                             +'found lengths {} and {} respectively.'.format(len(nentries),len(runnbs)))
+        if self.dtype is not None:
+            if isinstance(histograms,shu.SparseHists): histograms = histograms.astype(self.dtype, copy=False)
+            else: histograms = np.asarray(histograms).astype(self.dtype, copy=False)
         # add everything to the structure
         self.histnames.append(histname)
         self.histograms[histname] = histograms
         self.nentries[histname] = nentries
         self.runnbs = runnbs
         self.lsnbs = lsnbs
+        
+    def add_run_store( self, storedir, histnames=None, maxblocks=100 ):
+        ### add histograms from an on-disk RunStore, loading them per run only when they are needed
+        # input arguments:
+        # - storedir: directory of a RunStore (see RunStore.write to create one from csv files)
+        # - histnames: list of histogram names to add from the store (default: all)
+        # - maxblocks: maximum number of run blocks to keep in memory (see RunStore)
+        # notes:
+        # - the histograms are added as RunStoreArray objects instead of numpy arrays;
+        #   get_histograms, plot_ls and the other methods work as usual, but only read the runs they need
+        #   (e.g. the runs selected by the masks), and at most maxblocks blocks of one histogram type for one run
+        #   are kept in memory at any time.
+        # - run and lumisection numbers and numbers of entries are read from the store index,
+        #   so adding masks does not require loading any histograms.
+        # - evaluate_classifier loads all runs of a histogram type at once;
+        #   use evaluate_classifiers with the chunksize argument to keep the memory usage bounded.
+        store = RunStore( storedir, maxblocks=maxblocks )
+        if histnames is None: histnames = store.histnames
+        for histname in histnames:
+            if histname in self.histnames:
+                raise Exception('ERROR in HistStruct.add_run_store: store contains histogram name {}'.format(histname)
+                               +' but this is already present in the current HistStruct.')
+            if histname not in store.histnames:
+                raise Exception('ERROR in HistStruct.add_run_store: requested histogram name {}'.format(histname)
+                               +' but this is not present in the store.')
+        # check consistency in run and lumisection numbers
+        if len(self.histnames)!=0:
+            if( len(store.runnbs)!=len(self.runnbs) 
+                or not ( (store.runnbs==self.runnbs).all() and (store.lsnbs==self.lsnbs).all() ) ):
+                raise Exception('ERROR in HistStruct.add_run_store: run/lumi numbers are not consistent with current HistStruct!')
+        # add everything to the structure
+        for histname in histnames:
+            self.histnames.append(histname)
+            self.histograms[histname] = store.get_array(histname)
+            self.nentries[histname] = store.nentries[histname]
+        self.runnbs = store.runnbs
+        self.lsnbs = store.lsnbs
     
     def add_mask( self, name, mask ):
         ### add a mask to a HistStruct
         # input arguments:
         # - name: a name for the mask
         # - mask: a 1D np array of booleans  with same length as number of lumisections in HistStruct
+        # notes:
+        # - the mask is stored as a packed bitset (one bit per lumisection), see get_mask to retrieve it.
+        # - the name cannot start with '~', which is used for negation in mask expressions (see get_combined_mask).
         if name in self.masks.keys():
             raise Exception('ERROR in HistStruct.add_mask: name {} already exists!'.format(name))
+        if name.startswith('~'):
+            raise Exception('ERROR in HistStruct.add_mask: name {} starts with ~, which is reserved for negation.'.format(name))
         if( len(mask)!=len(self.runnbs) ):
             raise Exception('ERROR in HistStruct.add_mask: mask has length {}'.format(len(mask))
                            +' while HistStruct contains {} lumisections.'.format(len(self.runnbs)))
-        self.masks[name] = mask.astype(bool)
+        self.masks[name] = np.packbits( np.asarray(mask).astype(bool) )
+        self.maskcache = {}
+        self.histcache = {}
             
     def remove_mask( self, name ):
         ### inverse operation of add_mask
@@ -189,6 +352,16 @@ class HistStruct(object):
             print('WARNING in HistStruct.remove_mask: name {} is not in list of masks...'.format(name))
             return
         self.masks.pop( name )
+        self.maskcache = {}
+        self.histcache = {}
+        
+    def get_mask( self, name ):
+        ### get a single mask as a 1D numpy array of booleans
+        # input arguments:
+        # - name: name of the mask
+        if name not in self.masks.keys():
+            raise Exception('ERROR in HistStruct.get_mask: mask {} requested but not found.'.format(name))
+        return np.unpackbits( self.masks[name], count=len(self.runnbs) ).astype(bool)
       
     def add_json_mask( self, name, jsondict ):
         ### add a mask corresponding to a json dict
@@ -234,29 +407,121 @@ class HistStruct(object):
             mask = mask & (self.nentries[histname]/nbins>entries_to_bins_ratio)
         self.add_mask( name, mask )
         
+    def get_mask_key( self, names ):
+        ### get a canonical key for a mask expression (see get_combined_mask)
+        # mostly for internal use.
+        # the key is a sorted tuple of terms, where each term is a (possibly negated) name
+        # or a sorted tuple of (possibly negated) names for a nested list.
+        terms = set()
+        for term in names:
+            if isinstance(term,str): terms.add(term)
+            else: terms.add(tuple(sorted(set(term))))
+        return tuple(sorted(terms, key=repr))
+    
+    def get_mask_bits( self, name ):
+        ### get the packed bitset for a (possibly negated) mask name
+        # mostly for internal use.
+        negate = name.startswith('~')
+        if negate: name = name[1:]
+        if name not in self.masks.keys():
+            raise Exception('ERROR in HistStruct.get_combined_mask: mask {} requested but not found.'.format(name))
+        if negate: return np.invert(self.masks[name])
+        return self.masks[name]
+    
+    def get_combined_mask_and_indices( self, names ):
+        ### get a combined mask and the corresponding indices for a mask expression
+        # mostly for internal use; see get_combined_mask and get_combined_indices.
+        key = self.get_mask_key( names )
+        if key not in self.maskcache.keys():
+            nls = len(self.runnbs)
+            bits = np.full( (nls+7)//8, 255, dtype=np.uint8 )
+            for term in key:
+                if isinstance(term,str): np.bitwise_and( bits, self.get_mask_bits(term), out=bits )
+                else:
+                    orbits = np.zeros( (nls+7)//8, dtype=np.uint8 )
+                    for name in term: np.bitwise_or( orbits, self.get_mask_bits(name), out=orbits )
+                    np.bitwise_and( bits, orbits, out=bits )
+            mask = np.unpackbits( bits, count=nls ).astype(bool)
+            indices = np.nonzero(mask)[0]
+            mask.setflags(write=False)
+            indices.setflags(write=False)
+            self.maskcache[key] = (mask,indices)
+        return self.maskcache[key]
+        
     def get_combined_mask( self, names ):
         ### get a combined mask given multiple mask names
         # mostly for internal use; externally you can use get_histograms( histname, <list of mask names>) directly
-        mask = np.ones(len(self.runnbs)).astype(bool)
-        for name in names:
-            if name not in self.masks.keys():
-                raise Exception('ERROR in HistStruct.get_combined_mask: mask {} requested but not found.'.format(name))
-            mask = mask & self.masks[name]
-        return mask
+        # input arguments:
+        # - names: list of mask names, combined with AND.
+        #   a name can be prefixed with '~' to use its negation (NOT),
+        #   and an element can also be a nested list of (possibly negated) names, which are combined with OR;
+        #   e.g. ['dcson','~bad',['training','validation']] selects dcson AND NOT bad AND (training OR validation).
+        # returns:
+        # - a read-only 1D numpy array of booleans
+        # notes:
+        # - the masks are combined on their packed bitsets, and the result is cached per mask expression
+        #   (independent of the order of the names), until a mask is added or removed.
+        return self.get_combined_mask_and_indices( names )[0]
+    
+    def get_combined_indices( self, names ):
+        ### get the indices of the lumisections passing a combination of masks
+        # input arguments:
+        # - names: list of mask names, see get_combined_mask
+        # returns:
+        # - a read-only 1D numpy array of integer indices (cached in the same way as get_combined_mask),
+        #   which is usually faster for indexing than the boolean mask itself.
+        return self.get_combined_mask_and_indices( names )[1]
+    
+    def sort_by_masks( self, masknamesets ):
+        ### reorder the lumisections so that frequently used mask combinations select a contiguous range
+        # input arguments:
+        # - masknamesets: list of mask expressions (each one a list of mask names, see get_combined_mask),
+        #   in order of priority, e.g. [['dcson'],['dcson','highstat'],['dcson','highstat','training']]
+        # notes:
+        # - the lumisections are sorted (stably) such that those passing the first expression come first,
+        #   within those, the ones passing the second expression come first, and so on.
+        #   if the expressions are nested (as in the example above), each of them selects a contiguous range,
+        #   and get_histograms with cache=True returns a view on the histograms instead of a copy for them.
+        # - all per-lumisection arrays (histograms, run and lumisection numbers, nentries, masks, scores, lsdata)
+        #   are reordered consistently; extra histograms (exthistograms) are not affected.
+        # - scores that were up to date remain up to date (see evaluate_classifiers).
+        # - not supported for histograms added from a RunStore.
+        for histname in self.histnames:
+            if not isinstance(self.histograms[histname],(np.ndarray,shu.SparseHists)):
+                raise Exception('ERROR in HistStruct.sort_by_masks: histograms of type {}'.format(histname)
+                               +' are not a numpy array (e.g. added from a RunStore) and cannot be reordered.')
+        # determine the new order
+        keys = [~self.get_combined_mask(names) for names in masknamesets]
+        order = np.lexsort( keys[::-1] ) if len(keys)>0 else np.arange(len(self.runnbs))
+        # check which scores are up to date before reordering
+        uptodate = [histname for histname in self.fingerprints.keys()
+                    if histname in self.scores.keys() and self.get_fingerprint(histname)==self.fingerprints[histname]]
+        # reorder everything
+        for histname in self.histnames:
+            self.histograms[histname] = self.histograms[histname][order]
+            self.nentries[histname] = np.asarray(self.nentries[histname])[order]
+        for histname in self.scores.keys(): self.scores[histname] = self.scores[histname][order]
+        for name in self.lsdata.keys(): self.lsdata[name] = self.lsdata[name][order]
+        for name in self.masks.keys(): self.masks[name] = np.packbits( self.get_mask(name)[order] )
+        self.runnbs = self.runnbs[order]
+        self.lsnbs = self.lsnbs[order]
+        self.maskcache = {}
+        self.histcache = {}
+        for histname in uptodate: self.fingerprints[histname] = self.get_fingerprint(histname)
         
     def get_runnbs( self, masknames=None ):
         ### get the array of run numbers, optionally after masking
         # input arguments:
         # - masknames: list of names of masks (default: no masking, return full array)
         if masknames is None: return self.runnbs[:]
-        return self.runnbs[ self.get_combined_mask(masknames) ]
+        return self.runnbs[ self.get_combined_indices(masknames) ]
     
     def get_lsnbs( self, masknames=None ):
         ### get the array of lumisection numbers, optionally after masking
         # input arguments:
         # - masknames: list of names of masks (default: no masking, return full array)
         if masknames is None: return self.lsnbs[:]
-        return self.lsnbs[ self.get_combined_mask(masknames) ]
+        return self.lsnbs[ self.get_combined_indices(masknames) ]
     
     def get_index( self, runnb, lsnb ):
         ### get the index in the current HistStruct of a given run and lumisection number
@@ -269,6 +534,49 @@ class HistStruct(object):
         (index,) = index
         return index
     
+    def add_lsdata( self, name, values ):
+        ### add an array of additional information per lumisection to a HistStruct
+        # input arguments:
+        # - name: a name for the information (if it already exists, it is overwritten)
+        # - values: a 1D np array with same length as number of lumisections in HistStruct
+        if( len(values)!=len(self.runnbs) ):
+            raise Exception('ERROR in HistStruct.add_lsdata: array has length {}'.format(len(values))
+                           +' while HistStruct contains {} lumisections.'.format(len(self.runnbs)))
+        self.lsdata[name] = np.asarray(values)
+        
+    def get_lsdata( self, name, masknames=None ):
+        ### get an array of additional information per lumisection, optionally after masking
+        # input arguments:
+        # - name: name of the information as added by add_lsdata or add_oms_data
+        # - masknames: list of names of masks (default: no masking, return full array)
+        if name not in self.lsdata.keys():
+            raise Exception('ERROR in HistStruct.get_lsdata: requested information {}'.format(name)
+                           +' but it is not present in the HistStruct.')
+        if masknames is None: return self.lsdata[name][:]
+        return self.lsdata[name][ self.get_combined_indices(masknames) ]
+    
+    def add_oms_data( self, omsapi, attributes, api_endpoint='lumisections', lsattribute='lumisection_number', 
+                      prefix='', maxconcurrent=8 ):
+        ### retrieve information per lumisection from OMS and add it to the HistStruct (see add_lsdata)
+        # input arguments:
+        # - omsapi: an OMSAPI instance (see omsapi/get_oms_data.py)
+        # - attributes: list of valid field names in the OMS data to retrieve, e.g. ['pileup','delivered_lumi']
+        # - api_endpoint: OMS endpoint with per-lumisection information
+        # - lsattribute: field name in the OMS data that holds the lumisection number
+        # - prefix: string prepended to the attribute names to obtain the names in the HistStruct
+        # - maxconcurrent: maximum number of runs that are retrieved concurrently
+        # notes:
+        # - see get_oms_data.py/get_oms_data_per_lumisection for more details;
+        #   in short, lumisections that are not found in OMS get nan (or None for non-numerical attributes).
+        # - the omsapi folder is only imported when calling this function, 
+        #   so that the HistStruct can be used without OMS access.
+        sys.path.append('../omsapi')
+        from get_oms_data import get_oms_data_per_lumisection
+        data = get_oms_data_per_lumisection( omsapi, self.runnbs, self.lsnbs, attributes, 
+                                             api_endpoint=api_endpoint, lsattribute=lsattribute,
+                                             maxconcurrent=maxconcurrent )
+        for attribute in attributes: self.add_lsdata( prefix+attribute, data[attribute] )
+    
     def get_scores( self, histname=None, masknames=None ):
         ### get the array of scores for a given histogram type, optionally after masking
         # input arguments:
@@ -289,12 +597,10 @@ class HistStruct(object):
                 raise Exception('ERROR in HistStruct.get_scores: requested histogram name {}'.format(histname)
                                +' but the scores for this histogram type were not yet initialized.')
             histnames = [histname]
-        mask = np.ones(len(self.lsnbs)).astype(bool)
-        if masknames is not None:
-            mask = self.get_combined_mask(masknames)
         res = {}
         for hname in histnames:
-            res[hname] = self.scores[hname][mask]
+            if masknames is None: res[hname] = np.array(self.scores[hname])
+            else: res[hname] = self.scores[hname][self.get_combined_indices(masknames)]
         if histname is None: return res
         return res[histname]
     
@@ -328,12 +634,97 @@ class HistStruct(object):
                 scores[histname] = self.scores[histname][index]
         return scores
     
-    def get_histograms( self, histname=None, masknames=None ):
+    def get_scores_array( self, histnames=None, masknames=None ):
+        ### get the scores for multiple histogram types as a single 2D array, optionally after masking
+        # input arguments:
+        # - histnames: list of names of the histogram types to include (default: all)
+        # - masknames: list of names of masks (default: no masking, return all lumisections)
+        # returns:
+        # - a numpy array of shape (number of lumisections, number of histogram types),
+        #   where the columns are in the order of histnames;
+        #   this is the typical input for fitting and evaluating a CloudFitter (see fit_scores and get_scores_logpdf).
+        # notes:
+        # - the array is filled directly from the stored scores, without intermediate copies per histogram type;
+        #   it is stored column by column (i.e. in fortran order), which does not matter for any numpy operation.
+        if histnames is None: histnames = self.histnames
+        for histname in histnames:
+            if histname not in self.histnames:
+                raise Exception('ERROR in HistStruct.get_scores_array: requested histogram name {}'.format(histname)
+                               +' but this is not present in the current HistStruct.')
+            if histname not in self.scores.keys():
+                raise Exception('ERROR in HistStruct.get_scores_array: requested histogram name {}'.format(histname)
+                               +' but the scores for this histogram type were not yet initialized.')
+        indices = None
+        nls = len(self.lsnbs)
+        if masknames is not None:
+            indices = self.get_combined_indices(masknames)
+            nls = len(indices)
+        res = np.empty((len(histnames),nls))
+        for i,histname in enumerate(histnames):
+            if indices is None: res[i] = self.scores[histname]
+            else: np.take(self.scores[histname], indices, out=res[i])
+        return res.T
+    
+    def fit_scores( self, fittertype, histnames=None, masknames=None, **kwargs ):
+        ### fit a CloudFitter to the scores of multiple histogram types, optionally after masking
+        # input arguments:
+        # - fittertype: a class deriving from CloudFitter (e.g. SeminormalFitter or GaussianKdeFitter)
+        # - histnames: list of names of the histogram types to use as dimensions (default: all)
+        # - masknames: list of names of masks selecting the lumisections to fit on (e.g. a training set)
+        # - kwargs: additional keyword arguments passed to the fitter (e.g. bw_method for GaussianKdeFitter)
+        # returns:
+        # - the fitted CloudFitter object, with one dimension per histogram type in histnames
+        # notes:
+        # - the fits are cached in the 'scorefitters' attribute, keyed on the fitter type, the kwargs
+        #   and a hash of the points that were fitted; calling this method again with the same arguments
+        #   returns the cached fit without refitting, as long as the fitted points did not change
+        #   (e.g. after adding other masks or re-evaluating classifiers for other histogram types).
+        points = self.get_scores_array( histnames=histnames, masknames=masknames )
+        # the points are the transpose of a C-contiguous array (see get_scores_array),
+        # so the underlying buffer can be hashed directly without making a copy
+        pointshash = hashlib.sha1( str(points.shape).encode() )
+        pointshash.update( memoryview(points.T).cast('B') )
+        key = ( fittertype.__module__+'.'+fittertype.__name__, 
+                repr(sorted(kwargs.items())), pointshash.hexdigest() )
+        if key not in self.scorefitters.keys():
+            self.scorefitters[key] = fittertype( points, **kwargs )
+        return self.scorefitters[key]
+    
+    def get_scores_logpdf( self, fitter, histnames=None, masknames=None, chunksize=100000 ):
+        ### evaluate the log-probability of the scores of all lumisections under a fitted CloudFitter
+        # input arguments:
+        # - fitter: a fitted CloudFitter object (e.g. as returned by fit_scores)
+        # - histnames: list of names of the histogram types, in the same order as used for fitting (default: all)
+        # - masknames: list of names of masks (default: no masking, evaluate all lumisections)
+        # - chunksize: number of lumisections to evaluate at once (see CloudFitter.logpdf)
+        # returns:
+        # - a 1D numpy array with the natural logarithm of the pdf for each (selected) lumisection
+        points = self.get_scores_array( histnames=histnames, masknames=masknames )
+        if points.shape[1]!=fitter.ndims:
+            raise Exception('ERROR in HistStruct.get_scores_logpdf: fitter has {} dimensions'.format(fitter.ndims)
+                           +' while {} histogram types were requested.'.format(points.shape[1]))
+        return fitter.logpdf( points, chunksize=chunksize )
+    
+    def clear_score_fits( self ):
+        ### remove all cached fits (see fit_scores)
+        self.scorefitters = {}
+    
+    def get_histograms( self, histname=None, masknames=None, cache=False ):
         ### get the array of histograms for a given type, optionally after masking
         # input arguments:
         # - histname: name of the histogram type to retrieve 
         #   if None, return a dict matching histnames to arrays of histograms
         # - masknames: list of names of masks (default: no masking, return full array)
+        #   (mask names can also be negated or combined with OR, see get_combined_mask)
+        # - cache: boolean whether to return a shared read-only array instead of a new copy (default: False)
+        #   notes:
+        #   - the masked array is built (as a contiguous array) only at the first call for a given
+        #     histogram type and mask combination, and is shared by all subsequent calls;
+        #     this avoids repeated copies when e.g. the same training set is retrieved in a loop.
+        #   - if the selected lumisections form a contiguous range (e.g. without masking, or after sort_by_masks),
+        #     a view on the histograms is returned instead, which does not take any additional memory.
+        #   - the cached arrays are dropped when a mask is added or removed, or when calling clear_histogram_cache
+        #     (which is needed if the arrays in the 'histograms' attribute are modified directly).
         histnames = self.histnames[:]
         if histname is not None:
             # check if histname is valid
@@ -341,15 +732,38 @@ class HistStruct(object):
                 raise Exception('ERROR in HistStruct.get_scores: requested histogram name {}'.format(histname)
                                +' but this is not present in the current HistStruct.')
             histnames = [histname]
-        mask = np.ones(len(self.lsnbs)).astype(bool)
-        if masknames is not None:
-            mask = self.get_combined_mask(masknames)
         res = {}
         for hname in histnames:
-            res[hname] = self.histograms[hname][mask]
+            if cache: res[hname] = self.get_cached_histograms( hname, masknames )
+            elif masknames is None: res[hname] = self.histograms[hname].copy()
+            else: res[hname] = self.histograms[hname][self.get_combined_indices(masknames)]
         if histname is None: return res
         return res[histname]
     
+    def get_cached_histograms( self, histname, masknames=None ):
+        ### get a shared read-only array of histograms for a given type, optionally after masking
+        # mostly for internal use; see get_histograms with cache=True.
+        key = (histname, None if masknames is None else self.get_mask_key(masknames))
+        if key in self.histcache.keys(): return self.histcache[key]
+        histograms = self.histograms[histname]
+        if masknames is None: indices = np.arange(len(self.runnbs))
+        else: indices = self.get_combined_indices(masknames)
+        if( isinstance(histograms,np.ndarray) and len(indices)>0 
+            and indices[-1]-indices[0]+1==len(indices) ):
+            # (contiguous range: return a view)
+            res = histograms[indices[0]:indices[-1]+1].view()
+            res.setflags(write=False)
+        elif isinstance(histograms,shu.SparseHists): res = histograms[indices]
+        else: 
+            res = np.ascontiguousarray( histograms[indices] )
+            res.setflags(write=False)
+        self.histcache[key] = res
+        return res
+    
+    def clear_histogram_cache( self ):
+        ### remove all cached masked histogram arrays (see get_histograms with cache=True)
+        self.histcache = {}
+    
     def add_classifier( self, histname, classifier, evaluate=False ):
         ### add a histogram classifier for a given histogram name to the HistStruct
         # input arguments:
@@ -373,6 +787,10 @@ class HistStruct(object):
         # - histname: a valid histogram name present in the HistStruct for which to evaluate the classifier
         # notes:
         # - the result is both returned and stored in the 'scores' attribute
+        # - if a score cache is set (see set_score_cache), the scores are taken from there if available,
+        #   and newly computed scores are added to it.
+        # - the fingerprint of the histograms (see get_fingerprint) is only computed if a score cache is set,
+        #   so without score cache, a later call to evaluate_classifiers does not skip this histogram type.
         
         # check if histname is valid
         if histname not in self.histnames:
@@ -381,10 +799,450 @@ class HistStruct(object):
         if not histname in self.classifiers.keys():
             raise Exception('ERROR in HistStruct.evaluate_classifier: requested to evaluate classifier for {}'.format(histname)
                            +' but no classifier was set for this histogram type.')
-        scores = self.classifiers[histname].evaluate(self.histograms[histname])
+        if self.scorecache is None:
+            self.scores[histname] = self.classifiers[histname].evaluate(self.histograms[histname][:])
+            self.fingerprints.pop( histname, None )
+            return self.scores[histname]
+        fingerprint = self.get_fingerprint( histname )
+        scores = self.scorecache.get( histname, fingerprint )
+        if scores is None:
+            scores = self.classifiers[histname].evaluate(self.histograms[histname][:])
+            self.scorecache.put( histname, fingerprint, scores )
         self.scores[histname] = scores
+        self.fingerprints[histname] = fingerprint
         return scores
     
+    def set_score_cache( self, cachedir, maxsize=1e9 ):
+        ### store the scores persistently on disk, so they can be reused after the HistStruct is rebuilt
+        # input arguments:
+        # - cachedir: directory where to store the scores (see ScoreCache), use None to stop using a score cache
+        # - maxsize: maximum total size of the cache in bytes (default: 1 GB), 
+        #   beyond which the least recently used scores are removed.
+        # notes:
+        # - once set, evaluate_classifier and evaluate_classifiers automatically take the scores from the cache
+        #   if they were computed before for exactly the same histograms and classifier (see get_fingerprint),
+        #   and add newly computed scores to the cache.
+        if cachedir is None: self.scorecache = None
+        else: self.scorecache = ScoreCache( cachedir, maxsize=maxsize )
+    
+    def get_fingerprint( self, histname ):
+        ### get a fingerprint of the histograms and classifier for a given histogram type
+        # input arguments:
+        # - histname: a valid histogram name present in the HistStruct
+        # returns:
+        # - a tuple of two strings: a hash of the histogram array and a hash of the classifier (None if no classifier is set)
+        # notes:
+        # - used to detect whether the scores for a histogram type are still up to date (see evaluate_classifiers).
+        # - the fingerprint of the classifier is determined by its get_fingerprint method (see HistogramClassifier).
+        # - for histograms added from a RunStore, the hash computed when writing the store is used,
+        #   so that the histograms do not need to be loaded.
+        # - numpy arrays are hashed directly from their memory (in chunks of rows if they are not contiguous),
+        #   so that no copy of the full array is made.
+        histograms = self.histograms[histname]
+        datafingerprint = hashlib.sha1( str((histograms.shape,histograms.dtype)).encode() )
+        if hasattr(histograms,'get_fingerprint'): datafingerprint.update( histograms.get_fingerprint().encode() )
+        else:
+            histograms = np.asarray(histograms)
+            chunksize = len(histograms) if histograms.flags.c_contiguous else max(1, 2**26//max(1,histograms[:1].nbytes))
+            for start in range(0,len(histograms),max(1,chunksize)):
+                datafingerprint.update( memoryview(np.ascontiguousarray(histograms[start:start+chunksize])).cast('B') )
+        classifierfingerprint = None
+        if histname in self.classifiers.keys(): 
+            classifierfingerprint = self.classifiers[histname].get_fingerprint()
+        return (datafingerprint.hexdigest(), classifierfingerprint)
+    
+    def evaluate_classifiers( self, histnames=None, nthreads=None, chunksize=None, force=False, doprint=False, nprocesses=None ):
+        ### evaluate the histogram classifiers for multiple histogram types concurrently
+        # input arguments:
+        # - histnames: list of histogram names for which to evaluate the classifier
+        #   (default: all histogram types for which a classifier was set)
+        # - nthreads: number of worker threads (default: determined automatically by concurrent.futures)
+        # - chunksize: maximum number of histograms to pass to a classifier at once (default: all at once);
+        #   large arrays are split into chunks of this size, which are evaluated concurrently as well.
+        # - force: boolean whether to re-evaluate all classifiers, even if their scores are up to date (default: False)
+        # - doprint: boolean whether to print the evaluation time per histogram type
+        # - nprocesses: number of worker processes; if specified, a process pool is used instead of a thread pool
+        #   (see evaluate_chunks_in_processes). in that case, chunksize defaults to splitting each histogram type
+        #   in nprocesses equal ranges.
+        # returns:
+        # - a dict mapping histogram names to the time (in seconds) spent in evaluating their classifier,
+        #   summed over all chunks (None for histogram types that were skipped or taken from the score cache)
+        # notes:
+        # - the result is stored in the 'scores' attribute, as for evaluate_classifier.
+        # - a histogram type is skipped if neither its histograms nor its classifier have changed
+        #   since the last evaluation (as determined by get_fingerprint), unless force is True.
+        #   if force is True and no score cache is set, the fingerprints are not computed at all
+        #   (so a later call without force does not skip these histogram types).
+        # - if a score cache is set (see set_score_cache), it is consulted and populated as in evaluate_classifier
+        #   (also if force is True, since the cached scores are known to correspond to the current histograms and classifier).
+        # - by default, threads rather than processes are used, so the histograms do not need to be shared;
+        #   most of the heavy lifting (numpy, sklearn, tensorflow) releases the GIL.
+        #   for classifiers that spend much time holding the GIL (e.g. MaxPullClassifier or NMFClassifier
+        #   on large 2D histograms, with many small numpy operations), processes scale better.
+        if histnames is None: histnames = [histname for histname in self.histnames if histname in self.classifiers.keys()]
+        for histname in histnames:
+            if histname not in self.histnames:
+                raise Exception('ERROR in HistStruct.evaluate_classifiers: requested histogram name {}'.format(histname)
+                                +' but this is not present in the current HistStruct.')
+            if not histname in self.classifiers.keys():
+                raise Exception('ERROR in HistStruct.evaluate_classifiers: requested to evaluate classifier for {}'.format(histname)
+                               +' but no classifier was set for this histogram type.')
+        # determine which histogram types need to be (re-)evaluated
+        fingerprints = {}
+        timings = {}
+        for histname in histnames:
+            fingerprints[histname] = None
+            if self.scorecache is not None or not force: fingerprints[histname] = self.get_fingerprint( histname )
+            timings[histname] = None
+            if( not force and histname in self.scores.keys()
+                and self.fingerprints.get(histname)==fingerprints[histname] ):
+                if doprint: print('skipping {}: scores are up to date'.format(histname))
+                continue
+            if self.scorecache is not None:
+                scores = self.scorecache.get( histname, fingerprints[histname] )
+                if scores is not None:
+                    self.scores[histname] = scores
+                    self.fingerprints[histname] = fingerprints[histname]
+                    if doprint: print('skipping {}: scores were taken from the score cache'.format(histname))
+                    continue
+            timings[histname] = 0.
+        todo = [histname for histname in histnames if timings[histname] is not None]
+        # split the histograms in chunks
+        tasks = []
+        for histname in todo:
+            nhists = len(self.histograms[histname])
+            thischunksize = chunksize
+            if thischunksize is None: thischunksize = nhists if nprocesses is None else math.ceil(nhists/nprocesses)
+            thischunksize = max(1, thischunksize)
+            for start in range(0,max(nhists,1),thischunksize):
+                tasks.append( (histname,start,min(start+thischunksize,nhists)) )
+        def evaluate_chunk( task ):
+            (histname,start,stop) = task
+            starttime = time.time()
+            scores = self.classifiers[histname].evaluate( self.histograms[histname][start:stop] )
+            return (scores, time.time()-starttime)
+        # evaluate all chunks on a thread pool or a process pool
+        if nprocesses is None:
+            with ThreadPoolExecutor( max_workers=nthreads ) as executor:
+                results = list(executor.map( evaluate_chunk, tasks ))
+        else: results = self.evaluate_chunks_in_processes( tasks, nprocesses )
+        # put the results together
+        for histname in todo:
+            chunkresults = [result for task,result in zip(tasks,results) if task[0]==histname]
+            self.scores[histname] = np.concatenate([scores for scores,_ in chunkresults])
+            if fingerprints[histname] is None: self.fingerprints.pop( histname, None )
+            else: self.fingerprints[histname] = fingerprints[histname]
+            if self.scorecache is not None: self.scorecache.put( histname, fingerprints[histname], self.scores[histname] )
+            timings[histname] = sum([t for _,t in chunkresults])
+            if doprint: print('evaluated {} in {:.3f} seconds'.format(histname,timings[histname]))
+        return timings
+    
+    def evaluate_chunks_in_processes( self, tasks, nprocesses ):
+        ### evaluate classifiers on ranges of histograms using a pool of worker processes
+        # mostly for internal use (see evaluate_classifiers with nprocesses).
+        # input arguments:
+        # - tasks: list of tuples (histogram name, start index, stop index)
+        # - nprocesses: number of worker processes
+        # returns:
+        # - a list of tuples (scores, evaluation time in seconds), one for each task
+        # notes:
+        # - the histogram arrays (if they are numpy arrays) are moved to shared memory (see get_shared_histograms),
+        #   from which the worker processes read the range they need without any further copying or pickling;
+        #   this is done only at the first call, later calls reuse the same shared memory.
+        #   other histogram types (e.g. SparseHists or histograms from a RunStore) are passed to the workers per range.
+        # - for each histogram type, a float64 score array in shared memory is filled in place by the workers,
+        #   so the scores are converted to float64.
+        # - the classifiers are pickled once per worker process.
+        # - the shared memory for the scores is released at the end, also if an error occurs.
+        histnames = list(dict.fromkeys([task[0] for task in tasks]))
+        shms = []
+        histspecs = {}
+        scoreshms = {}
+        try:
+            for histname in histnames:
+                histograms = self.histograms[histname]
+                if isinstance(histograms,np.ndarray) and histograms.nbytes>0:
+                    histspecs[histname] = {'path':self.get_shared_histograms(histname), 
+                                           'shape':histograms.shape, 'dtype':histograms.dtype.str}
+                shms.append( shared_memory.SharedMemory(create=True, size=max(8*len(histograms),1)) )
+                scoreshms[histname] = shms[-1]
+            processtasks = []
+            for (histname,start,stop) in tasks:
+                histspec = histspecs.get(histname, None)
+                if histspec is None: histspec = {'histograms': self.histograms[histname][start:stop]}
+                scorespec = (scoreshms[histname].name, len(self.histograms[histname]))
+                processtasks.append( (histname,start,stop,histspec,scorespec) )
+            classifiers = {histname: self.classifiers[histname] for histname in histnames}
+            with ProcessPoolExecutor( max_workers=nprocesses, initializer=init_worker_classifiers,
+                                      initargs=(classifiers,) ) as executor:
+                evaltimes = list(executor.map( evaluate_chunk_in_process, processtasks ))
+            results = []
+            for (histname,start,stop),evaltime in zip(tasks,evaltimes):
+                scores = np.ndarray((len(self.histograms[histname]),), dtype=np.float64, buffer=scoreshms[histname].buf)
+                results.append( (scores[start:stop].copy(), evaltime) )
+                # (views on the shared memory must be released before closing it)
+                del scores
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        return results
+    
+    def get_shared_histograms( self, histname ):
+        ### get the path of a file in shared memory holding the histograms of a given type
+        # mostly for internal use (see evaluate_chunks_in_processes).
+        # notes:
+        # - at the first call, the histograms are copied into a file-backed array (np.memmap, in /dev/shm if available),
+        #   which replaces the array in the 'histograms' attribute, so the original array can be freed.
+        #   later calls return the same file without copying, as long as this array is not replaced
+        #   (e.g. by set_dtype, sort_by_masks or stream_lumisections); in-place modifications are shared as well.
+        # - the file is removed as soon as the array is no longer in use (or at exit).
+        histograms = self.histograms[histname]
+        (ref,path) = self.sharedhists.get(histname, (None,None))
+        if ref is not None and ref() is histograms: return path
+        shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        (fd,path) = tempfile.mkstemp( prefix='histstruct_', suffix='.dat', dir=shmdir )
+        os.close(fd)
+        try:
+            shared = np.memmap( path, dtype=histograms.dtype, mode='w+', shape=histograms.shape )
+            shared[:] = histograms
+        except:
+            remove_shared_file( path )
+            raise
+        weakref.finalize( shared, remove_shared_file, path )
+        self.histograms[histname] = shared
+        self.sharedhists[histname] = (weakref.ref(shared), path)
+        # (drop other references to the original array)
+        self.histcache = {key: val for key,val in self.histcache.items() if key[0]!=histname}
+        self.streambuffers.pop( ('histograms',histname), None )
+        return path
+    
+    def set_dtype( self, dtype ):
+        ### convert all histograms to a given data type, and use it for histograms added later on
+        # input arguments:
+        # - dtype: data type, e.g. np.float32 to halve the memory with respect to float64
+        # notes:
+        # - the scores are not re-evaluated automatically, but since the fingerprints of the histograms change,
+        #   evaluate_classifiers will re-evaluate them (see compare_dtype_scores to check the impact beforehand).
+        # - not supported for histograms added from a RunStore (choose the data type when writing the store instead).
+        for histname in self.histnames:
+            if not isinstance(self.histograms[histname],(np.ndarray,shu.SparseHists)):
+                raise Exception('ERROR in HistStruct.set_dtype: histograms of type {}'.format(histname)
+                               +' are not a numpy array (e.g. added from a RunStore) and cannot be converted.')
+        for histname in self.histnames:
+            self.histograms[histname] = self.histograms[histname].astype(dtype, copy=False)
+        self.dtype = dtype
+        self.histcache = {}
+    
+    def set_sparse( self, histnames=None, sparse=True ):
+        ### convert histograms to a sparse representation (or back to numpy arrays)
+        # input arguments:
+        # - histnames: list of histogram names to convert (default: all)
+        # - sparse: boolean whether to convert to SparseHists objects (True) or to numpy arrays (False)
+        # notes:
+        # - a SparseHists object (see sparse_hist_utils.py) only stores the non-zero bins,
+        #   which saves memory and time for mostly empty histograms (e.g. 2D occupancy maps).
+        #   masking, get_histograms, plot_ls and fingerprinting work as usual; get_histograms returns SparseHists objects.
+        # - not all classifiers support SparseHists objects as input; MaxPullClassifier and NMFClassifier do,
+        #   and exploit the sparsity. for the other ones, convert to numpy arrays first.
+        # - not supported for histograms added from a RunStore.
+        if histnames is None: histnames = self.histnames
+        for histname in histnames:
+            if not isinstance(self.histograms[histname],(np.ndarray,shu.SparseHists)):
+                raise Exception('ERROR in HistStruct.set_sparse: histograms of type {}'.format(histname)
+                               +' are not a numpy array (e.g. added from a RunStore) and cannot be converted.')
+        for histname in histnames:
+            if sparse: self.histograms[histname] = shu.tosparse( self.histograms[histname] )
+            else: self.histograms[histname] = np.asarray( self.histograms[histname] )
+        self.histcache = {}
+    
+    def compare_dtype_scores( self, dtype=np.float32, histnames=None, masknames=None ):
+        ### compare the scores of the classifiers when evaluated in float64 and in another data type
+        # input arguments:
+        # - dtype: data type to compare with float64 (default: float32)
+        # - histnames: list of histogram names for which to compare (default: all types with a classifier)
+        # - masknames: list of names of masks to select the lumisections to use (default: all)
+        # returns:
+        # - a pandas dataframe with one row per histogram type and the following columns:
+        #   - 'max abs diff', 'max rel diff', 'median rel diff': maximum absolute difference and maximum
+        #     and median relative difference between the scores in dtype and in float64
+        #   - 'rank correlation': correlation between the ranks of the scores in both cases
+        #     (1 means that any threshold on the scores selects the same lumisections)
+        #   - 'memory float64', 'memory dtype': size of the histograms in MB in both cases
+        #   - 'time float64', 'time dtype': evaluation time in seconds in both cases
+        # notes:
+        # - the scores in the 'scores' attribute are not modified.
+        if histnames is None: histnames = [histname for histname in self.histnames if histname in self.classifiers.keys()]
+        rows = []
+        for histname in histnames:
+            if not histname in self.classifiers.keys():
+                raise Exception('ERROR in HistStruct.compare_dtype_scores: requested to evaluate classifier for {}'.format(histname)
+                               +' but no classifier was set for this histogram type.')
+            histograms = self.get_histograms( histname=histname, masknames=masknames )
+            res = {}
+            for label,thisdtype in [('float64',np.float64),('dtype',dtype)]:
+                thishists = histograms.astype(thisdtype, copy=False)
+                starttime = time.time()
+                res[label] = np.asarray(self.classifiers[histname].evaluate( thishists ), dtype=np.float64)
+                res['time '+label] = time.time()-starttime
+                res['memory '+label] = thishists.nbytes/1e6
+            absdiff = np.abs(res['dtype']-res['float64'])
+            reldiff = absdiff/np.maximum(np.abs(res['float64']), np.finfo(np.float64).tiny)
+            ranks = [np.argsort(np.argsort(res[label],kind='stable'),kind='stable') for label in ['float64','dtype']]
+            rankcorr = np.corrcoef(ranks[0],ranks[1])[0,1] if len(absdiff)>1 else 1.
+            rows.append( {'max abs diff': np.max(absdiff,initial=0), 'max rel diff': np.max(reldiff,initial=0),
+                          'median rel diff': np.median(reldiff) if len(reldiff)>0 else 0.,
+                          'rank correlation': rankcorr,
+                          'memory float64': res['memory float64'], 'memory dtype': res['memory dtype'],
+                          'time float64': res['time float64'], 'time dtype': res['time dtype']} )
+        return pd.DataFrame( rows, index=histnames )
+    
+    def get_stream_buffer( self, key, arr, nrows, fillvalue=None ):
+        ### get a view of a given length on a pre-allocated buffer, of which the first rows hold a given array
+        # mostly for internal use (see stream_lumisections).
+        # the buffer is (re-)allocated with twice the requested length if it is too small,
+        # or if arr is not a view on it (e.g. the first time, or after arr was replaced),
+        # so that appending rows takes constant time on average.
+        # rows that are newly allocated are filled with fillvalue (if not None).
+        buf = self.streambuffers.get(key)
+        if( buf is None or arr.base is not buf or len(buf)<nrows 
+            or buf.shape[1:]!=arr.shape[1:] or buf.dtype!=arr.dtype ):
+            buf = np.empty( (2*nrows,)+arr.shape[1:], dtype=arr.dtype )
+            buf[:len(arr)] = arr
+            if fillvalue is not None: buf[len(arr):] = fillvalue
+            self.streambuffers[key] = buf
+        return buf[:nrows]
+    
+    def stream_lumisections( self, runnbs, lsnbs, histograms, nentries=None, 
+                             fitter=None, fithistnames=None, threshold=None, arrivaltimes=None ):
+        ### append new lumisections to the HistStruct and score only these (e.g. for online monitoring)
+        # input arguments:
+        # - runnbs: a 1D list or array containing the run number per new lumisection
+        # - lsnbs: a 1D list or array containing the lumisection number per new lumisection
+        # - histograms: dict matching each histogram name in the HistStruct to a numpy array
+        #   of shape (number of new lumisections,<shape of a histogram>), preprocessed in the same way
+        #   as the histograms already present (if the HistStruct is empty, the keys define the histogram names)
+        # - nentries: dict matching histogram names to 1D arrays with the number of entries per new histogram
+        #   (default: zero for all new histograms, see add_histograms)
+        # - fitter: a CloudFitter fitted on the scores (e.g. as returned by fit_scores), used to fuse the scores
+        #   of the different histogram types into one log-probability per lumisection (default: no fusion)
+        # - fithistnames: list of histogram names in the same order as used for fitting
+        #   (default: all histogram types with scores, in the order of the 'histnames' attribute, as in fit_scores)
+        # - threshold: lumisections with a fused log-probability below this value are flagged
+        # - arrivaltimes: 1D list or array with the time (as given by time.time()) at which each new lumisection
+        #   became available, used to calculate the latency (default: the time of the call for all of them)
+        # returns:
+        # - a dict with the following entries, each with one element per new lumisection:
+        #   - 'runnbs' and 'lsnbs': run and lumisection numbers
+        #   - 'scores': dict matching histogram names to the scores of their classifier
+        #   - 'logpdf': fused log-probability (None if no fitter is given)
+        #   - 'flags': booleans whether the lumisection is flagged (None if no fitter or threshold is given)
+        #   - 'latency': time in seconds between the arrival of each lumisection (see arrivaltimes)
+        #     and the moment its results were available
+        # notes:
+        # - the new lumisections must come after the ones already present (in run and lumisection number),
+        #   so that the HistStruct stays ordered in time.
+        # - all per-lumisection arrays are kept in buffers with spare capacity, so that appending
+        #   a few lumisections at a time does not copy the full arrays each time (amortized constant time).
+        #   masks are extended with False for the new lumisections, and lsdata with nan for floats,
+        #   -1 for signed integers, 0 for unsigned integers, False for booleans, empty strings for strings
+        #   and None for other objects.
+        # - only the classifiers of the new histograms are evaluated and the scores are appended;
+        #   for histogram types with a classifier but without scores yet, the scores of the lumisections
+        #   that were already present are set to nan (use evaluate_classifiers to fill them).
+        #   the fingerprints of the appended histogram types are discarded, since computing them would require
+        #   hashing all histograms (so evaluate_classifiers re-evaluates them if called afterwards).
+        # - the number of lumisections passed at once can be tuned to trade latency for throughput.
+        starttime = time.time()
+        runnbs = np.array(runnbs).astype(int)
+        lsnbs = np.array(lsnbs).astype(int)
+        nnew = len(runnbs)
+        nold = len(self.runnbs)
+        # check the input
+        if len(self.histnames)==0: histnames = list(histograms.keys())
+        else: histnames = self.histnames
+        if set(histograms.keys())!=set(histnames):
+            raise Exception('ERROR in HistStruct.stream_lumisections: histogram names {}'.format(sorted(histograms.keys()))
+                           +' do not correspond to the histogram names in the HistStruct {}.'.format(sorted(histnames)))
+        for histname in histnames:
+            if len(histograms[histname])!=nnew or len(lsnbs)!=nnew:
+                raise Exception('ERROR in HistStruct.stream_lumisections: number of histograms for {}'.format(histname)
+                               +' and number of run/lumi numbers are not consistent.')
+            if histname in self.histnames and not isinstance(self.histograms[histname],np.ndarray):
+                raise Exception('ERROR in HistStruct.stream_lumisections: histograms of type {}'.format(histname)
+                               +' are not a numpy array (e.g. added from a RunStore), appending is not supported.')
+        if arrivaltimes is None: arrivaltimes = np.full( nnew, starttime )
+        arrivaltimes = np.asarray(arrivaltimes, dtype=float)
+        if len(arrivaltimes)!=nnew:
+            raise Exception('ERROR in HistStruct.stream_lumisections: number of arrival times ({})'.format(len(arrivaltimes))
+                           +' does not correspond to the number of new lumisections ({}).'.format(nnew))
+        if( (np.diff(runnbs)<0) | ((np.diff(runnbs)==0) & (np.diff(lsnbs)<=0)) ).any():
+            raise Exception('ERROR in HistStruct.stream_lumisections: new lumisections are not ordered in time.')
+        if( nold>0 and nnew>0 and (runnbs[0]<self.runnbs[-1] 
+            or (runnbs[0]==self.runnbs[-1] and lsnbs[0]<=self.lsnbs[-1])) ):
+            raise Exception('ERROR in HistStruct.stream_lumisections: new lumisections must come after'
+                           +' run {}, lumisection {}.'.format(self.runnbs[-1],self.lsnbs[-1]))
+        if fitter is not None:
+            scorednames = [histname for histname in histnames 
+                           if histname in self.scores.keys() or histname in self.classifiers.keys()]
+            if fithistnames is None: fithistnames = scorednames
+            for histname in fithistnames:
+                if histname not in scorednames:
+                    raise Exception('ERROR in HistStruct.stream_lumisections: requested to fuse the scores for {}'.format(histname)
+                                   +' but no scores are available for this histogram type.')
+            if hasattr(fitter,'ndims') and fitter.ndims!=len(fithistnames):
+                raise Exception('ERROR in HistStruct.stream_lumisections: fitter has {} dimensions'.format(fitter.ndims)
+                               +' while scores for {} histogram types ({}) are given.'.format(len(fithistnames),fithistnames))
+        # append the new lumisections
+        nrows = nold+nnew
+        if len(self.histnames)==0:
+            for histname in histnames:
+                self.histnames.append(histname)
+                self.histograms[histname] = np.asarray(histograms[histname], dtype=self.dtype)[:0]
+                self.nentries[histname] = np.zeros(0)
+            self.runnbs = runnbs[:0]
+            self.lsnbs = lsnbs[:0]
+        self.runnbs = self.get_stream_buffer( 'runnbs', np.asarray(self.runnbs), nrows )
+        self.runnbs[nold:] = runnbs
+        self.lsnbs = self.get_stream_buffer( 'lsnbs', np.asarray(self.lsnbs), nrows )
+        self.lsnbs[nold:] = lsnbs
+        for histname in histnames:
+            self.histograms[histname] = self.get_stream_buffer( ('histograms',histname), 
+                                                                self.histograms[histname], nrows )
+            self.histograms[histname][nold:] = histograms[histname]
+            self.nentries[histname] = self.get_stream_buffer( ('nentries',histname), 
+                                                              np.asarray(self.nentries[histname]), nrows )
+            self.nentries[histname][nold:] = 0 if nentries is None else nentries[histname]
+            self.fingerprints.pop( histname, None )
+        for name in self.masks.keys():
+            self.masks[name] = self.get_stream_buffer( ('masks',name), self.masks[name], (nrows+7)//8, fillvalue=0 )
+        lsdatafillvalues = {'f': np.nan, 'c': np.nan, 'i': -1, 'u': 0, 'b': False, 'U': '', 'S': b'',
+                            'M': np.datetime64('NaT'), 'm': np.timedelta64('NaT')}
+        for name in self.lsdata.keys():
+            # (object arrays are filled with None by np.empty)
+            fillvalue = lsdatafillvalues.get( self.lsdata[name].dtype.kind, None )
+            self.lsdata[name] = self.get_stream_buffer( ('lsdata',name), self.lsdata[name], nrows, fillvalue=fillvalue )
+        self.maskcache = {}
+        self.histcache = {}
+        # evaluate the classifiers on the new histograms only
+        res = {'runnbs': runnbs, 'lsnbs': lsnbs, 'scores': {}, 'logpdf': None, 'flags': None}
+        for histname in self.histnames:
+            if histname not in self.scores.keys() and histname not in self.classifiers.keys(): continue
+            if histname not in self.scores.keys(): self.scores[histname] = np.full( nold, np.nan )
+            self.scores[histname] = self.get_stream_buffer( ('scores',histname), 
+                                                            self.scores[histname], nrows, fillvalue=np.nan )
+            if histname in self.classifiers.keys():
+                scores = self.classifiers[histname].evaluate( self.histograms[histname][nold:] )
+                self.scores[histname][nold:] = scores
+            res['scores'][histname] = self.scores[histname][nold:].copy()
+        # fuse the scores
+        if fitter is not None:
+            points = np.stack([res['scores'][histname] for histname in fithistnames], axis=1)
+            res['logpdf'] = fitter.logpdf( points )
+            if threshold is not None: res['flags'] = (res['logpdf']<threshold)
+        res['latency'] = time.time()-arrivaltimes
+        return res
+    
     def plot_histograms( self, histnames=None, masknames=None, colorlist=[], labellist=[], transparencylist=[] ):
         ### plot the histograms in a HistStruct, optionally after msking
         # note: so far only for 1D hsitograms.
@@ -408,6 +1266,8 @@ class HistStruct(object):
         # initializations
         ncols = min(4,len(histnames))
         nrows = int(math.ceil(len(histnames)/ncols))
+        import matplotlib.pyplot as plt
+        import plot_utils as pu
         fig,axs = plt.subplots(nrows,ncols,figsize=(6*ncols,6*nrows),squeeze=False)
         # loop over all histogram types
         for j,name in enumerate(histnames):
@@ -463,6 +1323,8 @@ class HistStruct(object):
         # initializations
         ncols = min(4,len(histnames))
         nrows = int(math.ceil(len(histnames)/ncols))
+        import matplotlib.pyplot as plt
+        import plot_utils as pu
         fig,axs = plt.subplots(nrows,ncols,figsize=(6*ncols,6*nrows),squeeze=False)
         # loop over all histograms belonging to this lumisection and make the plots
         for j,name in enumerate(histnames):
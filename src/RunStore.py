@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# **RunStore: on-disk storage of histograms partitioned per run, loaded on demand**  
+# 
+# A HistStruct normally keeps all histograms of all lumisections in memory, which is not feasible for e.g. a full year of 2D histograms on a laptop. However, most investigations (e.g. plotting a few runs or training on a few reference runs) only touch a small fraction of the runs.  
+# The RunStore converts the input csv files once into a directory with one numpy file per histogram type and per run, together with an index of the run and lumisection numbers and the number of entries. Afterwards, the histograms of a given run are only read from disk when they are actually needed, and only a limited number of these run blocks are kept in memory (the least recently used ones are dropped).  
+# 
+# A RunStore is usually not used directly, but attached to a HistStruct using HistStruct.add_run_store, after which the HistStruct can be used as usual (masking, plotting, evaluating classifiers, etc.), while only the runs selected by the masks or requested in the calls are loaded.  
+# Note that operations that need all histograms at once (e.g. get_histograms without masks) still load all runs; use HistStruct.evaluate_classifiers with the chunksize argument to evaluate classifiers with bounded memory.
+
+
+
+### imports
+
+# external modules
+import os
+import sys
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+import numpy as np
+
+# local modules
+sys.path.append('../utils')
+import hist_utils as hu
+
+
+
+
+class RunStore(object):
+    ### on-disk storage of histograms partitioned per run, with a bounded in-memory cache of loaded runs
+    # the store directory contains an index file (index.json and index.npz) and one subdirectory per histogram type,
+    # with a .npy file per run containing the histograms of that run sorted by lumisection number.
+    # all histogram types are required to have the same run and lumisection numbers (as in a HistStruct).
+
+    def __init__( self, storedir, maxblocks=100 ):
+        ### initializer, opening an existing store (see RunStore.write to create one)
+        # input arguments:
+        # - storedir: directory of the store
+        # - maxblocks: maximum number of run blocks (i.e. the histograms of one type for one run) to keep in memory
+        # the following attributes are read from the index:
+        # - histnames: list of histogram names
+        # - runnbs, lsnbs: 1D numpy arrays of run and lumisection numbers (sorted by run and lumisection)
+        # - nentries: dict mapping histogram names to 1D numpy arrays of number of entries per histogram
+        # - shapes: dict mapping histogram names to the shape of a single histogram
+        # - dtypes: dict mapping histogram names to the data type of the histograms
+        # - fingerprints: dict mapping histogram names to a hash of their histograms
+        # - runs, runstarts, runstops: unique run numbers and for each of them the first and last+1 index in runnbs
+        self.storedir = storedir
+        self.maxblocks = maxblocks
+        with open(os.path.join(storedir,'index.json'),'r') as f:
+            meta = json.load(f)
+        self.histnames = meta['histnames']
+        self.shapes = dict([(histname,tuple(shape)) for histname,shape in zip(self.histnames,meta['shapes'])])
+        self.dtypes = dict([(histname,np.dtype(dtype)) for histname,dtype in zip(self.histnames,meta['dtypes'])])
+        self.fingerprints = dict(zip(self.histnames,meta['fingerprints']))
+        index = np.load(os.path.join(storedir,'index.npz'))
+        self.runnbs = index['runnbs']
+        self.lsnbs = index['lsnbs']
+        self.nentries = dict([(histname,index['nentries_{}'.format(i)]) for i,histname in enumerate(self.histnames)])
+        (self.runs,self.runstarts) = np.unique(self.runnbs,return_index=True)
+        self.runstops = np.append(self.runstarts[1:],len(self.runnbs))
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__( self ):
+        ### support for pickling (e.g. when saving a HistStruct): the loaded run blocks and the lock are not stored
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        state.pop('lock')
+        return state
+
+    def __setstate__( self, state ):
+        ### support for unpickling
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_block_path( storedir, histindex, runnb ):
+        ### get the path to the file containing the histograms of a given type and run
+        # mostly for internal use.
+        return os.path.join( storedir, 'hist{}'.format(histindex), '{}.npy'.format(runnb) )
+
+    @staticmethod
+    def write( storedir, csvfiles, histnames=None, cropslices=None, donormalize=True, rebinningfactor=None,
+               dtype=float, chunksize=10000, overwrite=False ):
+        ### create a store from one or more csv files
+        # input arguments:
+        # - storedir: directory where to create the store
+        # - csvfiles: list of paths to csv files (e.g. the per-type files made with csv_utils.write_skimmed_csv)
+        # - histnames: list of histogram names to store (default: all names found in the csv files)
+        # - cropslices, donormalize, rebinningfactor: preprocessing options, see hist_utils.preparedatafromdf
+        #   (same defaults as HistStruct.add_dataframe)
+        # - dtype: data type in which to store the histograms (default: float64), e.g. np.float32 to halve the size
+        # - chunksize: number of csv rows to read and process at once
+        # - overwrite: boolean whether to remove an existing store in storedir
+        # returns:
+        # - a RunStore object opened on the new store
+        # notes:
+        # - the csv files are read in chunks, and the histograms of each chunk are written to disk immediately,
+        #   so the full data never needs to fit in memory.
+        #   at the end, the pieces of each run are merged, which only requires memory for one run at a time.
+        if os.path.exists(storedir):
+            if not overwrite:
+                raise Exception('ERROR in RunStore.write: directory {} already exists;'.format(storedir)
+                               +' use overwrite=True to replace it.')
+            shutil.rmtree(storedir)
+        tmpdir = os.path.join(storedir,'tmp')
+        os.makedirs(tmpdir)
+        # read the csv files in chunks and write the preprocessed histograms per type, run and chunk
+        foundhistnames = []
+        pieces = {}
+        npieces = 0
+        for csvfile in csvfiles:
+            for df in pd.read_csv(csvfile, chunksize=chunksize):
+                for histname in df['hname'].unique():
+                    if histnames is not None and histname not in histnames: continue
+                    if histname not in foundhistnames: foundhistnames.append(histname)
+                    thisdf = df[df['hname']==histname].reset_index(drop=True)
+                    nentries = np.array(thisdf['entries'])
+                    (hists,runnbs,lsnbs) = hu.preparedatafromdf(thisdf,returnrunls=True,cropslices=cropslices,
+                                                                donormalize=donormalize,rebinningfactor=rebinningfactor,
+                                                                dtype=dtype)
+                    for runnb in np.unique(runnbs):
+                        sel = (runnbs==runnb)
+                        path = os.path.join(tmpdir,'{}.npz'.format(npieces))
+                        np.savez(path, hists=hists[sel], lsnbs=lsnbs[sel], nentries=nentries[sel])
+                        pieces.setdefault((histname,int(runnb)),[]).append(path)
+                        npieces += 1
+        if histnames is None: histnames = foundhistnames
+        for histname in histnames:
+            if histname not in foundhistnames:
+                raise Exception('ERROR in RunStore.write: histogram name {} was not found in the csv files.'.format(histname))
+        # merge the pieces per type and run, and build the index
+        shapes = []
+        dtypes = []
+        fingerprints = []
+        index = {}
+        for i,histname in enumerate(histnames):
+            os.makedirs(os.path.join(storedir,'hist{}'.format(i)))
+            runs = sorted([runnb for (name,runnb) in pieces.keys() if name==histname])
+            thisrunnbs = []
+            thislsnbs = []
+            thisnentries = []
+            fingerprint = hashlib.sha1()
+            for runnb in runs:
+                data = [np.load(path) for path in pieces[(histname,runnb)]]
+                lsnbs = np.concatenate([d['lsnbs'] for d in data])
+                order = np.argsort(lsnbs,kind='stable')
+                hists = np.concatenate([d['hists'] for d in data])[order]
+                np.save(RunStore.get_block_path(storedir,i,runnb), hists)
+                fingerprint.update( np.ascontiguousarray(hists).tobytes() )
+                thisrunnbs.append( np.full(len(lsnbs),runnb) )
+                thislsnbs.append( lsnbs[order] )
+                thisnentries.append( np.concatenate([d['nentries'] for d in data])[order] )
+                for path in pieces[(histname,runnb)]: os.remove(path)
+            thisrunnbs = np.concatenate(thisrunnbs).astype(int)
+            thislsnbs = np.concatenate(thislsnbs).astype(int)
+            # check consistency in run and lumisection numbers
+            if 'runnbs' in index.keys():
+                if( len(thisrunnbs)!=len(index['runnbs']) or not ( (thisrunnbs==index['runnbs']).all()
+                    and (thislsnbs==index['lsnbs']).all() ) ):
+                    raise Exception('ERROR in RunStore.write: run/lumi numbers of {}'.format(histname)
+                                   +' are not consistent with the other histogram types.')
+            index['runnbs'] = thisrunnbs
+            index['lsnbs'] = thislsnbs
+            index['nentries_{}'.format(i)] = np.concatenate(thisnentries)
+            shapes.append( list(hists.shape[1:]) )
+            dtypes.append( hists.dtype.str )
+            fingerprint.update( str((len(thisrunnbs),)+tuple(hists.shape[1:])+(hists.dtype.str,)).encode() )
+            fingerprints.append( fingerprint.hexdigest() )
+        shutil.rmtree(tmpdir)
+        np.savez(os.path.join(storedir,'index.npz'), **index)
+        meta = {'histnames': list(histnames), 'shapes': shapes, 'dtypes': dtypes, 'fingerprints': fingerprints}
+        with open(os.path.join(storedir,'index.json'),'w') as f:
+            json.dump(meta,f)
+        return RunStore(storedir)
+
+    def get_block( self, histname, runnb ):
+        ### get the histograms of a given type and run
+        # input arguments:
+        # - histname: name of the histogram type
+        # - runnb: run number
+        # returns:
+        # - a read-only numpy array of shape (number of lumisections in the run,<shape of a histogram>)
+        # notes:
+        # - the block is read from disk if it is not in memory yet;
+        #   if more than maxblocks blocks are in memory, the least recently used ones are dropped.
+        key = (histname,int(runnb))
+        with self.lock:
+            if key in self.cache.keys():
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        block = np.load( self.get_block_path(self.storedir,self.histnames.index(histname),int(runnb)) )
+        block.setflags(write=False)
+        with self.lock:
+            self.cache[key] = block
+            self.cache.move_to_end(key)
+            while len(self.cache)>self.maxblocks: self.cache.popitem(last=False)
+        return block
+
+    def get_rows( self, histname, rows ):
+        ### get the histograms of a given type for given indices in runnbs/lsnbs
+        # input arguments:
+        # - histname: name of the histogram type
+        # - rows: 1D numpy array of integer indices (any order, duplicates allowed)
+        # returns:
+        # - a numpy array of shape (len(rows),<shape of a histogram>)
+        # notes:
+        # - only the runs containing at least one of the requested rows are loaded.
+        rows = np.asarray(rows,dtype=int)
+        res = np.empty((len(rows),)+self.shapes[histname], dtype=self.dtypes[histname])
+        if len(rows)==0: return res
+        runindices = np.searchsorted(self.runstops,rows,side='right')
+        for runindex in np.unique(runindices):
+            sel = np.nonzero(runindices==runindex)[0]
+            block = self.get_block( histname, self.runs[runindex] )
+            res[sel] = block[rows[sel]-self.runstarts[runindex]]
+        return res
+
+    def get_array( self, histname ):
+        ### get a numpy-like array of the histograms of a given type, that loads the runs on demand
+        # see RunStoreArray for more details.
+        if histname not in self.histnames:
+            raise Exception('ERROR in RunStore.get_array: histogram name {} is not in the store.'.format(histname))
+        return RunStoreArray( self, histname )
+
+    def clear_cache( self ):
+        ### drop all run blocks from memory
+        with self.lock: self.cache = OrderedDict()
+
+
+
+
+class RunStoreArray(object):
+    ### read-only numpy-like array of the histograms of a given type in a RunStore
+    # supports len, shape, ndim, dtype and indexing with integers, slices, boolean masks and integer arrays
+    # along the first axis (optionally followed by indices for the other axes),
+    # which is all a HistStruct needs; each indexing operation only loads the runs it needs and returns a numpy array.
+    # conversion to a full numpy array (e.g. with np.asarray) loads all runs.
+
+    def __init__( self, store, histname ):
+        ### initializer
+        # input arguments:
+        # - store: a RunStore object
+        # - histname: name of the histogram type
+        self.store = store
+        self.histname = histname
+        self.shape = (len(store.runnbs),)+store.shapes[histname]
+        self.ndim = len(self.shape)
+        self.dtype = store.dtypes[histname]
+
+    def __len__( self ):
+        return self.shape[0]
+
+    def __getitem__( self, key ):
+        ### get the histograms for a given index, slice, mask or list of indices
+        rest = None
+        if isinstance(key,tuple):
+            rest = (slice(None),)+key[1:]
+            key = key[0]
+        if isinstance(key,(int,np.integer)):
+            row = key+len(self) if key<0 else key
+            if row<0 or row>=len(self):
+                raise IndexError('ERROR in RunStoreArray.__getitem__: index {} is out of range.'.format(key))
+            res = self.store.get_rows( self.histname, [row] )[0]
+            if rest is not None: res = res[rest[1:]]
+            return res
+        if isinstance(key,slice): rows = np.arange(len(self))[key]
+        else:
+            key = np.asarray(key)
+            if key.dtype==bool:
+                if len(key)!=len(self):
+                    raise IndexError('ERROR in RunStoreArray.__getitem__: boolean mask has length {}'.format(len(key))
+                                    +' while the array has length {}.'.format(len(self)))
+                rows = np.nonzero(key)[0]
+            else:
+                rows = np.where(key<0,key+len(self),key)
+                if ((rows<0) | (rows>=len(self))).any():
+                    raise IndexError('ERROR in RunStoreArray.__getitem__: indices {}'.format(key[(rows<0) | (rows>=len(self))])
+                                    +' are out of range.')
+        res = self.store.get_rows( self.histname, rows )
+        if rest is not None: res = res[rest]
+        return res
+
+    def __array__( self, dtype=None, copy=None ):
+        ### convert to a numpy array (loads all runs)
+        res = self.store.get_rows( self.histname, np.arange(len(self)) )
+        if dtype is not None: res = res.astype(dtype)
+        return res
+
+    def copy( self ):
+        ### return a numpy array with all histograms (loads all runs)
+        return np.asarray(self)
+
+    def get_fingerprint( self ):
+        ### return the hash of the histograms as computed when the store was written
+        # (used by HistStruct.get_fingerprint, to avoid loading all runs)
+        return self.store.fingerprints[self.histname]
+
+
+
+
+
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# **ScoreCache: persistent storage of classifier scores on disk**  
+# 
+# Evaluating the classifiers on all histograms in a HistStruct can take a long time, and the scores are lost whenever the HistStruct is rebuilt (e.g. when re-running a notebook). The ScoreCache stores the scores on disk, keyed by the histogram type, a fingerprint of the histograms and a fingerprint of the classifier, so that they can be reused as long as neither the data nor the classifier has changed.  
+# 
+# A ScoreCache is usually not used directly, but attached to a HistStruct using HistStruct.set_score_cache, after which HistStruct.evaluate_classifier (and evaluate_classifiers) automatically consult and populate it.  
+# The total size of the cache on disk is bounded; when the bound is exceeded, the least recently used entries are removed.
+
+
+
+### imports
+
+# external modules
+import os
+import sys
+import hashlib
+import numpy as np
+
+# local modules
+sys.path.append('../utils')
+
+
+
+
+class ScoreCache(object):
+    ### persistent storage of classifier scores on disk
+    # each entry is a .npy file in the cache directory, named after a hash of
+    # the histogram name, the data fingerprint and the classifier fingerprint
+    # (see HistStruct.get_fingerprint and HistogramClassifier.get_fingerprint).
+    # the modification time of the files is used to keep track of the least recently used entries.
+    
+    def __init__( self, cachedir, maxsize=1e9 ):
+        ### initializer
+        # input arguments:
+        # - cachedir: directory where to store the cached scores (created if it does not exist yet)
+        # - maxsize: maximum total size of the cache in bytes (default: 1 GB)
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        if not os.path.exists(self.cachedir): os.makedirs(self.cachedir)
+            
+    def get_path( self, histname, fingerprint ):
+        ### get the path to the file corresponding to a given histogram name and fingerprint
+        # mostly for internal use.
+        # input arguments:
+        # - histname: name of the histogram type
+        # - fingerprint: tuple of (data fingerprint, classifier fingerprint), see HistStruct.get_fingerprint
+        key = hashlib.sha1( repr((histname,)+tuple(fingerprint)).encode() ).hexdigest()
+        return os.path.join( self.cachedir, key+'.npy' )
+    
+    def get( self, histname, fingerprint ):
+        ### retrieve scores from the cache
+        # input arguments:
+        # - histname: name of the histogram type
+        # - fingerprint: tuple of (data fingerprint, classifier fingerprint), see HistStruct.get_fingerprint
+        # returns:
+        # - a numpy array of scores, or None if no scores are present in the cache for this combination
+        path = self.get_path( histname, fingerprint )
+        if not os.path.exists(path): return None
+        try: scores = np.load(path, allow_pickle=False)
+        except (OSError,ValueError):
+            # (corrupt or partially written file, treat as a miss)
+            return None
+        # mark as recently used
+        os.utime(path)
+        return scores
+    
+    def put( self, histname, fingerprint, scores ):
+        ### add scores to the cache
+        # input arguments:
+        # - histname: name of the histogram type
+        # - fingerprint: tuple of (data fingerprint, classifier fingerprint), see HistStruct.get_fingerprint
+        # - scores: a numpy array of scores
+        # notes:
+        # - the file is first written under a temporary name and then renamed,
+        #   so that an interrupted write never leaves a corrupt entry behind.
+        # - after writing, the least recently used entries are removed if the cache exceeds its maximum size.
+        path = self.get_path( histname, fingerprint )
+        temppath = path.replace('.npy','.tmp{}.npy'.format(os.getpid()))
+        np.save( temppath, np.asarray(scores), allow_pickle=False )
+        os.replace( temppath, path )
+        self.evict()
+        
+    def get_entries( self ):
+        ### get a list of tuples (path, size in bytes, last use time) for all entries in the cache
+        # mostly for internal use.
+        entries = []
+        for f in os.listdir(self.cachedir):
+            if( os.path.splitext(f)[1]!='.npy' or '.tmp' in f ): continue
+            path = os.path.join(self.cachedir,f)
+            try: stat = os.stat(path)
+            except OSError: continue
+            entries.append( (path,stat.st_size,stat.st_mtime) )
+        return entries
+    
+    def get_size( self ):
+        ### get the total size of the cache in bytes
+        return sum([entry[1] for entry in self.get_entries()])
+    
+    def evict( self ):
+        ### remove the least recently used entries until the cache is smaller than its maximum size
+        entries = sorted( self.get_entries(), key=lambda entry: entry[2] )
+        totalsize = sum([entry[1] for entry in entries])
+        for (path,size,_) in entries:
+            if totalsize<=self.maxsize: break
+            try: os.remove(path)
+            except OSError: continue
+            totalsize -= size
+            
+    def clear( self ):
+        ### remove all entries from the cache
+        for (path,_,_) in self.get_entries(): os.remove(path)
+
+
+
+
+
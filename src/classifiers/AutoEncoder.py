@@ -13,9 +13,8 @@
 
 # external modules
 import sys
+import hashlib
 import numpy as np
-import tensorflow
-import importlib
 
 # local modules
 from HistogramClassifier import HistogramClassifier
@@ -39,6 +38,8 @@ class AutoEncoder(HistogramClassifier):
         #       but this is not yet supported currently
         
         super( AutoEncoder,self ).__init__()
+        # (tensorflow is only imported here, so that importing this module stays cheap)
+        import tensorflow
         if model is None:
             raise NotYetImplementedError('ERROR in AutoEncoder.__init__: init must take a fully trained and ready tensorflow model as input (for now)')
         if not isinstance( model, tensorflow.keras.Model ):
@@ -56,6 +57,15 @@ class AutoEncoder(HistogramClassifier):
     def reconstruct( self, histograms ):
         ### return the autoencoder reconstruction of a set of histograms
         return self.model.predict( histograms )
+    
+    def get_fingerprint( self ):
+        ### return a string that identifies the current state of the classifier
+        # overrides the default of HistogramClassifier, since tensorflow models cannot be pickled;
+        # instead the model architecture and weights are hashed.
+        fingerprint = hashlib.sha1( self.model.to_json().encode() )
+        for weights in self.model.get_weights():
+            fingerprint.update( np.ascontiguousarray(weights).tobytes() )
+        return fingerprint.hexdigest()
 
 
 
@@ -22,12 +22,68 @@
 
 # external modules
 import sys
+import re
+import hashlib
 import numpy as np
 from abc import ABC,abstractmethod
-import importlib
 
 # local modules
 sys.path.append('../../utils')
+from sparse_hist_utils import SparseHists
+
+
+
+
+def update_fingerprint( fingerprint, obj, visited=None ):
+    ### recursively add the content of an object to a hashlib hash object
+    # mostly for internal use in HistogramClassifier.get_fingerprint.
+    # input arguments:
+    # - fingerprint: a hashlib hash object (e.g. hashlib.sha1()), which is updated in place
+    # - obj: any object; numpy arrays, containers and objects with a __dict__ (e.g. sklearn models) are traversed,
+    #   numpy random number generators (e.g. used as random_state) are identified by their state,
+    #   functions are identified by their name, and all other objects by their repr.
+    # - visited: set of ids of objects already traversed (to protect against cyclic references)
+    # notes:
+    # - contrary to hashing the pickled object, the result does not depend on memory addresses
+    #   or on how objects are shared internally, so it is the same after saving and reloading the object.
+    # - objects whose repr contains a memory address (e.g. '<object at 0x...>') are only identified by their type
+    #   (and a warning is printed), since their repr would change the fingerprint at every reload.
+    if visited is None: visited = set()
+    if id(obj) in visited: return
+    if isinstance(obj, np.ndarray):
+        fingerprint.update( str((obj.shape,obj.dtype)).encode() )
+        if obj.dtype==object: update_fingerprint( fingerprint, obj.tolist(), visited=visited )
+        else: fingerprint.update( np.ascontiguousarray(obj).tobytes() )
+    elif isinstance(obj, dict):
+        visited.add(id(obj))
+        for key in sorted(obj.keys(), key=str):
+            fingerprint.update( str(key).encode() )
+            update_fingerprint( fingerprint, obj[key], visited=visited )
+    elif isinstance(obj, (list,tuple)):
+        visited.add(id(obj))
+        for el in obj: update_fingerprint( fingerprint, el, visited=visited )
+    elif isinstance(obj, np.random.RandomState):
+        fingerprint.update( type(obj).__name__.encode() )
+        update_fingerprint( fingerprint, obj.get_state(), visited=visited )
+    elif isinstance(obj, np.random.Generator):
+        fingerprint.update( type(obj).__name__.encode() )
+        update_fingerprint( fingerprint, obj.bit_generator.state, visited=visited )
+    elif isinstance(obj, np.random.BitGenerator):
+        fingerprint.update( type(obj).__name__.encode() )
+        update_fingerprint( fingerprint, obj.state, visited=visited )
+    elif callable(obj) and hasattr(obj,'__qualname__'):
+        fingerprint.update( '{}.{}'.format(getattr(obj,'__module__',''),obj.__qualname__).encode() )
+    elif hasattr(obj,'__dict__'):
+        visited.add(id(obj))
+        fingerprint.update( type(obj).__name__.encode() )
+        update_fingerprint( fingerprint, vars(obj), visited=visited )
+    else:
+        objrepr = repr(obj)
+        if re.search(r' at 0x[0-9a-fA-F]+', objrepr) is not None:
+            print('WARNING in HistogramClassifier.update_fingerprint: object of type {}'.format(type(obj).__name__)
+                  +' has a repr depending on its memory address and is left out of the fingerprint.')
+            objrepr = type(obj).__name__
+        fingerprint.update( objrepr.encode() )
 
 
 
@@ -44,6 +100,9 @@ class HistogramClassifier(ABC):
     # - make sure all functions with @abstractmethod are implemented in your class
     # - it is recommended to start each overriding function with a call to super(), but this is not strictly necessary
     # see also the existing examples!
+    # classifiers that can also evaluate SparseHists objects (see sparse_hist_utils.py) should set supports_sparse to True.
+    
+    supports_sparse = False
     
     @abstractmethod
     def __init__( self ):
@@ -57,15 +116,29 @@ class HistogramClassifier(ABC):
         # this is an @abstractmethod and must be overridden in any concrete deriving class!
         # input arguments:
         # - histograms: numpy array of shape (nhists,nbins) or (nhists,nybins,nxbins).
+        #   (or a SparseHists object for classifiers that set supports_sparse to True)
         # output: 1D numpy array of shape (nhists), one number per histogram.
         
         # check input args
-        if not isinstance( histograms, np.ndarray ):
+        if isinstance( histograms, SparseHists ) and not self.supports_sparse:
+            raise Exception('ERROR in HistogramClassifier.evaluate: input is a SparseHists object,'
+                           +' which is not supported by {}; convert it to a numpy array first.'.format(type(self).__name__))
+        if not isinstance( histograms, (np.ndarray,SparseHists) ):
             raise Exception('ERROR in HistogramClassifier.evaluate: input is of type {}'.format(type(histograms))
                            +' while a numpy array is expected.')
         if( len(histograms.shape)!=2 and len(histograms.shape)!=3 ):
             raise Exception('ERROR in HistogramClassifier.evaluate: input array has shape {}'.format(histograms.shape)
                             +' while a 2D or 3D array is expected.')
+            
+    def get_fingerprint( self ):
+        ### return a string that identifies the current state of the classifier
+        # used to detect whether a classifier has changed since its scores were last computed
+        # (see e.g. HistStruct.evaluate_classifiers).
+        # the default implementation hashes all attributes of the classifier (see update_fingerprint);
+        # classifiers wrapping objects that cannot be hashed this way (e.g. a tensorflow model) should override this method.
+        fingerprint = hashlib.sha1( type(self).__name__.encode() )
+        update_fingerprint( fingerprint, vars(self) )
+        return fingerprint.hexdigest()
 
 
 
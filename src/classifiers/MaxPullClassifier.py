@@ -17,6 +17,7 @@ import numpy as np
 # local modules
 from HistogramClassifier import HistogramClassifier
 sys.path.append('../../utils')
+import sparse_hist_utils as shu
 
 
 
@@ -53,6 +54,8 @@ class MaxPullClassifier(HistogramClassifier):
     # specifically intended for 2D histograms, but should in principle work for 1D as well.
     # see static function pull (above) for definition of bin-per-bin pull and other notes.
     
+    supports_sparse = True
+    
     def __init__( self, refhist, n=1 ):
         ### initializer from a reference histogram
         # input arguments:
@@ -64,10 +67,28 @@ class MaxPullClassifier(HistogramClassifier):
         
     def evaluate( self, histograms ):
         ### classify the histograms based on their max bin-per-bin pull (in absolute value) with respect to a reference histogram
+        # notes:
+        # - equivalent to applying maxabspull (see above) on each histogram,
+        #   but for many histograms at once (in chunks of about 1M bins).
+        # - the pulls are computed in the data type of the histograms for floating point types (e.g. float32),
+        #   else in float64; the returned maximum pulls are always float64.
+        # - histograms can also be a SparseHists object (see sparse_hist_utils.py),
+        #   in which case only the non-zero bins are processed (see sparse_hist_utils.maxabspull_sparse).
         super( MaxPullClassifier,self).evaluate( histograms )
+        if isinstance(histograms,shu.SparseHists): return shu.maxabspull_sparse( histograms, self.refhist, n=self.n )
+        dtype = histograms.dtype if histograms.dtype.kind=='f' else np.float64
+        refhist = np.asarray(self.refhist, dtype=dtype).flatten()
+        denom = np.power(refhist,1/2)
+        denom = np.power( np.where( denom<1, 1, denom ), 1/2 )
+        refsum = np.sum(refhist)
         maxpulls = np.zeros(len(histograms))
-        for i,hist in enumerate(histograms):
-            maxpulls[i] = maxabspull( hist, self.refhist, n=self.n )
+        chunksize = max(1, 1000000//len(refhist))
+        for start in range(0,len(histograms),chunksize):
+            hists = np.asarray(histograms[start:start+chunksize], dtype=dtype).reshape(-1,len(refhist))
+            norm = refsum/np.sum(hists,axis=1,keepdims=True)
+            abspull = np.abs( (norm*hists-refhist)/denom )
+            largest = np.partition( abspull, -self.n, axis=1 )[:,-self.n:]
+            maxpulls[start:start+chunksize] = np.mean(largest,axis=1)
         return maxpulls
     
     def getpull( self, histogram ):
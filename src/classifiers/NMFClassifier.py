@@ -13,12 +13,12 @@
 # external modules
 import sys
 import numpy as np
-from sklearn.decomposition import NMF
 
 # local modules
 from HistogramClassifier import HistogramClassifier
 sys.path.append('../../utils')
 from autoencoder_utils import mseTopNRaw
+import sparse_hist_utils as shu
 
 
 
@@ -28,18 +28,28 @@ class NMFClassifier(HistogramClassifier):
     # specifically intended for 2D histograms, but should in principle work for 1D as well.
     # it is basically a wrapper for a sklearn.decomposition.NMF instance.
     
-    def __init__( self, histograms, ncomponents, nmax ):
+    supports_sparse = True
+    
+    def __init__( self, histograms, ncomponents, nmax, dtype=None ):
         ### initializer from a collection of histograms
         # input arguments:
         # - histograms: a numpy array of shape (nhists,nbins) or (nhists,nybins,nxbins) that will be used to fit a NMF model
+        #   (or a SparseHists object, see sparse_hist_utils.py)
         # - ncomponents: number of NMF components (aka clusters aka basis vectors) to use in the decomposition
         # - nmax: number of largest elements to keep in mean square error calculation
+        # - dtype: data type in which to fit and evaluate the model, either np.float32 or np.float64
+        #   (default: float32 if the histograms are float32, else float64)
         # TODO: add keyword arguments to pass down to sklearn.decomposition.NMF
         
         super( NMFClassifier,self ).__init__()
         self.shape = list(histograms.shape)[1:]
-        if len(histograms.shape)==3:
+        if isinstance(histograms,shu.SparseHists): histograms = histograms.matrix
+        elif len(histograms.shape)==3:
             histograms = histograms.reshape(histograms.shape[0],-1)
+        if dtype is None: dtype = np.float32 if histograms.dtype==np.float32 else np.float64
+        histograms = histograms.astype(dtype, copy=False)
+        # (sklearn is only imported here, so that importing this module stays cheap)
+        from sklearn.decomposition import NMF
         self.NMF = NMF( n_components=ncomponents )
         self.NMF.fit( histograms )
         self.nmax = nmax
@@ -55,10 +65,23 @@ class NMFClassifier(HistogramClassifier):
         ### classify the given histograms based on the MSE with respect to their reconstructed version
         # input arguments:
         # - histograms: numpy array of shape (nhists,nbins) or (nhists,nybins,nxbins)
+        #   (converted to the data type of the model if needed, see initializer)
+        #   histograms can also be a SparseHists object (see sparse_hist_utils.py), in which case the NMF transform
+        #   runs on the sparse matrix, and the reconstruction and mean square error are computed in chunks.
         
         super( NMFClassifier,self ).evaluate( histograms )
+        if isinstance(histograms,shu.SparseHists):
+            matrix = histograms.matrix.astype(self.NMF.components_.dtype, copy=False)
+            weights = self.NMF.transform(matrix)
+            res = np.zeros(len(histograms))
+            chunksize = max(1, 1000000//matrix.shape[1])
+            for start in range(0,len(histograms),chunksize):
+                reco = self.NMF.inverse_transform(weights[start:start+chunksize])
+                res[start:start+chunksize] = mseTopNRaw( matrix[start:start+chunksize].toarray(), reco, n=self.nmax )
+            return res
         if len(histograms.shape)==3:
             histograms = histograms.reshape(histograms.shape[0],-1)
+        histograms = histograms.astype(self.NMF.components_.dtype, copy=False)
         reco = self.NMF.inverse_transform(self.NMF.transform(histograms))
         return mseTopNRaw( histograms, reco, n=self.nmax )
     
@@ -72,11 +95,13 @@ class NMFClassifier(HistogramClassifier):
     def reconstruct( self, histograms ):
         ### return the NMF reconstruction for a given set of histograms
         # input arguments:
-        # - histograms: numpy array of shape (nhists,nbins) or (nhists,nybins,nxbins)
-        if len(histograms.shape)==3:
+        # - histograms: numpy array of shape (nhists,nbins) or (nhists,nybins,nxbins) (or a SparseHists object)
+        if isinstance(histograms,shu.SparseHists): histograms = histograms.matrix
+        elif len(histograms.shape)==3:
             histograms = histograms.reshape(histograms.shape[0],-1)
+        histograms = histograms.astype(self.NMF.components_.dtype, copy=False)
         reco = self.NMF.inverse_transform(self.NMF.transform(histograms))
-        if len(self.shape)==2: reco = reco.reshape(len(histograms),self.shape[0],self.shape[1])
+        if len(self.shape)==2: reco = reco.reshape(histograms.shape[0],self.shape[0],self.shape[1])
         return reco
 
 
@@ -10,8 +10,6 @@
 # external modules
 import sys
 import numpy as np
-import tensorflow
-import importlib
 
 # local modules
 from HistogramClassifier import HistogramClassifier
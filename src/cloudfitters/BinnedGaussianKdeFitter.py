@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# **Class for fitting a gaussian kernel density to a point cloud, using a binned approximation for fast evaluation**
+# 
+# Scalable alternative to GaussianKdeFitter for large point clouds in low dimensions (e.g. the 2D projections of the combined score space, for a full year of lumisections).  
+# The exact scipy.stats.gaussian_kde sums the contributions of all points in the cloud for each point where the pdf is evaluated, i.e. its cost scales as (number of points in the cloud) x (number of evaluated points).  
+# Here the points are first distributed over a regular grid (using linear binning), and the kernel sum is computed on the grid by a single FFT convolution. The pdf at any point is then obtained by interpolation on this grid, so that the cost of evaluation no longer depends on the number of points in the cloud.  
+# The number of grid points per dimension determines the trade-off between accuracy and speed. In the tails of the distribution, where the binned approximation is least accurate, the exact calculation is used instead.  
+# The kernel itself is the same as in GaussianKdeFitter: each gaussian has the covariance matrix of the cloud, scaled by the square of the bandwidth factor.
+
+
+
+### imports
+
+# external modules
+import sys
+import itertools
+import numpy as np
+from scipy.stats import gaussian_kde
+from scipy.signal import fftconvolve
+from scipy.interpolate import RegularGridInterpolator
+
+# local modules
+from CloudFitter import CloudFitter
+sys.path.append('../../utils')
+
+
+
+
+class BinnedGaussianKdeFitter(CloudFitter):
+    ### class for fitting a gaussian kernel density to a point cloud, using a binned approximation for fast evaluation
+    # scalable alternative to GaussianKdeFitter for low dimensions, see the notes in the header of this file.
+    # parameters:
+    # - kernel: scipy.stats.gaussian_kde object, used for the exact calculation in the tails
+    # - cov: covariance matrix of the point cloud
+    # - axes: list of 1D numpy arrays holding the grid coordinates along each dimension
+    # - grid: numpy array of shape (nbins,)*ndims holding the binned pdf
+    # - interpolator: scipy.interpolate.RegularGridInterpolator object on the grid
+    # - threshold: value of the binned pdf below which the exact calculation is used
+    
+    def __init__(self, points, bw_method='scott', nbins=256, cutoff=5, exactfraction=1e-3, maxgridsize=1e8):
+        ### constructor
+        # input arguments:
+        # - points: a np array of shape (npoints,ndims)
+        # - bw_method: method to calculate the bandwidth of the gaussians,
+        #   see https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.gaussian_kde.html
+        # - nbins: number of grid points along each dimension (default: 256)
+        #   note: this determines the trade-off between accuracy and speed;
+        #         the approximation is good as long as the grid spacing is small compared to the bandwidth.
+        # - cutoff: number of bandwidths (i.e. standard deviations of the gaussians) beyond which the kernel is truncated;
+        #   the grid also extends by this amount beyond the range of the points.
+        # - exactfraction: where the binned pdf is below this fraction of its maximum,
+        #   the exact calculation is used (default: 1e-3, use 0 to never use the exact calculation inside the grid)
+        #   note: points outside the grid are always evaluated exactly.
+        # - maxgridsize: maximum total number of grid points, to protect against excessive memory usage in high dimensions
+        super( BinnedGaussianKdeFitter, self ).__init__(points)
+        if nbins**self.ndims > maxgridsize:
+            raise Exception('ERROR in BinnedGaussianKdeFitter.init: a grid of {} points per dimension'.format(nbins)
+                           +' in {} dimensions exceeds the maximum grid size of {};'.format(self.ndims,maxgridsize)
+                           +' use fewer bins or the unbinned GaussianKdeFitter instead.')
+        self.kernel = gaussian_kde(np.transpose(points),bw_method=bw_method)
+        self.cov = np.cov(points,rowvar=False)
+        kcov = np.atleast_2d(self.kernel.covariance)
+        sigma = np.sqrt(np.diag(kcov))
+        # define the grid
+        self.axes = []
+        for dim in range(self.ndims):
+            self.axes.append( np.linspace( np.min(points[:,dim])-cutoff*sigma[dim], 
+                                           np.max(points[:,dim])+cutoff*sigma[dim], num=nbins ) )
+        delta = np.array([axis[1]-axis[0] for axis in self.axes])
+        # linear binning: distribute each point over the surrounding grid points
+        pos = (points-np.array([axis[0] for axis in self.axes]))/delta
+        lowindex = np.clip(np.floor(pos).astype(int),0,nbins-2)
+        frac = pos-lowindex
+        counts = np.zeros((nbins,)*self.ndims)
+        for corner in itertools.product([0,1],repeat=self.ndims):
+            corner = np.array(corner)
+            weights = np.prod(np.where(corner==1,frac,1-frac),axis=1)
+            np.add.at( counts, tuple(np.transpose(lowindex+corner)), weights )
+        # evaluate the (truncated) kernel on the grid offsets
+        nhalf = np.minimum(np.ceil(cutoff*sigma/delta).astype(int),nbins-1)
+        offsets = np.meshgrid(*[np.arange(-n,n+1)*d for n,d in zip(nhalf,delta)], indexing='ij')
+        offsets = np.stack([o.ravel() for o in offsets],axis=1)
+        kinv = np.linalg.inv(kcov)
+        maha = np.sum(np.dot(offsets,kinv)*offsets,axis=1)
+        kvalues = np.exp(-0.5*maha)/np.sqrt(np.linalg.det(2*np.pi*kcov))
+        kvalues = kvalues.reshape(tuple(2*nhalf+1))
+        # convolve and build the interpolator
+        self.grid = np.clip(fftconvolve(counts,kvalues,mode='same')/self.npoints,0,None)
+        self.interpolator = RegularGridInterpolator(tuple(self.axes), self.grid, 
+                                                    bounds_error=False, fill_value=0.)
+        self.threshold = exactfraction*np.max(self.grid)
+        
+    def pdf(self, points):
+        ### get pdf at points
+        super( BinnedGaussianKdeFitter, self ).pdf(points)
+        return np.exp(self.logpdf(points))
+    
+    def logpdf_chunk(self, points):
+        ### get log pdf at points
+        # note: points where the binned pdf is below threshold (e.g. outside the grid) are evaluated exactly
+        dens = self.interpolator(points)
+        exact = (dens<=self.threshold)
+        logdens = np.zeros(len(points))
+        logdens[~exact] = np.log(dens[~exact])
+        if np.any(exact): logdens[exact] = self.kernel.logpdf(np.transpose(points[exact]))
+        return logdens
+
+
+
+
+
@@ -20,7 +20,6 @@
 import sys
 import numpy as np
 from abc import ABC,abstractmethod
-import importlib
 
 # local modules
 sys.path.append('../../utils')
@@ -62,6 +61,141 @@ class CloudFitter(ABC):
             raise Exception('ERROR in CloudFitter.pdf: points must be a 2D numpy array but found shape {}'.format(points.shape))
         if points.shape[1]!=self.ndims:
             raise Exception('ERROR in CloudFitter.pdf: points must have {} dimensions but found {}'.format(self.ndims,points.shape[1]))
+            
+    def logpdf( self, points, chunksize=100000 ):
+        ### evaluate the natural logarithm of the pdf at given points
+        # input arguments:
+        # - points: a 2D numpy array of shape (npoints,ndims)
+        # - chunksize: number of points to evaluate at once (default: 100000),
+        #   in order to limit the size of intermediate arrays when evaluating a very large number of points.
+        #   use None to evaluate all points at once.
+        # output: a 1D array of shape (npoints)
+        # notes:
+        # - the actual calculation for each chunk of points is done in logpdf_chunk.
+        #   the default implementation simply takes the logarithm of the pdf,
+        #   but concrete deriving classes can override it with a faster and numerically more stable calculation in log-space.
+        if not isinstance( points, np.ndarray ):
+            raise Exception('ERROR in CloudFitter.logpdf: points must be a numpy array but found type {}'.format(type(points)))
+        if len(points.shape)!=2:
+            raise Exception('ERROR in CloudFitter.logpdf: points must be a 2D numpy array but found shape {}'.format(points.shape))
+        if points.shape[1]!=self.ndims:
+            raise Exception('ERROR in CloudFitter.logpdf: points must have {} dimensions but found {}'.format(self.ndims,points.shape[1]))
+        npoints = len(points)
+        if( chunksize is None or chunksize>=npoints ): return self.logpdf_chunk( points )
+        res = np.zeros(npoints)
+        for start in range(0,npoints,chunksize):
+            stop = min(start+chunksize,npoints)
+            res[start:stop] = self.logpdf_chunk( points[start:stop] )
+        return res
+    
+    def logpdf_chunk( self, points ):
+        ### evaluate the natural logarithm of the pdf for a single chunk of points
+        # mostly for internal use; call logpdf instead, which performs input checks and splits the points in chunks.
+        # input arguments:
+        # - points: a 2D numpy array of shape (npoints,ndims)
+        # output: a 1D array of shape (npoints)
+        # note: the default implementation simply takes the logarithm of the pdf,
+        #       override it in concrete deriving classes if a direct calculation in log-space is available.
+        return np.log( self.pdf(points) )
+    
+    @staticmethod
+    def get_pairs( ndims ):
+        ### get a list of all pairs of dimensions (i,j) with i<j
+        # input arguments:
+        # - ndims: number of dimensions
+        return [(i,j) for i in range(ndims-1) for j in range(i+1,ndims)]
+    
+    @classmethod
+    def fit_projections( cls, points, dimslist=None, **kwargs ):
+        ### fit this type of CloudFitter to multiple projections of a point cloud at once
+        # input arguments:
+        # - points: 2D numpy array of shape (npoints,ndims)
+        # - dimslist: list of tuples of dimension indices onto which to project, e.g. [(0,1),(0,2),(1,2)]
+        #   (default: all pairs of dimensions, see get_pairs)
+        # - kwargs: additional keyword arguments passed to the constructor of the fitter
+        # output: a list of fitted objects of this class, one per element in dimslist
+        # notes:
+        # - the default implementation simply fits each projection separately.
+        #   concrete deriving classes can override it to share computations between the projections
+        #   (e.g. computing the full covariance matrix only once).
+        if not isinstance( points, np.ndarray ):
+            raise Exception('ERROR in CloudFitter.fit_projections: points must be a numpy array but found type {}'.format(type(points)))
+        if len(points.shape)!=2:
+            raise Exception('ERROR in CloudFitter.fit_projections: points must be a 2D numpy array but found shape {}'.format(points.shape))
+        if dimslist is None: dimslist = cls.get_pairs( points.shape[1] )
+        return [cls( points[:,list(dims)], **kwargs ) for dims in dimslist]
+    
+    @classmethod
+    def logpdf_projections( cls, fitters, dimslist, points, chunksize=100000 ):
+        ### evaluate the natural logarithm of the pdf of multiple projections at given points
+        # input arguments:
+        # - fitters: list of fitted objects of this class, one per element in dimslist (e.g. as returned by fit_projections)
+        # - dimslist: list of tuples of dimension indices onto which the fitters were projected
+        # - points: a 2D numpy array of shape (npoints,ndims), with ndims the number of dimensions of the full point cloud
+        # - chunksize: number of points to evaluate at once (see logpdf)
+        # output: a 2D array of shape (npoints,len(dimslist))
+        # note: the actual calculation for each chunk of points is done in logpdf_projections_chunk.
+        if not isinstance( points, np.ndarray ):
+            raise Exception('ERROR in CloudFitter.logpdf_projections: points must be a numpy array but found type {}'.format(type(points)))
+        if len(points.shape)!=2:
+            raise Exception('ERROR in CloudFitter.logpdf_projections: points must be a 2D numpy array but found shape {}'.format(points.shape))
+        if len(fitters)!=len(dimslist):
+            raise Exception('ERROR in CloudFitter.logpdf_projections: found {} fitters'.format(len(fitters))
+                           +' but {} projections.'.format(len(dimslist)))
+        for fitter,dims in zip(fitters,dimslist):
+            if fitter.ndims!=len(dims):
+                raise Exception('ERROR in CloudFitter.logpdf_projections: fitter has {} dimensions'.format(fitter.ndims)
+                               +' but projection {} has {}.'.format(dims,len(dims)))
+        npoints = len(points)
+        if( chunksize is None or chunksize>=npoints ): return cls.logpdf_projections_chunk( fitters, dimslist, points )
+        res = np.zeros((npoints,len(dimslist)))
+        for start in range(0,npoints,chunksize):
+            stop = min(start+chunksize,npoints)
+            res[start:stop] = cls.logpdf_projections_chunk( fitters, dimslist, points[start:stop] )
+        return res
+    
+    @classmethod
+    def logpdf_projections_chunk( cls, fitters, dimslist, points ):
+        ### evaluate the natural logarithm of the pdf of multiple projections for a single chunk of points
+        # mostly for internal use; call logpdf_projections instead, which performs input checks and splits the points in chunks.
+        # note: the default implementation evaluates each fitter separately,
+        #       override it in concrete deriving classes if a vectorized calculation over the projections is available.
+        res = np.zeros((len(points),len(dimslist)))
+        for i,(fitter,dims) in enumerate(zip(fitters,dimslist)):
+            res[:,i] = fitter.logpdf_chunk( points[:,list(dims)] )
+        return res
+    
+    @classmethod
+    def pdf_projections( cls, fitters, dimslist, points, chunksize=100000 ):
+        ### evaluate the pdf of multiple projections at given points
+        # see logpdf_projections for the input arguments, output is a 2D array of shape (npoints,len(dimslist))
+        return np.exp( cls.logpdf_projections( fitters, dimslist, points, chunksize=chunksize ) )
+    
+    @staticmethod
+    def gaussian_logpdf_pairs( points, dimslist, covs, means=None ):
+        ### evaluate the log pdf of 2D normal distributions on multiple pairs of dimensions at once
+        # mostly for internal use by the gaussian-type fitters.
+        # input arguments:
+        # - points: 2D numpy array of shape (npoints,ndims)
+        # - dimslist: list of pairs of dimension indices
+        # - covs: numpy array of shape (len(dimslist),2,2) with the covariance matrix for each pair
+        # - means: numpy array of shape (len(dimslist),2) with the mean for each pair (default: zero)
+        # output: a 2D array of shape (npoints,len(dimslist))
+        # note: uses the closed form of the inverse and determinant of 2x2 matrices,
+        #       so that all pairs are evaluated at once.
+        idx1 = np.array([dims[0] for dims in dimslist])
+        idx2 = np.array([dims[1] for dims in dimslist])
+        a = covs[:,0,0]
+        b = covs[:,0,1]
+        c = covs[:,1,1]
+        det = a*c-b*b
+        x = points[:,idx1]
+        y = points[:,idx2]
+        if means is not None:
+            x -= means[:,0]
+            y -= means[:,1]
+        maha = (c*x*x-2*b*x*y+a*y*y)/det
+        return -0.5*(2*np.log(2*np.pi)+np.log(det)+maha)
 
 
 
@@ -12,7 +12,6 @@
 # external modules
 import sys
 import numpy as np
-import importlib
 
 # local modules
 from CloudFitter import CloudFitter
@@ -37,10 +36,13 @@ class ExponentialFitter(CloudFitter):
     def pdf(self, points):
         ### get pdf at points
         super( ExponentialFitter, self ).pdf(points)
-        temp = np.repeat(np.transpose(np.expand_dims(self.l,axis=1)),len(points),axis=0)
-        temp = np.multiply(temp,points)
-        temp = np.sum(temp,axis=1)
-        return np.prod(self.l)*np.exp(-temp)
+        return np.exp(self.logpdf(points))
+    
+    def logpdf_chunk(self, points):
+        ### get log pdf at points
+        # note: evaluated directly in log-space as sum(log(lambda)) - lambda.x,
+        #       which avoids the intermediate (npoints,ndims) array and underflow of the exponential.
+        return np.sum(np.log(self.l)) - np.dot(points,self.l)
 
 
 
@@ -14,7 +14,6 @@
 import sys
 import numpy as np
 from scipy.stats import gaussian_kde
-import importlib
 
 # local modules
 from CloudFitter import CloudFitter
@@ -45,6 +44,82 @@ class GaussianKdeFitter(CloudFitter):
         ### get pdf at points
         super( GaussianKdeFitter, self ).pdf(points)
         return self.kernel.pdf(np.transpose(points))
+    
+    def logpdf_chunk(self,points):
+        ### get log pdf at points
+        # note: uses scipy's logpdf, which sums the kernels in log-space (numerically stable for points far from the cloud)
+        return self.kernel.logpdf(np.transpose(points))
+    
+    @classmethod
+    def fit_projections(cls, points, dimslist=None, bw_method='scott'):
+        ### fit a gaussian kernel density to multiple projections of a point cloud at once
+        # overrides the default of CloudFitter:
+        # the full covariance matrix is computed only once (the 'cov' attribute of the fits are its submatrices),
+        # and the bandwidth factor is determined once and shared by all projections with the same number of dimensions
+        # (for 'scott' and 'silverman' it only depends on the number of points and dimensions).
+        # see CloudFitter.fit_projections for the input arguments and output,
+        # and the constructor for the bw_method argument.
+        if dimslist is None: dimslist = cls.get_pairs( points.shape[1] )
+        cov = np.cov(points,rowvar=False)
+        npoints = len(points)
+        factors = {}
+        fitters = []
+        for dims in dimslist:
+            ndims = len(dims)
+            if ndims not in factors.keys():
+                if bw_method=='scott': factors[ndims] = npoints**(-1./(ndims+4))
+                elif bw_method=='silverman': factors[ndims] = (npoints*(ndims+2)/4.)**(-1./(ndims+4))
+                else: factors[ndims] = bw_method
+            fitter = cls.__new__(cls)
+            fitter.npoints = npoints
+            fitter.ndims = ndims
+            fitter.cov = cov[np.ix_(dims,dims)]
+            fitter.kernel = gaussian_kde(np.transpose(points[:,list(dims)]),bw_method=factors[ndims])
+            fitters.append(fitter)
+        return fitters
+    
+    @classmethod
+    def logpdf_projections_chunk(cls, fitters, dimslist, points):
+        ### get log pdf of multiple projections at points
+        # overrides the default of CloudFitter: if all projections are pairs of dimensions of the same point cloud
+        # (e.g. as returned by fit_projections), all pairs are evaluated at once.
+        # the differences between the points and the kernel centers are computed only once per dimension
+        # and shared between all pairs that contain this dimension.
+        # in other cases, the default of CloudFitter (evaluating each fitter separately) is used.
+        if not all([len(dims)==2 for dims in dimslist]):
+            return super( GaussianKdeFitter, cls ).logpdf_projections_chunk( fitters, dimslist, points )
+        # collect the kernel centers per dimension, and check that they are the same for all pairs
+        centers = {}
+        for fitter,dims in zip(fitters,dimslist):
+            for k,dim in enumerate(dims):
+                if dim not in centers.keys(): centers[dim] = fitter.kernel.dataset[k]
+                elif( centers[dim] is not fitter.kernel.dataset[k] 
+                      and not np.array_equal(centers[dim],fitter.kernel.dataset[k]) ):
+                    return super( GaussianKdeFitter, cls ).logpdf_projections_chunk( fitters, dimslist, points )
+        dims = sorted(centers.keys())
+        dimindex = dict([(dim,i) for i,dim in enumerate(dims)])
+        ncenters = len(centers[dims[0]])
+        # evaluate in sub-chunks of points, in order to limit the size of the array of differences
+        res = np.zeros((len(points),len(dimslist)))
+        subchunksize = max(1,int(1e7/(len(dims)*ncenters)))
+        for start in range(0,len(points),subchunksize):
+            stop = min(start+subchunksize,len(points))
+            diffs = np.zeros((len(dims),stop-start,ncenters))
+            for i,dim in enumerate(dims): diffs[i] = points[start:stop,dim][:,np.newaxis]-centers[dim]
+            for j,(fitter,(dim1,dim2)) in enumerate(zip(fitters,dimslist)):
+                cov = fitter.kernel.covariance
+                det = cov[0,0]*cov[1,1]-cov[0,1]*cov[1,0]
+                x = diffs[dimindex[dim1]]
+                y = diffs[dimindex[dim2]]
+                # (-0.5 times the mahalanobis distance to each kernel center)
+                arg = (x*x)*(-0.5*cov[1,1]/det)
+                arg += (y*y)*(-0.5*cov[0,0]/det)
+                arg += (x*y)*(cov[0,1]/det)
+                # (sum the kernels in log-space, as in scipy's logpdf)
+                maxarg = np.max(arg,axis=1)
+                np.exp(arg-maxarg[:,np.newaxis],out=arg)
+                res[start:stop,j] = maxarg+np.log(np.sum(arg,axis=1))-np.log(ncenters)-np.log(2*np.pi)-0.5*np.log(det)
+        return res
 
 
 
@@ -13,7 +13,7 @@
 import sys
 import numpy as np
 from scipy.stats import multivariate_normal
-import importlib
+from scipy.linalg import cholesky, solve_triangular
 
 # local modules
 from CloudFitter import CloudFitter
@@ -28,6 +28,8 @@ class LogNormalFitter(CloudFitter):
     # - mean: multidim mean of underlying normal
     # - cov: multidim covariance matrix of underlying normal
     # - mvn: scipy.stats multivariate_normal object built from the mean and cov
+    # - cholesky: lower triangular cholesky factor of cov (cached for fast evaluation of the pdf)
+    # - logdet: natural logarithm of the determinant of cov
     
     def __init__(self,points):
         ### constructor
@@ -40,11 +42,55 @@ class LogNormalFitter(CloudFitter):
         self.mean = np.mean(points_log,axis=0)
         self.cov = np.cov(points_log,rowvar=False)
         self.mvn = multivariate_normal(self.mean,self.cov)
+        self.cholesky = cholesky(np.atleast_2d(self.cov),lower=True)
+        self.logdet = 2*np.sum(np.log(np.diag(self.cholesky)))
         
     def pdf(self,points):
         ### get pdf at points
         super( LogNormalFitter, self ).pdf(points)
-        return self.mvn.pdf(np.log(points))
+        return np.exp(self.logpdf(points))
+    
+    def logpdf_chunk(self,points):
+        ### get log pdf at points
+        # note: uses the cached cholesky factor of the covariance matrix
+        #       instead of re-validating and re-factorizing it in scipy on each call.
+        diff = np.transpose(np.log(points)-self.mean)
+        maha = np.sum(np.power(solve_triangular(self.cholesky,diff,lower=True),2),axis=0)
+        return -0.5*(self.ndims*np.log(2*np.pi)+self.logdet+maha)
+    
+    @classmethod
+    def fit_projections(cls, points, dimslist=None):
+        ### fit a log-normal distribution to multiple projections of a point cloud at once
+        # overrides the default of CloudFitter:
+        # the logarithm of the points and the full mean and covariance matrix are computed only once,
+        # the fits to the projections use their subsets (which is identical to fitting each projection separately).
+        # see CloudFitter.fit_projections for the input arguments and output.
+        if dimslist is None: dimslist = cls.get_pairs( points.shape[1] )
+        points_log = np.log(points)
+        mean = np.mean(points_log,axis=0)
+        cov = np.cov(points_log,rowvar=False)
+        fitters = []
+        for dims in dimslist:
+            fitter = cls.__new__(cls)
+            fitter.npoints = len(points)
+            fitter.ndims = len(dims)
+            fitter.mean = mean[list(dims)]
+            fitter.cov = cov[np.ix_(dims,dims)]
+            fitter.mvn = multivariate_normal(fitter.mean,fitter.cov)
+            fitter.cholesky = cholesky(np.atleast_2d(fitter.cov),lower=True)
+            fitter.logdet = 2*np.sum(np.log(np.diag(fitter.cholesky)))
+            fitters.append(fitter)
+        return fitters
+    
+    @classmethod
+    def logpdf_projections_chunk(cls, fitters, dimslist, points):
+        ### get log pdf of multiple projections at points
+        # overrides the default of CloudFitter: all pairs of dimensions are evaluated at once.
+        if not all([len(dims)==2 for dims in dimslist]):
+            return super( LogNormalFitter, cls ).logpdf_projections_chunk( fitters, dimslist, points )
+        covs = np.array([fitter.cov for fitter in fitters])
+        means = np.array([fitter.mean for fitter in fitters])
+        return cls.gaussian_logpdf_pairs( np.log(points), dimslist, covs, means=means )
 
 
 
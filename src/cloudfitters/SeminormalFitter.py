@@ -13,7 +13,7 @@
 import sys
 import numpy as np
 from scipy.stats import multivariate_normal
-import importlib
+from scipy.linalg import cholesky, solve_triangular
 
 # local modules
 from CloudFitter import CloudFitter
@@ -30,6 +30,8 @@ class SeminormalFitter(CloudFitter):
     # parameters
     # - cov: multidim covariance matrix of normal distribution
     # - mvn: scipy.stats multivariate_normal object built from the cov
+    # - cholesky: lower triangular cholesky factor of cov (cached for fast evaluation of the pdf)
+    # - logdet: natural logarithm of the determinant of cov
         
     def __init__(self,points):
         ### constructor
@@ -43,16 +45,62 @@ class SeminormalFitter(CloudFitter):
             self.npoints = 0
             self.cov = None
             self.mvn = None
+            self.cholesky = None
+            self.logdet = None
             return
         super( SeminormalFitter, self ).__init__(points)
         points = np.vstack((points,-points))
         self.cov = np.cov(points,rowvar=False)
         self.mvn = multivariate_normal(np.zeros(self.ndims),self.cov)
+        self.factorize()
+        
+    def factorize(self):
+        ### compute and cache the cholesky factor and log-determinant of the covariance matrix
+        # mostly for internal use, called automatically when building or loading the fit.
+        self.cholesky = cholesky(np.atleast_2d(self.cov),lower=True)
+        self.logdet = 2*np.sum(np.log(np.diag(self.cholesky)))
         
     def pdf(self,points):
         ### get pdf at points
         super( SeminormalFitter, self ).pdf(points)
-        return self.mvn.pdf(points)
+        return np.exp(self.logpdf(points))
+    
+    def logpdf_chunk(self,points):
+        ### get log pdf at points
+        # note: uses the cached cholesky factor of the covariance matrix
+        #       instead of re-validating and re-factorizing it in scipy on each call.
+        maha = np.sum(np.power(solve_triangular(self.cholesky,np.transpose(points),lower=True),2),axis=0)
+        return -0.5*(self.ndims*np.log(2*np.pi)+self.logdet+maha)
+    
+    @classmethod
+    def fit_projections(cls, points, dimslist=None):
+        ### fit a seminormal distribution to multiple projections of a point cloud at once
+        # overrides the default of CloudFitter:
+        # the full covariance matrix is computed only once, the fits to the projections use its submatrices
+        # (which is identical to fitting each projection separately).
+        # see CloudFitter.fit_projections for the input arguments and output.
+        if dimslist is None: dimslist = cls.get_pairs( points.shape[1] )
+        # (the mirrored point cloud has zero mean, so its covariance is simply a scaled inner product)
+        cov = 2*np.matmul(np.transpose(points),points)/(2*len(points)-1)
+        fitters = []
+        for dims in dimslist:
+            fitter = cls([])
+            fitter.npoints = len(points)
+            fitter.ndims = len(dims)
+            fitter.cov = cov[np.ix_(dims,dims)]
+            fitter.mvn = multivariate_normal(np.zeros(fitter.ndims),fitter.cov)
+            fitter.factorize()
+            fitters.append(fitter)
+        return fitters
+    
+    @classmethod
+    def logpdf_projections_chunk(cls, fitters, dimslist, points):
+        ### get log pdf of multiple projections at points
+        # overrides the default of CloudFitter: all pairs of dimensions are evaluated at once.
+        if not all([len(dims)==2 for dims in dimslist]):
+            return super( SeminormalFitter, cls ).logpdf_projections_chunk( fitters, dimslist, points )
+        covs = np.array([fitter.cov for fitter in fitters])
+        return cls.gaussian_logpdf_pairs( points, dimslist, covs )
     
     def save(self,path):
         ### save the covariance matrix as a .npy file specified by path
@@ -63,6 +111,7 @@ class SeminormalFitter(CloudFitter):
         self.cov = np.load(path)
         self.ndims = len(self.cov)
         self.mvn = multivariate_normal(np.zeros(self.ndims),self.cov)
+        self.factorize()
 
 
 
@@ -14,16 +14,11 @@
 
 # external modules
 import numpy as np
-import tensorflow as tf
-from keras import backend as K
-import seaborn as sn
 import pandas as pd
-import matplotlib.pyplot as plt
-import importlib
+# (tensorflow, keras, seaborn and matplotlib are only imported in the functions that need them,
+#  so that functions like mseTopNRaw can be used without the import overhead)
 
 # local modules
-import plot_utils
-importlib.reload(plot_utils)
 
 
 
@@ -40,6 +35,8 @@ def mseTop10(y_true, y_pred):
     # - mean squared error between y_true and y_pred,
     #   where only the 10 bins with largest squared error are taken into account.
     #   if y_true and y_pred are 2D arrays, this function returns 1D array (mseTop10 for each histogram)
+    import tensorflow as tf
+    from keras import backend as K
     top_values, _ = tf.nn.top_k(K.square(y_pred - y_true), k=10, sorted=True)
     mean=K.mean(top_values, axis=-1)
     return mean
@@ -65,11 +62,14 @@ def mseTopNRaw(y_true, y_pred, n=10):
     # - n: number of largest elements to keep for averaging
     # output:
     # numpy array of shape (nhists)
-    sqdiff = np.power(y_true-y_pred,2)
+    # note: the squared differences are computed in the data type of the inputs (e.g. float32),
+    #       only the final averaging is done in float64.
+    sqdiff = np.subtract(y_true,y_pred)
+    np.square(sqdiff, out=sqdiff)
     if len(sqdiff.shape)==3:
         sqdiff = sqdiff.reshape(len(sqdiff),-1)
     sqdiff = np.partition( sqdiff, -n, axis=-1 )[:,-n:]
-    mean = np.mean( sqdiff, axis=-1 )
+    mean = np.mean( sqdiff, axis=-1, dtype=np.float64 )
     return mean
 
 # attempts to use chi2 instead of mse, so far no good results, but keep for reference
@@ -82,12 +82,15 @@ def chiSquared(y_true, y_pred):
     # output:
     # - relative mean squared error between y_true and y_pred,
     #   if y_true and y_pred are 2D arrays, this function returns 1D array (chiSquared for each histogram)
+    from keras import backend as K
     normdiffsq = np.divide(K.square(y_pred - y_true),y_true)
     chi2 = K.sum(normdiffsq,axis=-1)
     return chi2
 
 def chiSquaredTop10(y_true, y_pred):
     ### same as chiSquared but take into account only 10 largest values in averaging.
+    import tensorflow as tf
+    from keras import backend as K
     normdiffsq = np.divide(K.square(y_pred - y_true),y_true)
     top_values,_ = tf.nn.top_k(normdiffsq,k=10,sorted=True)
     chi2 = K.sum(top_values,axis=-1)
@@ -175,6 +178,7 @@ def get_roc(scores, labels, mode='lin', npoints=100, doprint=False, doplot=True,
     
     if not doplot:
         return auc
+    import matplotlib.pyplot as plt
     
     # calculate auc
     if plotmode=='classic':
@@ -227,6 +231,8 @@ def get_confusion_matrix(scores, labels, wp):
     # scores and labels are defined in the same way as for get_roc
     # wp is the chosen working point 
     # (i.e. any score above wp is flagged as signal, any below is flagged as background)
+    import seaborn as sn
+    import matplotlib.pyplot as plt
     
     nsig = np.sum(labels)
     nback = np.sum(1-labels)
@@ -310,6 +316,7 @@ def train_simple_autoencoder(hists,nepochs=-1,modelname=''):
     if nepochs<0: nepochs = int(min(40,len(hists)/400))
     model = getautoencoder(input_size,arch,act,opt,loss)
     history = model.fit(hists, hists, epochs=nepochs, batch_size=500, shuffle=False, verbose=1, validation_split=0.1)
+    import plot_utils
     plot_utils.plot_loss(history)
     if len(modelname)>0: model.save(modelname.split('.')[0]+'.h5')
     return model
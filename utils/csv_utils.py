@@ -17,11 +17,9 @@
 import os
 import pandas as pd
 import numpy as np
-import importlib
 
 # local modules
 import dataframe_utils as dfu
-importlib.reload(dfu)
 
 
 
@@ -16,11 +16,9 @@ import os
 import pandas as pd
 import numpy as np
 import json
-import importlib
 
 # local modules
 import json_utils
-importlib.reload(json_utils)
 
 
 
@@ -158,16 +156,21 @@ def select_highstat(df, entries_to_bins_ratio=100):
 
 # functions to obtain histograms in np array format
 
-def get_hist_values(df):
+def get_hist_values(df, dtype=float, sparse=False):
     ### same as builtin "df['histo'].values" but convert strings to np arrays
     # input arguments:
     # - df: a dataframe containing histograms (assumed to be of a single type!)
+    # - dtype: data type of the output histogram array (default: float64);
+    #   e.g. np.float32 halves the memory (bin counts are represented exactly up to 2^24),
+    #   or an unsigned integer type (e.g. np.uint32) can be used for unnormalized histograms.
+    # - sparse: boolean whether to return the histograms as a SparseHists object (see sparse_hist_utils.py)
+    #   instead of a numpy array; only the non-zero bins are stored, so the memory scales with the number of non-zero bins.
     # note: this function works for both 1D and 2D histograms,
     #       the distinction is made based on whether or not 'Ybins' is present as a column in the dataframe
     #       update: 'Ybins' is also present for 1D histograms, but has value 1!
     # output:
     # a tuple containing the following elements:
-    # - np array of shape (nhists,nbins) (for 1D) or (nhists,nybins,nxbins) (for 2D)
+    # - np array of shape (nhists,nbins) (for 1D) or (nhists,nybins,nxbins) (for 2D) (or a SparseHists object)
     # - np array of run numbers of length nhists
     # - np array of lumisection numbers of length nhists
     # warning: no check is done to assure that all histograms are of the same type!
@@ -175,18 +178,37 @@ def get_hist_values(df):
     if 'Ybins' in df.keys():
         if df.at[0,'Ybins']>1: dim=2
     nxbins = df.at[0,'Xbins']+2 # +2 for under- and overflow bins
-    vals = np.zeros((len(df),nxbins))
+    histshape = (nxbins,)
     if dim==2: 
         nybins = df.at[0,'Ybins']+2
-        vals = np.zeros((len(df),nybins,nxbins))
+        histshape = (nybins,nxbins)
+    if not sparse: vals = np.zeros((len(df),)+histshape,dtype=dtype)
+    else:
+        indices = []
+        data = []
+        indptr = np.zeros(len(df)+1,dtype=np.int64)
     ls = np.zeros(len(df))
     runs = np.zeros(len(df))
     for i in range(len(df)):
-        hist = np.array(json.loads(df.at[i,'histo']))
-        if dim==2: hist = hist.reshape((nybins,nxbins))
-        vals[i,:] = hist
+        hist = np.array(json.loads(df.at[i,'histo'])).ravel()
+        if hist.size!=np.prod(histshape):
+            raise Exception('ERROR in dataframe_utils.py / get_hist_values: histogram at row {}'.format(i)
+                           +' has {} bins while {} were expected from Xbins and Ybins.'.format(hist.size,int(np.prod(histshape))))
+        if not sparse:
+            vals[i,:] = hist.reshape(histshape)
+        else:
+            nonzero = np.nonzero(hist)[0]
+            indices.append(nonzero)
+            data.append(hist[nonzero])
+            indptr[i+1] = indptr[i]+len(nonzero)
         ls[i] = int(df.at[i,'fromlumi'])
         runs[i] = int(df.at[i,'fromrun'])
+    if sparse:
+        from scipy.sparse import csr_matrix
+        from sparse_hist_utils import SparseHists
+        matrix = csr_matrix( (np.concatenate(data+[np.zeros(0)]).astype(dtype),np.concatenate(indices+[np.zeros(0,dtype=int)]),indptr),
+                             shape=(len(df),int(np.prod(histshape))) )
+        vals = SparseHists( matrix, histshape )
     ls = ls.astype(int)
     runs = runs.astype(int)
     return (vals,runs,ls)
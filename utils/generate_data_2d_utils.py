@@ -11,19 +11,16 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import importlib
 
 # local modules
 import hist_utils
-importlib.reload(hist_utils)
 
 
 
 
 ### help functions
 
-def goodnoise_nd(shape, fstd=None, kmaxscale=0.25, ncomponents=3):
+def goodnoise_nd(shape, fstd=None, kmaxscale=0.25, ncomponents=3, rng=None):
     ### generate one sample of 'good' noise consisting of fourier components
     # generalization of goodnoise (see generate_data_utils) to arbitrary number of dimensions
     # input args:
@@ -36,47 +33,66 @@ def goodnoise_nd(shape, fstd=None, kmaxscale=0.25, ncomponents=3):
     #   note: can be a tuple with same length as shape, to scale differently in different dimensions.
     # - ncomponents: number of random sines to add per dimension
     #   note: can be a tuple with same length as shape, to use a different number of components in different dimensions.
+    # - rng: numpy random Generator (e.g. np.random.default_rng(seed)) used for sampling
+    #   (default: the global numpy random state)
     # output: 
     # - numpy array of shape detailed by shape argument containing the noise
+    # note: to generate many samples, use goodnoise_nd_batch, which is much faster.
     
     # check fstd argument
     if fstd is not None:
         if fstd.shape!=shape:
             raise Exception('ERROR in generate_data_2d_utils.py / goodnoisend:'
                             +' argument fstd must either be None or have same shape as shape argument')
+    return goodnoise_nd_batch(1, shape, fstd=fstd, kmaxscale=kmaxscale, ncomponents=ncomponents, rng=rng)[0]
+
+def goodnoise_nd_batch(nsamples, shape, fstd=None, kmaxscale=0.25, ncomponents=3, rng=None, dtype=float):
+    ### generate multiple samples of 'good' noise consisting of fourier components
+    # same distribution as goodnoise_nd, but all samples are generated at once.
+    # input args:
+    # - nsamples: number of samples to generate
+    # - shape, kmaxscale, ncomponents, rng: see goodnoise_nd
+    # - fstd: an array of shape given by shape argument (same for all samples) 
+    #   or of shape (nsamples,<shape>) (one per sample), 
+    #   used for scaling of the amplitude of the noise bin-by-bin (default: no scaling).
+    # - dtype: data type of the output array (e.g. np.float32 to save memory and time)
+    # output:
+    # - numpy array of shape (nsamples,<shape>) containing the noise
+    if rng is None: rng = np.random
     # parse kmaxscale argument
-    if( isinstance(kmaxscale,float) or isinstance(ncomponents,int) ):
+    if( isinstance(kmaxscale,float) or isinstance(kmaxscale,int) ):
         kmaxscale = tuple([kmaxscale]*len(shape))
     # parse ncomponents argument
     if( isinstance(ncomponents,float) or isinstance(ncomponents,int) ):
-        ncomponents = tuple([ncomponents]*len(shape))
+        ncomponents = tuple([int(ncomponents)]*len(shape))
     # initialize noise array
-    noise = np.zeros(shape)
+    noise = np.zeros((nsamples,)+tuple(shape), dtype=dtype)
     # loop over axes
     for i in range(len(shape)):
-        ax = np.arange(0,shape[i])
-        thiscomp = np.zeros(shape[i])
+        ax = np.arange(0,shape[i]).astype(dtype)
         ncomps = ncomponents[i]
         # get uniformly sampled wavenumbers in range (0,kmax)
         kmax = np.pi*kmaxscale[i]
-        k = np.random.uniform(low=0,high=1,size=ncomps)*kmax
+        k = (rng.uniform(low=0,high=1,size=(nsamples,ncomps))*kmax).astype(dtype)
         # get uniformly sampled phases in range (0,2pi)
-        phase = np.random.uniform(low=0,high=1,size=ncomps)*2*np.pi
+        phase = (rng.uniform(low=0,high=1,size=(nsamples,ncomps))*2*np.pi).astype(dtype)
         # get uniformly sampled amplitudes in range (0,2/ncomps) (i.e. mean total amplitude = 1)
-        amplitude = np.random.uniform(low=0,high=1,size=ncomps)*2/ncomps
-        for j in range(ncomps): thiscomp += amplitude[j]*np.sin(k[j]*ax + phase[j])
-        # expand this component to all dimensions
-        reps = list(shape)
-        reps[i] = 1
-        for j in range(0,i): thiscomp = np.expand_dims(thiscomp,0)
-        for j in range(i+1,len(shape)): thiscomp = np.expand_dims(thiscomp,-1)
-        # add to noise
-        noise += thiscomp
+        amplitude = (rng.uniform(low=0,high=1,size=(nsamples,ncomps))*2/ncomps).astype(dtype)
+        # sum the components for all samples at once, giving shape (nsamples,shape[i])
+        temp = k[:,:,np.newaxis]*ax
+        temp += phase[:,:,np.newaxis]
+        np.sin(temp,out=temp)
+        temp *= amplitude[:,:,np.newaxis]
+        thiscomp = np.sum(temp,axis=1)
+        # broadcast this component to all dimensions and add to noise
+        compshape = [nsamples]+[1]*len(shape)
+        compshape[i+1] = shape[i]
+        noise += thiscomp.reshape(compshape)
     # scale noise
-    if fstd is not None: noise = np.multiply(noise,fstd)
+    if fstd is not None: noise *= fstd
     return noise
 
-def whitenoise_nd(shape, fstd=None):
+def whitenoise_nd(shape, fstd=None, rng=None):
     ### generate one sample of white noise (standard normally distributed, uncorrelated between bins)
     # generalization of whitenoise (see generate_data_utils) to arbitrary number of dimensions
     # input args:
@@ -85,21 +101,25 @@ def whitenoise_nd(shape, fstd=None):
     # - fstd: an array of shape given by shape argument, 
     #   used for scaling of the amplitude of the noise bin-by-bin
     #   (default: no scaling).
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
     # output: 
     # - numpy array of shape detailed by shape argument containing the noise
-    noise = np.random.normal(size=shape)
+    if rng is None: rng = np.random
+    noise = rng.normal(size=shape)
     if fstd is not None: noise = np.multiply(noise,fstd)
     return noise
 
-def random_lico_nd(hists):
+def random_lico_nd(hists, rng=None):
     ### generate one linear combination of histograms with random coefficients in (0,1) summing to 1.
     # generalization of random_lico (see generate_data_utils) to arbitrary number of dimensions.
     # input args: 
     # - numpy array of shape (nhists,<arbitrary number of additional dimensions>)
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
     # output:
     # - numpy array of shape (<same dimensions as input>), containing the new histogram
+    if rng is None: rng = np.random
     nhists = hists.shape[0]
-    coeffs = np.random.uniform(low=0.,high=1.,size=nhists)
+    coeffs = rng.uniform(low=0.,high=1.,size=nhists)
     coeffs = coeffs/np.sum(coeffs)
     for i in range(len(hists.shape[1:])): coeffs = np.expand_dims(coeffs,-1)
     res = np.sum(hists*coeffs,axis=0)
@@ -108,8 +128,30 @@ def random_lico_nd(hists):
 
 
 
+def get_output_array(outshape, out=None, dtype=None):
+    ### get an array to write generated histograms to
+    # mostly for internal use.
+    # input args:
+    # - outshape: required shape of the output array
+    # - out: preallocated array (e.g. a np.memmap) to use, or None to allocate a new one
+    # - dtype: data type for a newly allocated array (default: float64), ignored if out is provided
+    if out is None: return np.empty(outshape, dtype=(dtype if dtype is not None else float))
+    if tuple(out.shape)!=tuple(outshape):
+        raise Exception('ERROR in generate_data_2d_utils.py / get_output_array:'
+                        +' provided output array has shape {} while {} is required.'.format(out.shape,outshape))
+    return out
+
+def get_chunksize(histshape, chunksize=None):
+    ### get the number of histograms to generate at once
+    # mostly for internal use; by default, chunks of about 1e7 bins are generated at once.
+    if chunksize is not None: return max(1,int(chunksize))
+    return max(1,int(1e7/max(1,np.prod(histshape))))
+
+
+
+
 def fourier_noise_nd(hists, outfilename='', figname='', nresamples=1, nonnegative=True, 
-                     stdfactor=15., kmaxscale=0.25, ncomponents=3):
+                     stdfactor=15., kmaxscale=0.25, ncomponents=3, rng=None, out=None, dtype=None, chunksize=None):
     ### apply fourier noise on random histograms with simple flat amplitude scaling.
     # generalization of fourier_noise (see generate_data_utils) to arbitrary number of dimensions.
     # input args: 
@@ -120,20 +162,32 @@ def fourier_noise_nd(hists, outfilename='', figname='', nresamples=1, nonnegativ
     # - nonnegative: boolean whether to set all bins to minimum zero after applying noise
     # - stdfactor: factor to scale magnitude of noise (larger factor = smaller noise)
     # - kmaxscale and ncomponents: see goodnoise_nd
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
+    # - out: preallocated array of shape (nresamples*nhists,<dimensions of hists>) to write the results to,
+    #   e.g. a np.memmap for outputs that do not fit in memory (default: a new array is allocated)
+    # - dtype: data type of the output array if out is not provided (e.g. np.float32, default: float64)
+    # - chunksize: number of histograms generated at once (default: chunks of about 1e7 bins)
+    # output:
+    # - numpy array of shape (nresamples*nhists,<dimensions of hists>) (out, if it was provided),
+    #   in random order.
     
+    if rng is None: rng = np.random
     nhists = hists.shape[0]
     histshape = hists.shape[1:]
     outshape = tuple([nresamples*nhists]+list(histshape))
-    reshists = np.zeros(outshape)
+    reshists = get_output_array(outshape, out=out, dtype=dtype)
+    chunksize = get_chunksize(histshape, chunksize=chunksize)
     
     # generate data
-    for i in range(nhists):
-        for j in range(nresamples):
-            reshists[nresamples*i+j] = hists[i] + goodnoise_nd(histshape,fstd=hists[i]/stdfactor,
-                                                               kmaxscale=kmaxscale,ncomponents=ncomponents)
-    if nonnegative:
-        reshists = np.where(reshists>0,reshists,0)
-    np.random.shuffle(reshists)
+    # (the output is shuffled by generating the resamples directly in a random order)
+    order = rng.permutation(nresamples*nhists)
+    for start in range(0,len(order),chunksize):
+        seeds = hists[order[start:start+chunksize]//nresamples].astype(reshists.dtype)
+        noise = goodnoise_nd_batch(len(seeds), histshape, fstd=seeds/stdfactor,
+                                   kmaxscale=kmaxscale, ncomponents=ncomponents, rng=rng, dtype=reshists.dtype)
+        seeds += noise
+        if nonnegative: np.maximum(seeds,0,out=seeds)
+        reshists[start:start+chunksize] = seeds
 
     # plot examples of good and bad histograms
     #if len(figname)>0: 
@@ -150,7 +204,8 @@ def fourier_noise_nd(hists, outfilename='', figname='', nresamples=1, nonnegativ
 
 
 
-def white_noise_nd(hists, figname='', nresamples=1, nonnegative=True, stdfactor=15.):
+def white_noise_nd(hists, figname='', nresamples=1, nonnegative=True, stdfactor=15., 
+                   rng=None, out=None, dtype=None, chunksize=None):
     ### apply white noise to the histograms in hists.
     # generalization of white_noise (see generate_data_utils) to arbitrary number of dimensions.
     # input args:
@@ -159,18 +214,27 @@ def white_noise_nd(hists, figname='', nresamples=1, nonnegative=True, stdfactor=
     # - nresamples: number of samples to draw per input histogram
     # - nonnegative: boolean whether to set all bins to minimum zero after applying noise
     # - stdfactor: scaling factor of white noise amplitude (higher factor = smaller noise)
+    # - rng, out, dtype, chunksize: see fourier_noise_nd
+    # output:
+    # - numpy array of shape (nresamples*nhists,<dimensions of hists>) (out, if it was provided),
+    #   where resample j of input histogram i is at index nresamples*i+j.
 
+    if rng is None: rng = np.random
     nhists = hists.shape[0]
     histshape = hists.shape[1:]
     outshape = tuple([nresamples*nhists]+list(histshape))
-    reshists = np.zeros(outshape)
-
-    for i in range(nhists):
-        for j in range(nresamples):
-            reshists[nresamples*i+j] = hists[i] + whitenoise_nd(histshape,fstd=hists[i]/stdfactor)
-        
-    if nonnegative:
-        reshists = np.where(reshists>0,reshists,0)
+    reshists = get_output_array(outshape, out=out, dtype=dtype)
+    chunksize = get_chunksize(histshape, chunksize=chunksize)
+
+    for start in range(0,nresamples*nhists,chunksize):
+        stop = min(nresamples*nhists,start+chunksize)
+        seeds = hists[np.arange(start,stop)//nresamples].astype(reshists.dtype)
+        noise = rng.normal(size=seeds.shape).astype(reshists.dtype,copy=False)
+        noise *= seeds
+        noise /= stdfactor
+        seeds += noise
+        if nonnegative: np.maximum(seeds,0,out=seeds)
+        reshists[start:stop] = seeds
     
     # plot examples of generated histograms
     #if len(figname)>0: plot_data_and_gen(50,hists,reshists,figname)
@@ -180,7 +244,7 @@ def white_noise_nd(hists, figname='', nresamples=1, nonnegative=True, stdfactor=
 
 
 
-def resample_lico_nd(hists, nresamples=1, nonnegative=True):
+def resample_lico_nd(hists, nresamples=1, nonnegative=True, rng=None, out=None, dtype=None, chunksize=None):
     ### take random linear combinations of input histograms
     # generalization of fourier_noise (see generate_data_utils) to arbitrary number of dimensions.
     # input args: 
@@ -188,17 +252,26 @@ def resample_lico_nd(hists, nresamples=1, nonnegative=True):
     # - nresamples: number of samples to draw
     # - nonnegative: boolean whether to set all bins to minimum zero after applying noise
     #   note: coefficients in linear combination are always nonnegative, so this setting is superfluous is input histograms are all nonnegative
+    # - rng, out, dtype, chunksize: see fourier_noise_nd
+    # output:
+    # - numpy array of shape (nresamples,<dimensions of hists>) (out, if it was provided)
     
+    if rng is None: rng = np.random
     nhists = hists.shape[0]
     histshape = hists.shape[1:]
     outshape = tuple([nresamples]+list(histshape))
-    reshists = np.zeros(outshape)
-
-    for i in range(nresamples):
-        reshists[i] = random_lico_nd( hists )
-        
-    if nonnegative:
-        reshists = np.where(reshists>0,reshists,0)
+    reshists = get_output_array(outshape, out=out, dtype=dtype)
+    chunksize = get_chunksize(histshape, chunksize=chunksize)
+    flathists = hists.reshape(nhists,-1).astype(reshists.dtype)
+
+    for start in range(0,nresamples,chunksize):
+        stop = min(nresamples,start+chunksize)
+        # random coefficients in (0,1) summing to 1 for each resample
+        coeffs = rng.uniform(low=0.,high=1.,size=(stop-start,nhists)).astype(reshists.dtype)
+        coeffs /= np.sum(coeffs,axis=1,keepdims=True)
+        chunk = np.matmul(coeffs,flathists)
+        if nonnegative: np.maximum(chunk,0,out=chunk)
+        reshists[start:stop] = chunk.reshape((stop-start,)+tuple(histshape))
 
     return reshists
 
@@ -206,8 +279,3 @@ def resample_lico_nd(hists, nresamples=1, nonnegative=True):
 
 
 
-
-
-
-
-
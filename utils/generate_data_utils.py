@@ -14,41 +14,64 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import importlib
+# (matplotlib and scipy are only imported in the functions that need them)
 
 # local modules
 import hist_utils
-importlib.reload(hist_utils)
 
 
 
 
 ### help functions
 
-def goodnoise(nbins, fstd=None):
+def goodnoise(nbins, fstd=None, rng=None):
     ### generate one sample of 'good' noise consisting of fourier components
     # input args:
     # - nbins: number of bins, length of noise array to be sampled
     # - fstd: an array of length nbins used for scaling of the amplitude of the noise
     #         bin-by-bin.
+    # - rng: numpy random Generator (e.g. np.random.default_rng(seed)) used for sampling
+    #        (default: the global numpy random state)
     # output: 
     # - numpy array of length nbins containing the noise
+    # note: to generate many samples, use goodnoise_batch, which is much faster.
+    return goodnoise_batch(1, nbins, fstd=fstd, rng=rng)[0]
+
+def goodnoise_batch(nsamples, nbins, fstd=None, rng=None):
+    ### generate multiple samples of 'good' noise consisting of fourier components
+    # same distribution as goodnoise, but all samples are generated at once.
+    # input args:
+    # - nsamples: number of samples to generate
+    # - nbins: number of bins, length of each noise array
+    # - fstd: an array of length nbins (same for all samples) or of shape (nsamples,nbins) (one per sample)
+    #         used for scaling of the amplitude of the noise bin-by-bin.
+    # - rng: numpy random Generator (e.g. np.random.default_rng(seed)) used for sampling
+    #        (default: the global numpy random state)
+    # output:
+    # - numpy array of shape (nsamples,nbins) containing the noise
+    if rng is None: rng = np.random
     kmaxscale = 0.25 # frequency limiting factor to ensure smoothness
     ncomps = 3 # number of random sines to use
     kmax = np.pi*kmaxscale
     xax = np.arange(0,nbins)
-    noise = np.zeros(nbins)
     # get uniformly sampled wavenumbers in range (0,kmax)
-    k = np.random.uniform(low=0,high=1,size=ncomps)*kmax
+    k = rng.uniform(low=0,high=1,size=(nsamples,ncomps))*kmax
     # get uniformly sampled phases in range (0,2pi)
-    phase = np.random.uniform(low=0,high=1,size=ncomps)*2*np.pi
+    phase = rng.uniform(low=0,high=1,size=(nsamples,ncomps))*2*np.pi
     # get uniformly sampled amplitudes in range (0,2/ncomps) (i.e. mean total amplitude = 1)
-    amplitude = np.random.uniform(low=0,high=1,size=ncomps)*2/ncomps
-    for i in range(ncomps):
-        temp = amplitude[i]*np.sin(k[i]*xax + phase[i])
-        if fstd is not None: temp = np.multiply(temp,fstd)
-        noise += temp
+    amplitude = rng.uniform(low=0,high=1,size=(nsamples,ncomps))*2/ncomps
+    # sum the components, using broadcasting to shape (nsamples,ncomps,nbins)
+    # (in chunks of samples, to limit the size of the temporary arrays)
+    noise = np.zeros((nsamples,nbins))
+    chunksize = max(1, int(1e6/max(1,ncomps*nbins)))
+    for start in range(0,nsamples,chunksize):
+        stop = min(nsamples,start+chunksize)
+        temp = k[start:stop,:,np.newaxis]*xax
+        temp += phase[start:stop,:,np.newaxis]
+        np.sin(temp,out=temp)
+        temp *= amplitude[start:stop,:,np.newaxis]
+        np.sum(temp,axis=1,out=noise[start:stop])
+    if fstd is not None: noise = np.multiply(noise,fstd)
     return noise
 
 def badnoise(nbins, fstd=None):
@@ -122,6 +145,45 @@ def moments_correlation_vector(moments, index):
     # very similar to mse_correlation_vector but using histogram moments instead of full histograms for speed-up
     return mse_correlation_vector(moments,index)
 
+def get_similarity_moments(hists, orders=[0,1,2]):
+    ### calculate the histogram moments used to define similar histograms
+    # input args:
+    # - hists: numpy array of shape (nhists,nbins) containing the histograms
+    # - orders: list of moment orders to calculate (see hist_utils.moment)
+    # output:
+    # - numpy array of shape (nhists,len(orders)) containing the moments
+    nbins = hists.shape[1]
+    binwidth = 1./nbins
+    bincenters = np.linspace(binwidth/2,1-binwidth/2,num=nbins,endpoint=True)
+    return hist_utils.histmoments(bincenters,hists,orders)
+
+def get_similar_indices(allmoments, selmoments, keeppercentage=1.):
+    ### find for each selected histogram the indices of the most similar histograms in a larger set
+    # similarity is defined as the mse between the moments (see moments_correlation_vector),
+    # i.e. the euclidean distance between the moments; a KD-tree is built on allmoments
+    # so that the neighbourhoods of all selected histograms are found at once.
+    # input args:
+    # - allmoments: numpy array of shape (nhists,nmoments) with the moments of all available histograms
+    # - selmoments: numpy array of shape (nsel,nmoments) with the moments of the selected histograms
+    # - keeppercentage: percentage (between 0. and 100.) of histograms in allmoments to keep per selected histogram
+    # output:
+    # - numpy array of shape (nsel,nsim) with the indices in allmoments of the nsim most similar histograms,
+    #   where nsim is the number of distances within the keeppercentage percentile (always at least 1).
+    # note: in case of exactly equal distances at the boundary of the neighbourhood, 
+    #       only nsim of them are kept (in arbitrary order).
+    nhists = len(allmoments)
+    nsim = int(np.floor((nhists-1)*keeppercentage/100.))+1
+    nsim = min(max(1,nsim),nhists)
+    from scipy.spatial import cKDTree
+    tree = cKDTree(allmoments)
+    (_,simindices) = tree.query(selmoments,k=nsim)
+    return simindices.reshape(len(selmoments),nsim)
+
+def get_similar_chunksize(nsim, nbins, nresamples=1):
+    ### get the number of selected histograms to process at once in the resample_similar_* functions
+    # mostly for internal use; chunks of about 1e7 values are processed at once.
+    return max(1,int(1e7/(max(nsim,nresamples)*nbins)))
+
 
 
 
@@ -133,6 +195,7 @@ def plot_data_and_gen(nplot, datahist, genhist, figname='fig.png'):
     # - nplot: integer, maximum number of examples to plot
     # - datahist, genhist: numpy arrays of shape (nhists,nbins)
     # - figname: name of figure to plot
+    import matplotlib.pyplot as plt
 
     # make sure that figname contains absolute path
     figname = os.path.abspath(figname)
@@ -160,6 +223,8 @@ def plot_seed_and_gen(seedhist, genhist, figname='fig.png'):
     # input arguments:
     # - datahist, genhist: numpy arrays of shape (nhists,nbins)
     # - figname: name of figure to plot
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
 
     # make sure that figname contains absolute path
     figname = os.path.abspath(figname)
@@ -179,6 +244,7 @@ def plot_seed_and_gen(seedhist, genhist, figname='fig.png'):
 def plot_noise(noise, histstd=None, figname='fig.png'):
     ### plot histograms in noise (numpy array of shape (nhists,nbins))
     # optional argument histstd plots +- histstd as boundaries
+    import matplotlib.pyplot as plt
 
     # make sure that figname contains absolute path
     figname = os.path.abspath(figname)
@@ -197,7 +263,7 @@ def plot_noise(noise, histstd=None, figname='fig.png'):
 
 
 
-def fourier_noise_on_mean(hists, outfilename='', figname='', nresamples=0, nonnegative=True):
+def fourier_noise_on_mean(hists, outfilename='', figname='', nresamples=0, nonnegative=True, rng=None):
     ### apply fourier noise on the bin-per-bin mean histogram, with amplitude scaling based on bin-per-bin std histogram.
     # input args:
     # - hists: numpy array of shape (nhists,nbins) used for determining mean and std
@@ -205,6 +271,7 @@ def fourier_noise_on_mean(hists, outfilename='', figname='', nresamples=0, nonne
     # - figname: path to figure plotting examples (default: no plotting)
     # - nresamples: number of samples to draw (default: number of input histograms / 10)
     # - nonnegative: boolean whether to set all bins to minimum zero after applying noise
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
     # MOSTLY SUITABLE AS HELP FUNCTION FOR RESAMPLE_SIMILAR_FOURIER_NOISE, NOT AS GENERATOR IN ITSELF
     # advantages: mean histogram is almost certainly 'good' because of averaging, eliminate bad histograms
     # disadvantages: deviations from mean are small, does not model systematic shifts by lumi.
@@ -220,6 +287,7 @@ def fourier_noise_on_mean(hists, outfilename='', figname='', nresamples=0, nonne
     if len(figname)>0:
         nplot = min(200,len(hists))
         randint = np.random.choice(np.arange(len(hists)),size=nplot,replace=False)
+        import matplotlib.pyplot as plt
         plt.figure()
         for i in randint: plt.plot(hists[int(i),:],color='b',alpha=0.1)
         plt.plot(histmean,color='black',label='mean')
@@ -230,16 +298,14 @@ def fourier_noise_on_mean(hists, outfilename='', figname='', nresamples=0, nonne
         #plt.close()
     
     # generate data
-    reshists = np.zeros((nresamples,nbins))
-    for i in range(nresamples): reshists[i,:] = histmean + goodnoise(nbins,histstd)
+    reshists = histmean + goodnoise_batch(nresamples,nbins,fstd=histstd,rng=rng)
     if nonnegative:
         reshists = np.where(reshists>0,reshists,0)
         
     # plot examples of good and bad histograms
     if len(figname)>0:
-        noise_examples = []
-        for i in range(5): noise_examples.append(goodnoise(nbins,histstd))
-        plot_noise(np.array(noise_examples),histstd,figname)
+        noise_examples = goodnoise_batch(5,nbins,fstd=histstd,rng=rng)
+        plot_noise(noise_examples,histstd,figname)
         plot_data_and_gen(50,hists,reshists,figname)
 
     # store results if requested
@@ -250,7 +316,7 @@ def fourier_noise_on_mean(hists, outfilename='', figname='', nresamples=0, nonne
 
 
 
-def fourier_noise(hists, outfilename='', figname='', nresamples=1, nonnegative=True, stdfactor=15.):
+def fourier_noise(hists, outfilename='', figname='', nresamples=1, nonnegative=True, stdfactor=15., rng=None):
     ### apply fourier noise on random histograms with simple flat amplitude scaling.
     # input args: 
     # - hists: numpy array of shape (nhists,nbins) used for seeding
@@ -259,25 +325,25 @@ def fourier_noise(hists, outfilename='', figname='', nresamples=1, nonnegative=T
     # - nresamples: number of samples to draw per input histogram
     # - nonnegative: boolean whether to set all bins to minimum zero after applying noise
     # - stdfactor: factor to scale magnitude of noise (larger factor = smaller noise)
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
     # advantages: resampled histograms will have statistically same features as original input set
     # disadvantages: also 'bad' histograms will be resampled if included in hists
     
     (nhists,nbins) = hists.shape
+    if rng is None: rng = np.random
     
     # generate data
-    reshists = np.zeros((nresamples*len(hists),nbins))
-    for i in range(nhists):
-        for j in range(nresamples):
-            reshists[nresamples*i+j,:] = hists[i,:]+goodnoise(nbins,hists[i,:]/stdfactor)
+    # (resample j of input histogram i ends up at index nresamples*i+j before shuffling)
+    reshists = np.repeat(hists.astype(float,copy=False),nresamples,axis=0)
+    reshists += goodnoise_batch(nresamples*nhists,nbins,fstd=reshists/stdfactor,rng=rng)
     if nonnegative:
         reshists = np.where(reshists>0,reshists,0)
-    np.random.shuffle(reshists)
+    rng.shuffle(reshists)
 
     # plot examples of good and bad histograms
     if len(figname)>0: 
-        noise_examples = []
-        for i in range(5): noise_examples.append(goodnoise(nbins,hists[-1,:]/stdfactor))
-        plot_noise(np.array(noise_examples),hists[-1,:]/stdfactor,figname)
+        noise_examples = goodnoise_batch(5,nbins,fstd=hists[-1,:]/stdfactor,rng=rng)
+        plot_noise(noise_examples,hists[-1,:]/stdfactor,figname)
         plot_data_and_gen(50,hists,reshists,figname)
     
     # store results if requested
@@ -285,12 +351,12 @@ def fourier_noise(hists, outfilename='', figname='', nresamples=1, nonnegative=T
 
     return reshists
 
-def upsample_hist_set(hists,ntarget,fourierstdfactor=15.,figname='f'):
+def upsample_hist_set(hists,ntarget,fourierstdfactor=15.,figname='f',rng=None):
     ### wrapper for fourier_noise allowing for a fixed target number of histograms instead of a fixed resampling factor
     # useful function for quickly generating a fixed number of resampled histograms,
     # without bothering too much about what exact resampling technique or detailed settings would be most appropriate.
     nresamples = max(1,int(float(ntarget)/len(hists)))    
-    hists_ext = fourier_noise(hists,figname=figname,nresamples=nresamples,nonnegative=True,stdfactor=fourierstdfactor)
+    hists_ext = fourier_noise(hists,figname=figname,nresamples=nresamples,nonnegative=True,stdfactor=fourierstdfactor,rng=rng)
     return hists_ext
 
 
@@ -355,7 +421,7 @@ def resample_bin_per_bin(hists, outfilename='', figname='', nresamples=0, nonneg
 
 
 def resample_similar_bin_per_bin( allhists, selhists, outfilename='', figname='', nresamples=1, nonnegative=True,
-                                   keeppercentage=1.):
+                                   keeppercentage=1., rng=None):
     ### resample from bin-per-bin probability distributions, but only from similar looking histograms.
     # input args:
     # - allhists: np array (nhists,nbins) containing all available histograms (to determine mean)
@@ -365,6 +431,7 @@ def resample_similar_bin_per_bin( allhists, selhists, outfilename='', figname=''
     # - nresamples: number of samples per input histogram in selhists
     # - nonnegative: boolean whether or not to put all bins to minimum zero after applying noise
     # - keeppercentage: percentage (between 1 and 100) of histograms in allhists to use per input histogram
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
     # advantages: no assumptions on shape of noise,
     #             can handle systematic shifts in histograms
     # disadvantages: bins are treated independently from each other
@@ -372,30 +439,26 @@ def resample_similar_bin_per_bin( allhists, selhists, outfilename='', figname=''
     # set some parameters
     (nhists,nbins) = allhists.shape
     (nsel,_) = selhists.shape
+    if rng is None: rng = np.random
     
-    # get array of moments (used to define similar histograms)
-    binwidth = 1./nbins
-    bincenters = np.linspace(binwidth/2,1-binwidth/2,num=nbins,endpoint=True)
-    orders = [0,1,2]
-    allmoments = np.zeros((nhists,len(orders)))
-    for i,j in enumerate(orders): allmoments[:,i] = hist_utils.moment(bincenters,allhists,j)
-    selmoments = np.zeros((nsel,len(orders)))
-    for i,j in enumerate(orders): selmoments[:,i] = hist_utils.moment(bincenters,selhists,j)
+    # select similar histograms (based on moments)
+    simindices = get_similar_indices(get_similarity_moments(allhists),get_similarity_moments(selhists),
+                                     keeppercentage=keeppercentage)
+    nsim = simindices.shape[1]
     
     # make resamples
+    # (for each bin, draw the value of a random histogram in the neighbourhood,
+    #  processing a chunk of selected histograms at once)
     reshists = np.zeros((nsel*nresamples,nbins))
-    for i in range(nsel):
-        # select similar histograms
-        thisdiff = moments_correlation_vector(np.vstack((selmoments[i],allmoments)),0)[1:]
-        #thisdiff = mse_correlation_vector(np.vstack((selhists[i],allhists)),0)[1:]
-        threshold = np.percentile(thisdiff,keeppercentage)
-        simindices = np.nonzero(np.where(thisdiff<=threshold,1,0))[0]
-        for j in range(nresamples):
-            reshists[nresamples*i+j,:] = resample_bin_per_bin(allhists[simindices,:],
-               figname='',nresamples=1,nonnegative=nonnegative,smoothinghalfwidth=0)[0,:]
+    binindices = np.arange(nbins)
+    chunksize = get_similar_chunksize(nsim,nbins,nresamples=nresamples)
+    for start in range(0,nsel,chunksize):
+        stop = min(nsel,start+chunksize)
+        choice = (rng.uniform(low=0,high=1,size=(stop-start,nresamples*nbins))*nsim).astype(int)
+        histindices = np.take_along_axis(simindices[start:stop],choice,axis=1).reshape(stop-start,nresamples,nbins)
+        reshists[nresamples*start:nresamples*stop] = allhists[histindices,binindices].reshape(-1,nbins)
     if nonnegative: reshists = np.maximum(0,reshists)
-    np.random.shuffle(reshists)
-    nsim = len(simindices)
+    rng.shuffle(reshists)
     print('Note: bin-per-bin resampling performed on '+str(nsim)+' histograms.')
     print('If this number is too low, existing histograms are drawn with too small variation.')
     print('If this number is too high, systematic shifts of histograms can be averaged out.')
@@ -412,7 +475,7 @@ def resample_similar_bin_per_bin( allhists, selhists, outfilename='', figname=''
 
 
 def resample_similar_fourier_noise( allhists, selhists, outfilename='', figname='', nresamples=1, nonnegative=True,
-                                   keeppercentage=1.):
+                                   keeppercentage=1., rng=None):
     ### apply fourier noise on mean histogram, 
     # where the mean is determined from a set of similar-looking histograms
     # input args:
@@ -423,6 +486,7 @@ def resample_similar_fourier_noise( allhists, selhists, outfilename='', figname=
     # - nresamples: number of samples per input histogram in selhists
     # - nonnegative: boolean whether or not to put all bins to minimum zero after applying noise
     # - keeppercentage: percentage (between 1 and 100) of histograms in allhists to use per input histogram
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
     # advantages: most of fourier_noise_on_mean but can additionally handle shifting histograms,
     #             apart from fourier noise, also white noise can be applied.
     # disadvantages: does not filter out odd histograms as long as enough other odd histograms look more or less similar
@@ -433,30 +497,29 @@ def resample_similar_fourier_noise( allhists, selhists, outfilename='', figname=
         return
     (nhists,nbins) = allhists.shape
     (nsel,_) = selhists.shape
+    if rng is None: rng = np.random
 
-    # get array of moments (used to define similar histograms)
-    binwidth = 1./nbins
-    bincenters = np.linspace(binwidth/2,1-binwidth/2,num=nbins,endpoint=True)
-    orders = [0,1,2]
-    allmoments = np.zeros((nhists,len(orders)))
-    for i,j in enumerate(orders): allmoments[:,i] = hist_utils.moment(bincenters,allhists,j)
-    selmoments = np.zeros((nsel,len(orders)))
-    for i,j in enumerate(orders): selmoments[:,i] = hist_utils.moment(bincenters,selhists,j)
+    # select similar histograms (based on moments)
+    simindices = get_similar_indices(get_similarity_moments(allhists),get_similarity_moments(selhists),
+                                     keeppercentage=keeppercentage)
+    nsim = simindices.shape[1]
  
+    # get mean and std histogram of each neighbourhood
+    histmean = np.zeros((nsel,nbins))
+    histstd = np.zeros((nsel,nbins))
+    chunksize = get_similar_chunksize(nsim,nbins)
+    for start in range(0,nsel,chunksize):
+        stop = min(nsel,start+chunksize)
+        simhists = allhists[simindices[start:stop]]
+        histmean[start:stop] = np.mean(simhists,axis=1)
+        histstd[start:stop] = np.std(simhists,axis=1)
+    
     # make resampled histograms
-    reshists = np.zeros((nsel*nresamples,nbins))
-    for i in range(nsel):
-        # select similar histograms
-        thisdiff = moments_correlation_vector(np.vstack((selmoments[i],allmoments)),0)[1:]
-        #thisdiff = mse_correlation_vector(np.vstack((selhists[i],allhists)),0)[1:]
-        threshold = np.percentile(thisdiff,keeppercentage)
-        simindices = np.nonzero(np.where(thisdiff<threshold,1,0))[0]
-        for j in range(nresamples):
-            reshists[nresamples*i+j,:] = fourier_noise_on_mean(allhists[simindices,:],
-                                                               figname='',nresamples=1,nonnegative=nonnegative)[0,:]
+    # (resample j of selected histogram i is at index nresamples*i+j before shuffling)
+    reshists = np.repeat(histmean,nresamples,axis=0)
+    reshists += goodnoise_batch(nsel*nresamples,nbins,fstd=np.repeat(histstd,nresamples,axis=0),rng=rng)
     if nonnegative: reshists = np.maximum(0,reshists)
-    np.random.shuffle(reshists)
-    nsim = len(simindices)
+    rng.shuffle(reshists)
     print('Note: mean and std calculation is performed on '+str(nsim)+' histograms.')
     print('If this number is too low, histograms might be too similar for averaging to have effect.')
     print('If this number is too high, systematic shifts of histogram shapes are included into the averaging.')
@@ -474,7 +537,7 @@ def resample_similar_fourier_noise( allhists, selhists, outfilename='', figname=
 
 
 def resample_similar_lico( allhists, selhists, outfilename='', figname='', nresamples=1, nonnegative=True,
-                          keeppercentage=1.):
+                          keeppercentage=1., rng=None):
     ### take linear combinations of similar histograms
     # input arguments:
     # - allhists: 2D np array (nhists,nbins) with all available histograms, used to take linear combinations
@@ -484,6 +547,7 @@ def resample_similar_lico( allhists, selhists, outfilename='', figname='', nresa
     # - nresamples: number of combinations to make per input histogram
     # - nonnegative: boolean whether to make all final histograms nonnegative
     # - keeppercentage: percentage (between 0. and 100.) of histograms in allhists to use per input histogram
+    # - rng: numpy random Generator used for sampling (default: the global numpy random state)
     # advantages: no assumptions on noise
     # disadvantages: sensitive to outlying histograms (more than with averaging)
     
@@ -493,36 +557,25 @@ def resample_similar_lico( allhists, selhists, outfilename='', figname='', nresa
         return
     (nhists,nbins) = allhists.shape
     (nsel,_) = selhists.shape
+    if rng is None: rng = np.random
     
-    # get array of moments (used to define similar histograms)
-    binwidth = 1./nbins
-    bincenters = np.linspace(binwidth/2,1-binwidth/2,num=nbins,endpoint=True)
-    orders = [0,1,2]
-    allmoments = np.zeros((nhists,len(orders)))
-    for i,j in enumerate(orders): allmoments[:,i] = hist_utils.moment(bincenters,allhists,j)
-    selmoments = np.zeros((nsel,len(orders)))
-    for i,j in enumerate(orders): selmoments[:,i] = hist_utils.moment(bincenters,selhists,j)
+    # select similar histograms (based on moments)
+    simindices = get_similar_indices(get_similarity_moments(allhists),get_similarity_moments(selhists),
+                                     keeppercentage=keeppercentage)
+    nsim = simindices.shape[1]
     
     # make resampled histograms
+    # (random coefficients summing to one, multiplied with the histograms in the neighbourhood,
+    #  processing a chunk of selected histograms at once)
     reshists = np.zeros((nsel*nresamples,nbins))
-    for i in range(nsel):
-        # select similar histograms
-        thisdiff = moments_correlation_vector(np.vstack((selmoments[i],allmoments)),0)[1:]
-        # printouts for testing purposes
-        #for j in range(nhists):
-        #    print(str(allmoments[j])+' -> '+str(thisdiff[j]))
-        #thisdiff = mse_correlation_vector(np.vstack((selhists[i],allhists)),0)[1:]
-        threshold = np.percentile(thisdiff,keeppercentage)
-        simindices = np.nonzero(np.where(thisdiff<=threshold,1,0))[0]
-        # printouts for testing purposes
-        #print('---------------')
-        #for j in simindices:
-        #    print(str(allmoments[j])+' -> '+str(thisdiff[j]))
-        for j in range(nresamples):
-            reshists[nresamples*i+j,:] = random_lico(allhists[simindices,:])
+    chunksize = get_similar_chunksize(nsim,nbins,nresamples=nresamples)
+    for start in range(0,nsel,chunksize):
+        stop = min(nsel,start+chunksize)
+        coeffs = rng.uniform(low=0.,high=1.,size=(stop-start,nresamples,nsim))
+        coeffs /= np.sum(coeffs,axis=2,keepdims=True)
+        reshists[nresamples*start:nresamples*stop] = np.matmul(coeffs,allhists[simindices[start:stop]]).reshape(-1,nbins)
     if nonnegative: reshists = np.maximum(0,reshists)
-    np.random.shuffle(reshists)
-    nsim = len(simindices)
+    rng.shuffle(reshists)
     print('Note: linear combination is taken between '+str(nsim)+' histograms.')
     print('If this number is too low, histograms might be too similar for combination to have effect.')
     print('If this number is too high, systematic shifts of histogram shapes are included into the combination')
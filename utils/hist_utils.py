@@ -15,16 +15,12 @@
 
 # external modules
 import numpy as np
-from sklearn.preprocessing import normalize
-import importlib
 
 # local modules
 import dataframe_utils
-importlib.reload(dataframe_utils)
 import csv_utils
-importlib.reload(csv_utils)
-import plot_utils
-importlib.reload(plot_utils)
+import sparse_hist_utils as shu
+# (plot_utils, and with it matplotlib, is only imported when plotting is requested)
 
 
 
@@ -45,6 +41,8 @@ def crophists(hists, slices):
     # - see tutorials/plot_histograms_2d.ipynb
     # returns:
     # - a numpy array containing the same histograms as input but cropped according to the slices argument
+    # note: hists can also be a SparseHists object, in which case a SparseHists object is returned (see sparse_hist_utils.py)
+    if isinstance(hists,shu.SparseHists): return shu.crophists_sparse(hists,slices)
     if len(hists.shape)==2:
         if isinstance(slices,slice): slices=[slices]
         return hists[:,slices[0]]
@@ -66,6 +64,9 @@ def rebinhists(hists, factor):
     # - see tutorials/plot_histograms_2d.ipynb
     # returns:
     # - a numpy array containing the same histograms as input but rebinned according to the factor argument
+    #   (with the same data type as the input)
+    # note: hists can also be a SparseHists object, in which case a SparseHists object is returned (see sparse_hist_utils.py)
+    if isinstance(hists,shu.SparseHists): return shu.rebinhists_sparse(hists,factor)
     if len(hists.shape)==2:
         if(not hists.shape[1]%factor==0): 
             print('WARNING in hist_utils.py / rebinhists: no rebinning performed since no suitable reduction factor was given.'
@@ -73,7 +74,7 @@ def rebinhists(hists, factor):
             return hists
         (nhists,nbins) = hists.shape
         newnbins = int(nbins/factor)
-        rebinned = np.zeros((nhists,newnbins))
+        rebinned = np.zeros((nhists,newnbins),dtype=hists.dtype)
         for i in range(newnbins):
             rebinned[:,i] = np.sum(hists[:,factor*i:factor*(i+1)],axis=1)
         return rebinned
@@ -89,7 +90,7 @@ def rebinhists(hists, factor):
         (nhists,nybins,nxbins) = hists.shape
         newnybins = int(nybins/factor[0])
         newnxbins = int(nxbins/factor[1])
-        rebinned = np.zeros((nhists,newnybins,newnxbins))
+        rebinned = np.zeros((nhists,newnybins,newnxbins),dtype=hists.dtype)
         for i in range(newnybins):
             for j in range(newnxbins):
                 rebinned[:,i,j] = np.sum(hists[:,factor[0]*i:factor[0]*(i+1),factor[1]*j:factor[1]*(j+1)],axis=(1,2))
@@ -99,6 +100,17 @@ def rebinhists(hists, factor):
 
 ### normalization
 
+def normalize_l1(arr):
+    ### normalize each row of a 2D array so that the sum of absolute values is one
+    # equivalent to sklearn.preprocessing.normalize(arr, norm='l1', axis=1)
+    # (rows with only zeros are left unchanged), but without the overhead of importing sklearn.
+    # floating point arrays keep their data type (e.g. float32), other arrays are converted to float64.
+    arr = np.asarray(arr)
+    if arr.dtype.kind!='f': arr = arr.astype(float)
+    norms = np.sum(np.abs(arr),axis=1,keepdims=True)
+    norms[norms==0] = 1.
+    return arr/norms
+
 def normalizehists(hists):
     ### perform normalization on a set of histograms
     # note: 
@@ -109,12 +121,13 @@ def normalizehists(hists):
     # - hists: a numpy array of shape (nhistograms,nbins) for 1D or (nhistograms,nybins,nxbins) for 2D
     # returns:
     # - a numpy array containing the same histograms as input but normalized
-    if len(hists.shape)==2: return normalize(hists, norm='l1', axis=1)
+    #   (with the same data type as the input for floating point types, float64 otherwise)
+    # note: hists can also be a SparseHists object, in which case a SparseHists object is returned (see sparse_hist_utils.py)
+    if isinstance(hists,shu.SparseHists): return shu.normalizehists_sparse(hists)
+    if len(hists.shape)==2: return normalize_l1(hists)
     elif len(hists.shape)==3:
-        normhists = []
-        for i in range(len(hists)):
-            normhists.append( hists[i]/hists[i].max() )
-        return np.array(normhists)
+        if hists.dtype.kind!='f': hists = hists.astype(float)
+        return hists/np.max(hists,axis=(1,2),keepdims=True)
     else:
         raise Exception('ERROR in hist_utils.py / normalizehists: histograms have invalid input shape: {}'.format(hists.shape))
 
@@ -178,11 +191,11 @@ def running_average_hists(hists, window, weights=None):
         raise Exception('ERROR in hist_utils.py / running_average_hists: weights argument is invalid: '
                        +'found length {} while the window has length {}'.format(len(weights),nwindow))
     avghists = np.zeros(hists.shape)
-    weights = normalize([weights], norm='l1')[0]
+    weights = normalize_l1([weights])[0]
     # first low edge
     for i in range(window[0]):
         thesehists = hists[0:i+1+window[1]]
-        theseweights = normalize([weights[-len(thesehists):]], norm='l1')[0]
+        theseweights = normalize_l1([weights[-len(thesehists):]])[0]
         avghists[i] = np.average( thesehists, weights=theseweights, axis=0 )
     # then middle part
     for i in range(window[0],len(avghists)-window[1]):
@@ -191,7 +204,7 @@ def running_average_hists(hists, window, weights=None):
     # finally high edge
     for i in range(len(avghists)-window[1],len(avghists)):
         thesehists = hists[i-window[0]:]
-        theseweights = normalize([weights[:len(thesehists)]], norm='l1')[0]
+        theseweights = normalize_l1([weights[:len(thesehists)]])[0]
         avghists[i] = np.average( thesehists, weights=theseweights, axis=0 )
     return avghists
 
@@ -266,6 +279,7 @@ def preparedatafromnpy(dataname, cropslices=None, rebinningfactor=None, donormal
         return hist
     
     # plot some examples
+    import plot_utils
     nplot = min(8,len(hist))
     flatindex = np.linspace(0,len(hist),num=len(hist),endpoint=False)
     randint = np.random.choice(flatindex,size=nplot,replace=False).astype(int)
@@ -278,7 +292,7 @@ def preparedatafromnpy(dataname, cropslices=None, rebinningfactor=None, donormal
                                        title = 'histogram examples' )
     return hist
 
-def preparedatafromdf(df, returnrunls=False, cropslices=None, rebinningfactor=None, donormalize=False, doplot=False):
+def preparedatafromdf(df, returnrunls=False, cropslices=None, rebinningfactor=None, donormalize=False, doplot=False, dtype=float, sparse=False):
     ### prepare the data contained in a dataframe in the form of a numpy array
     # input arguments:
     # - returnrunls: boolean whether to return a tuple of (histograms, run numbers, lumisection numbers).
@@ -287,9 +301,13 @@ def preparedatafromdf(df, returnrunls=False, cropslices=None, rebinningfactor=No
     # - rebinningfactor: an integer (or tuple of integers for 2D histograms) to downsample/rebin the histograms (default: no rebinning)
     # - donormalize: boolean whether to normalize the data
     # - doplot: if True, some example plots are made showing the histograms
+    # - dtype: data type in which to decode and process the histograms (default: float64),
+    #   e.g. np.float32 to halve the memory (see also dataframe_utils.get_hist_values)
+    # - sparse: boolean whether to return the histograms as a SparseHists object instead of a numpy array
+    #   (recommended for mostly empty histograms, see sparse_hist_utils.py)
 
     # preprocessing of the data: rebinning and normalizing
-    (hist,runnbs,lsnbs) = dataframe_utils.get_hist_values(df)
+    (hist,runnbs,lsnbs) = dataframe_utils.get_hist_values(df,dtype=dtype,sparse=sparse)
     if cropslices is not None:  hist = crophists(hist,cropslices)
     if rebinningfactor is not None: hist = rebinhists(hist,rebinningfactor)
     if donormalize: hist = normalizehists(hist)
@@ -299,21 +317,22 @@ def preparedatafromdf(df, returnrunls=False, cropslices=None, rebinningfactor=No
         else: return hist
     
     # plot some examples
+    import plot_utils
     nplot = min(8,len(hist))
     flatindex = np.linspace(0,len(hist),num=len(hist),endpoint=False)
     randint = np.random.choice(flatindex,size=nplot,replace=False).astype(int)
     if len(hist.shape)==2:
-        _,_ = plot_utils.plot_hists( hist[randint], colorlist='b',
+        _,_ = plot_utils.plot_hists( np.asarray(hist[randint]), colorlist='b',
                                     title = 'histogram examples',
                                     xaxtitle = 'bin number' )
     if len(hist.shape)==3:
-        _,_ = plot_utils.plot_hists_2d( hist[randint], ncols=4, 
+        _,_ = plot_utils.plot_hists_2d( np.asarray(hist[randint]), ncols=4, 
                                        title = 'histogram examples' )
         
     if returnrunls: return (hist,runnbs,lsnbs)
     else: return hist
 
-def preparedatafromcsv(dataname, returnrunls=False, cropslices=None, rebinningfactor=None, donormalize=True, doplot=False):
+def preparedatafromcsv(dataname, returnrunls=False, cropslices=None, rebinningfactor=None, donormalize=True, doplot=False, dtype=float, sparse=False):
     ### prepare the data contained in a dataframe csv file in the form of a numpy array
     # input arguments:
     # - returnrunls: boolean whether to return a tuple of (histograms, run numbers, lumisection numbers).
@@ -322,11 +341,13 @@ def preparedatafromcsv(dataname, returnrunls=False, cropslices=None, rebinningfa
     # - rebinningfactor: an integer (or tuple of integers for 2D histograms) to downsample/rebin the histograms (default: no rebinning)
     # - donormalize: boolean whether to normalize the data
     # - doplot: if True, some example plots are made showing the histograms
+    # - dtype: data type in which to decode and process the histograms (default: float64)
+    # - sparse: boolean whether to return the histograms as a SparseHists object (see preparedatafromdf)
 
     # read data
     df = csv_utils.read_csv(dataname)
     # prepare data from df
-    return preparedatafromdf(df, returnrunls=returnrunls, cropslices=cropslices, rebinningfactor=rebinningfactor,donormalize=donormalize,doplot=doplot)
+    return preparedatafromdf(df, returnrunls=returnrunls, cropslices=cropslices, rebinningfactor=rebinningfactor,donormalize=donormalize,doplot=doplot,dtype=dtype,sparse=sparse)
 
 
 
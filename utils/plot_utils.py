@@ -345,6 +345,7 @@ def plot_fit_2d( points, fitfunc=None, logprob=False, onlycontour=False, xlims=5
     # - fitfunc: an object of type CloudFitter (see src/cloudfitters) 
     #   or any other object that implements a pdf(points) method
     # - logprob: boolean whether to plot log probability or normal probability
+    #   (if fitfunc implements a logpdf(points) method, it is used directly)
     # - onlycontour: a boolean whether to draw only the fit or include the data points
     # - xlims and ylims: tuples of (low,high)
     #   note: can be an integer, in which case the range will be determined automatically
@@ -375,8 +376,10 @@ def plot_fit_2d( points, fitfunc=None, logprob=False, onlycontour=False, xlims=5
         # make a grid of points and evaluate the fitfunc
         x,y = np.mgrid[xlims[0]:xlims[1]:xstep,ylims[0]:ylims[1]:ystep]
         gridpoints = np.transpose(np.vstack((np.ravel(x),np.ravel(y))))
-        evalpoints = fitfunc.pdf(gridpoints)
-        if logprob: evalpoints = np.log(evalpoints)
+        if( logprob and hasattr(fitfunc,'logpdf') ): evalpoints = fitfunc.logpdf(gridpoints)
+        else:
+            evalpoints = fitfunc.pdf(gridpoints)
+            if logprob: evalpoints = np.log(evalpoints)
         z = np.reshape(evalpoints,x.shape)
 
         # make a plot of probability contours
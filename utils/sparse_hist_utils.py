@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# **Sparse storage of histograms and sparse-aware processing**  
+# 
+# Many 2D histograms (e.g. pixel occupancy maps) are mostly empty, so storing them as dense arrays of shape (nhists,nybins,nxbins) wastes a lot of memory, and processing them densely wastes a lot of time.  
+# The SparseHists class stores a set of histograms as a single scipy.sparse CSR matrix (one row per histogram, one column per bin), together with the shape of a single histogram. It behaves like a numpy array of histograms for the common operations (len, shape, indexing on the first axis, conversion to a dense array).  
+# 
+# The functions in this script implement the preprocessing steps (cropping, rebinning, normalizing) and the maximum pull calculation of MaxPullClassifier directly on the sparse representation, so that their memory usage and run time scale with the number of non-zero bins instead of the full grid. hist_utils.crophists, rebinhists and normalizehists automatically use them when called with a SparseHists object.  
+# Use tosparse (or the sparse argument of dataframe_utils.get_hist_values and hist_utils.preparedatafromdf) to create a SparseHists object.
+
+
+
+### imports
+
+# external modules
+import hashlib
+import numpy as np
+# (scipy.sparse is only imported in the functions that need it)
+
+# local modules
+
+
+
+
+class SparseHists(object):
+    ### a set of histograms stored as a scipy.sparse CSR matrix of shape (nhists,nbins)
+    # supports len, shape, ndim, dtype and indexing along the first axis:
+    # an integer gives a single dense histogram, slices, boolean masks and integer arrays give a new SparseHists object,
+    # and a tuple (e.g. hists[i:i+1,:]) gives a dense array.
+    # use toarray (or np.asarray) to obtain the full dense array.
+
+    def __init__( self, matrix, histshape ):
+        ### initializer
+        # input arguments:
+        # - matrix: a scipy.sparse matrix (or array) of shape (nhists,nbins), converted to CSR format if needed
+        # - histshape: shape of a single histogram, e.g. (nbins,) for 1D or (nybins,nxbins) for 2D
+        # notes:
+        # - explicitly stored zeros are removed, since the sparse kernels assume that all stored values are non-zero.
+        from scipy.sparse import csr_matrix
+        self.matrix = csr_matrix(matrix)
+        self.matrix.eliminate_zeros()
+        self.histshape = tuple(histshape)
+        if self.matrix.shape[1]!=int(np.prod(self.histshape)):
+            raise Exception('ERROR in SparseHists.__init__: matrix has {} columns'.format(self.matrix.shape[1])
+                           +' while histograms of shape {} were specified.'.format(self.histshape))
+
+    @property
+    def shape( self ): return (self.matrix.shape[0],)+self.histshape
+
+    @property
+    def ndim( self ): return 1+len(self.histshape)
+
+    @property
+    def dtype( self ): return self.matrix.dtype
+
+    @property
+    def nnz( self ): return self.matrix.nnz
+
+    @property
+    def nbytes( self ):
+        ### memory taken by the sparse representation in bytes
+        return self.matrix.data.nbytes+self.matrix.indices.nbytes+self.matrix.indptr.nbytes
+
+    def __len__( self ):
+        return self.matrix.shape[0]
+
+    def __getitem__( self, key ):
+        ### get the histograms for a given index, slice, mask or list of indices
+        if isinstance(key,tuple):
+            if isinstance(key[0],(int,np.integer)): return self[key[0]][key[1:]]
+            return self[key[0]].toarray()[(slice(None),)+key[1:]]
+        if isinstance(key,(int,np.integer)):
+            return self.matrix[[key]].toarray().reshape(self.histshape)
+        if not isinstance(key,slice): key = np.asarray(key)
+        return SparseHists( self.matrix[key], self.histshape )
+
+    def toarray( self ):
+        ### convert to a dense numpy array of shape (nhists,)+histshape
+        return self.matrix.toarray().reshape(self.shape)
+
+    def __array__( self, dtype=None, copy=None ):
+        res = self.toarray()
+        if dtype is not None: res = res.astype(dtype)
+        return res
+
+    def copy( self ):
+        return SparseHists( self.matrix.copy(), self.histshape )
+
+    def astype( self, dtype, copy=True ):
+        ### convert the bin contents to a given data type
+        if not copy and self.dtype==np.dtype(dtype): return self
+        return SparseHists( self.matrix.astype(dtype), self.histshape )
+
+    def get_fingerprint( self ):
+        ### return a hash of the histograms (used by HistStruct.get_fingerprint, without converting to a dense array)
+        fingerprint = hashlib.sha1( str((self.shape,self.dtype)).encode() )
+        for arr in [self.matrix.indptr,self.matrix.indices,self.matrix.data]:
+            fingerprint.update( memoryview(np.ascontiguousarray(arr)).cast('B') )
+        return fingerprint.hexdigest()
+
+
+
+
+def tosparse( hists ):
+    ### convert a numpy array of histograms to a SparseHists object
+    # input arguments:
+    # - hists: a numpy array of shape (nhists,nbins) or (nhists,nybins,nxbins)
+    from scipy.sparse import csr_matrix
+    if isinstance(hists,SparseHists): return hists
+    return SparseHists( csr_matrix(hists.reshape(len(hists),-1)), hists.shape[1:] )
+
+def crophists_sparse( hists, slices ):
+    ### sparse version of hist_utils.crophists
+    # input arguments:
+    # - hists: a SparseHists object
+    # - slices: a slice object or a list of slices (one per dimension), see hist_utils.crophists
+    if isinstance(slices,slice): slices=[slices]
+    if len(slices)!=len(hists.histshape):
+        raise Exception('ERROR in sparse_hist_utils.py / crophists_sparse: got {} slices'.format(len(slices))
+                       +' for histograms of shape {}.'.format(hists.histshape))
+    columns = np.arange(hists.matrix.shape[1]).reshape(hists.histshape)[tuple(slices)]
+    return SparseHists( hists.matrix[:,columns.flatten()], columns.shape )
+
+def rebinhists_sparse( hists, factor ):
+    ### sparse version of hist_utils.rebinhists
+    # input arguments:
+    # - hists: a SparseHists object
+    # - factor: the rebinning factor (for 1D), or a tuple of (y axis rebinning factor, x axis rebinning factor) (for 2D),
+    #   see hist_utils.rebinhists (no rebinning is performed if the factors are not divisors of the number of bins)
+    # notes:
+    # - the rebinning is done by multiplying with a sparse matrix mapping the old bins to the new ones.
+    from scipy.sparse import csr_matrix
+    factor = tuple(np.atleast_1d(factor))
+    if( len(factor)!=len(hists.histshape) or any([n%f!=0 for n,f in zip(hists.histshape,factor)]) ):
+        print('WARNING in sparse_hist_utils.py / rebinhists_sparse: no rebinning performed since no suitable reduction factor was given.'
+             +' The rebinning factors ({}) must be divisors of the number of bins ({})'.format(factor,hists.histshape))
+        return hists
+    newshape = tuple([n//f for n,f in zip(hists.histshape,factor)])
+    oldindices = np.unravel_index( np.arange(hists.matrix.shape[1]), hists.histshape )
+    newcolumns = np.ravel_multi_index( tuple([i//f for i,f in zip(oldindices,factor)]), newshape )
+    rebinmatrix = csr_matrix( (np.ones(len(newcolumns),dtype=hists.dtype),(np.arange(len(newcolumns)),newcolumns)),
+                              shape=(len(newcolumns),int(np.prod(newshape))) )
+    return SparseHists( hists.matrix @ rebinmatrix, newshape )
+
+def scalerows( matrix, scales ):
+    ### multiply each row of a CSR matrix by a factor
+    # mostly for internal use.
+    matrix = matrix.copy()
+    matrix.data *= np.repeat( scales.astype(matrix.dtype), np.diff(matrix.indptr) )
+    return matrix
+
+def normalizehists_sparse( hists ):
+    ### sparse version of hist_utils.normalizehists
+    # input arguments:
+    # - hists: a SparseHists object
+    # notes:
+    # - as for dense histograms, 1D histograms are normalized to unit sum and 2D histograms to unit maximum.
+    # - histograms with only zeros remain zero (the dense version gives nan for 2D histograms in that case).
+    if hists.dtype.kind!='f': hists = hists.astype(float)
+    if len(hists.histshape)==1: norms = np.asarray(abs(hists.matrix).sum(axis=1)).ravel()
+    else: norms = hists.matrix.max(axis=1).toarray().ravel()
+    norms[norms==0] = 1
+    return SparseHists( scalerows(hists.matrix,1/norms), hists.histshape )
+
+def maxabspull_sparse( hists, refhist, n=1, chunksize=10000 ):
+    ### sparse version of the maximum pull calculation of MaxPullClassifier (see MaxPullClassifier.maxabspull)
+    # input arguments:
+    # - hists: a SparseHists object
+    # - refhist: a dense numpy array of shape hists.histshape
+    # - n: number of largest pull values to average over
+    # - chunksize: number of histograms to process at once
+    # returns:
+    # - a 1D numpy array with the mean of the n largest absolute pulls per histogram
+    # notes:
+    # - the pull of an empty bin does not depend on the histogram (it is -refhist/denominator),
+    #   so only the non-zero bins need to be calculated explicitly; the largest pulls among the empty bins
+    #   are found by going through the bins in order of decreasing pull for an empty bin,
+    #   until enough empty bins are found for each histogram.
+    # - histograms with only zeros get nan (as for dense histograms).
+    from scipy.sparse import csr_matrix
+    dtype = hists.dtype if hists.dtype.kind=='f' else np.float64
+    refhist = np.asarray(refhist,dtype=dtype).flatten()
+    denom = np.power(refhist,1/2)
+    denom = np.power( np.where( denom<1, 1, denom ), 1/2 )
+    emptypulls = np.abs(refhist/denom)
+    emptyorder = np.argsort(-emptypulls,kind='stable')
+    refsum = np.sum(refhist)
+    nbins = len(refhist)
+    res = np.zeros(len(hists))
+    for start in range(0,len(hists),chunksize):
+        matrix = csr_matrix( hists.matrix[start:start+chunksize], dtype=dtype )
+        nhists = matrix.shape[0]
+        rowsums = np.asarray(matrix.sum(axis=1)).ravel()
+        with np.errstate(divide='ignore'): norm = refsum/rowsums
+        # pulls of the non-zero bins
+        rows = np.repeat( np.arange(nhists), np.diff(matrix.indptr) )
+        pulls = np.abs( (norm[rows]*matrix.data-refhist[matrix.indices])/denom[matrix.indices] )
+        # find the candidate empty bins
+        ncandidates = min(n,nbins)
+        while True:
+            occupied = matrix[:,emptyorder[:ncandidates]]
+            noccupied = np.diff(occupied.indptr)
+            needed = min(n+(np.max(noccupied) if nhists>0 else 0),nbins)
+            if needed<=ncandidates: break
+            ncandidates = needed
+        (emptyrows,emptycols) = np.nonzero( occupied.toarray()==0 )
+        # take the n largest pulls per histogram
+        allrows = np.concatenate([rows,emptyrows])
+        allpulls = np.concatenate([pulls,emptypulls[emptyorder[:ncandidates]][emptycols]])
+        order = np.lexsort( (-allpulls,allrows) )
+        allrows = allrows[order]
+        allpulls = allpulls[order]
+        rank = np.arange(len(allrows))-np.searchsorted(allrows,allrows)
+        keep = (rank<n)
+        res[start:start+nhists] = np.bincount( allrows[keep], weights=allpulls[keep], minlength=nhists )/n
+        res[start:start+nhists][rowsums==0] = np.nan
+    return res
+
+
+
+
+